@@ -0,0 +1,122 @@
+"""
+Fast renderer of the detections for the demos (selected with --renderer sprites, see utils.annotate_frame)
+supervision's annotators format the label of every detection and draw its text with OpenCV in every frame.
+Here each label (class, confidence rounded to --conf_step and track ID) is rasterized only once into a small
+"sprite" with its background, and drawing a frame is just a rectangle and an array copy per detection.
+The labels look like the ones of supervision's BoundingBoxAnnotator + LabelAnnotator (top left corner of the box).
+"""
+
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+RENDERERS = ['supervision', 'sprites']
+
+
+class SpriteAnnotator:
+    """
+    Draws the boxes and labels of the detections with cached label images
+    """
+
+    def __init__(self, colors, text_color=(0, 0, 0), thickness=2, text_scale=0.5, text_thickness=1,
+                 text_padding=10, conf_step=0.05, max_sprites=4096):
+        """
+        :param colors: list of BGR colors (one per class ID, repeated if there are more classes)
+        :param text_color: BGR color of the text
+        :param thickness: thickness of the box lines
+        :param text_scale: font scale of the labels
+        :param text_thickness: thickness of the text
+        :param text_padding: space between the text and the border of its background
+        :param conf_step: the confidence shown in the labels is rounded to a multiple of this
+        :param max_sprites: maximum number of cached labels (tracked detections have a label per track ID)
+        """
+        self.colors = [tuple(int(v) for v in c) for c in colors]
+        self.text_color = tuple(int(v) for v in text_color)
+        self.thickness = thickness
+        self.text_scale = text_scale
+        self.text_thickness = text_thickness
+        self.text_padding = text_padding
+        self.conf_step = conf_step
+        self.max_sprites = max_sprites
+        self.sprites = OrderedDict()  # (class ID, confidence bucket, track ID) -> BGR image, least recently used first
+
+    def _sprite(self, key, class_names_dict):
+        """ Get the label image of a detection, rasterizing it the first time it is needed """
+        sprite = self.sprites.get(key)
+        if sprite is not None:
+            self.sprites.move_to_end(key)
+            return sprite
+        class_id, bucket, tracker_id = key
+        text = "{} {:0.2f}".format(class_names_dict[class_id], bucket * self.conf_step)
+        if tracker_id is not None:
+            text = "#{} {}".format(tracker_id, text)
+        (text_w, text_h), _ = cv2.getTextSize(text, FONT, self.text_scale, self.text_thickness)
+        # One pixel more than the padded text, like the filled rectangle of supervision (its corners are inclusive)
+        sprite = np.empty((text_h + 2 * self.text_padding + 1, text_w + 2 * self.text_padding + 1, 3), dtype=np.uint8)
+        sprite[:] = self.colors[class_id % len(self.colors)]
+        cv2.putText(sprite, text, (self.text_padding, self.text_padding + text_h), FONT, self.text_scale,
+                    self.text_color, self.text_thickness, cv2.LINE_AA)
+        self.sprites[key] = sprite
+        if len(self.sprites) > self.max_sprites:
+            self.sprites.popitem(last=False)
+        return sprite
+
+    def annotate(self, scene, detections, class_names_dict):
+        """
+        :param scene: BGR image (it is drawn in place)
+        :param detections: supervision Detections object
+        :param class_names_dict: dictionary with model's class names {class_id: class_name, ...}
+        :return: annotated image
+        """
+        if len(detections) == 0:
+            return scene
+        h, w = scene.shape[:2]
+        xyxy = detections.xyxy.astype(int).tolist()
+        class_ids = detections.class_id.tolist()
+        buckets = np.rint(detections.confidence / self.conf_step).astype(int).tolist()
+        tracker_ids = [None] * len(xyxy) if detections.tracker_id is None else detections.tracker_id.tolist()
+
+        # All the boxes first, so that no box is drawn over a label
+        for (x1, y1, x2, y2), class_id in zip(xyxy, class_ids):
+            cv2.rectangle(scene, (x1, y1), (x2, y2), self.colors[class_id % len(self.colors)], self.thickness)
+
+        for (x1, y1, _, _), key in zip(xyxy, zip(class_ids, buckets, tracker_ids)):
+            sprite = self._sprite(key, class_names_dict)
+            # The label sits on top of the box, clipped to the frame
+            top, left = y1 - sprite.shape[0] + 1, x1
+            y_a, y_b = max(top, 0), min(top + sprite.shape[0], h)
+            x_a, x_b = max(left, 0), min(left + sprite.shape[1], w)
+            if y_a < y_b and x_a < x_b:
+                scene[y_a:y_b, x_a:x_b] = sprite[y_a - top:y_b - top, x_a - left:x_b - left]
+        return scene
+
+
+def add_annotation_args(parser):
+    """
+    Add the renderer options to a script's argument parser
+    :param parser: argparse.ArgumentParser
+    :return: None
+    """
+    parser.add_argument('--renderer', type=str, default='supervision', choices=RENDERERS,
+                        help="How the detections are drawn: supervision's annotators or cached label sprites "
+                             "(faster with many detections)")
+    parser.add_argument('--conf_step', type=float, default=0.05,
+                        help="With --renderer sprites, the confidence of the labels is rounded to this step")
+
+
+def annotators_from_args(class_colors, args):
+    """
+    :param class_colors: supervision ColorPalette with a color per class
+    :param args: parsed arguments of a script that called add_annotation_args
+    :return: box annotator and label annotator for utils.annotate_frame
+             (with --renderer sprites, the same SpriteAnnotator draws both)
+    """
+    import supervision as spv
+
+    if args.renderer == 'sprites':
+        annotator = SpriteAnnotator([c.as_bgr() for c in class_colors.colors], conf_step=args.conf_step)
+        return annotator, annotator
+    return (spv.BoundingBoxAnnotator(thickness=2, color=class_colors),
+            spv.LabelAnnotator(color=class_colors, text_color=spv.Color.from_hex("#000000")))
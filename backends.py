@@ -0,0 +1,415 @@
+"""
+Inference backends shared by run.py and live_demo.py
+All of them take BGR images and return one supervision.Detections per image (in the coordinates of each image),
+so annotate_frame and the report code work the same with any of them.
+The images are letterboxed once, straight into a reusable input buffer (see Preprocessor), by all the backends:
+    - torch: the Ultralytics model, as before
+    - onnx: the model exported to ONNX (once, next to the .pt file) and run with ONNX Runtime
+    - openvino: the same ONNX file compiled with OpenVINO
+The ONNX model can also be quantized to INT8, calibrated on a sample of validation images.
+"""
+
+import ast
+import os
+import tempfile
+from pathlib import Path
+
+import cv2
+import numpy as np
+import supervision as spv
+
+BACKENDS = ['torch', 'onnx', 'openvino']
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def letterbox(img, out, color=114):
+    """
+    Resize an image keeping its aspect ratio and pad it to a square, like Ultralytics does
+    The image is resized straight into the output buffer, so there are no intermediate copies
+    :param img: BGR image
+    :param out: output buffer (imgsz, imgsz, 3), uint8
+    :param color: padding value
+    :return: resize ratio, (left, top) padding
+    """
+    imgsz = out.shape[0]
+    h, w = img.shape[:2]
+    ratio = min(imgsz / h, imgsz / w)
+    new_w, new_h = int(round(w * ratio)), int(round(h * ratio))
+    left, top = (imgsz - new_w) // 2, (imgsz - new_h) // 2
+    out[:top] = color
+    out[top + new_h:] = color
+    out[top:top + new_h, :left] = color
+    out[top:top + new_h, left + new_w:] = color
+    roi = out[top:top + new_h, left:left + new_w]
+    if (new_w, new_h) != (w, h):
+        cv2.resize(img, (new_w, new_h), dst=roi, interpolation=cv2.INTER_LINEAR)
+    else:
+        roi[:] = img
+    return ratio, (left, top)
+
+
+class Preprocessor:
+    """
+    Letterboxes batches of images into preallocated buffers (they only grow when a bigger batch arrives)
+    The returned blob is overwritten by the next call, so each thread needs its own Preprocessor
+    """
+
+    def __init__(self, imgsz=640):
+        self.imgsz = imgsz
+        self.canvas = np.empty((0, imgsz, imgsz, 3), dtype=np.uint8)
+        self.blob = np.empty((0, 3, imgsz, imgsz), dtype=np.float32)
+
+    def __call__(self, images):
+        """
+        :param images: list of BGR images
+        :return: NCHW float32 RGB blob in [0, 1], list of ratios, list of (left, top) paddings
+        """
+        n = len(images)
+        if n > len(self.canvas):
+            self.canvas = np.empty((n, self.imgsz, self.imgsz, 3), dtype=np.uint8)
+            self.blob = np.empty((n, 3, self.imgsz, self.imgsz), dtype=np.float32)
+
+        ratios, pads = [], []
+        for img, out in zip(images, self.canvas):
+            ratio, pad = letterbox(img, out)
+            ratios.append(ratio)
+            pads.append(pad)
+        # BGR to RGB, HWC to CHW and uint8 to [0, 1] floats in a single pass
+        np.multiply(self.canvas[:n, :, :, ::-1].transpose(0, 3, 1, 2), np.float32(1 / 255), out=self.blob[:n])
+        return self.blob[:n], ratios, pads
+
+
+def preprocess(images, imgsz=640):
+    """
+    Same as Preprocessor, but returning a new blob
+    :param images: list of BGR images
+    :param imgsz: network input size
+    :return: NCHW float32 RGB blob in [0, 1], list of ratios, list of (left, top) paddings
+    """
+    return Preprocessor(imgsz)(images)
+
+
+def unletterbox(xyxy, ratio, pad, img_shape):
+    """
+    Map boxes from the letterboxed image back to the original image
+    :param xyxy: array of boxes (x1, y1, x2, y2) in the network input
+    :param ratio: resize ratio used by letterbox
+    :param pad: (left, top) padding used by letterbox
+    :param img_shape: shape of the original image
+    :return: float32 array of boxes in the original image, clipped to its size
+    """
+    xyxy = (np.asarray(xyxy, dtype=np.float32) - np.array(pad * 2, dtype=np.float32)) / ratio
+    xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clip(0, img_shape[1])
+    xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clip(0, img_shape[0])
+    return xyxy
+
+
+def decode_predictions(pred, names, ratio, pad, img_shape, conf=0.25, iou=0.7, max_det=300):
+    """
+    Turn the raw output of an exported YOLOv8 model for one image into detections (class-agnostic NMS)
+    :param pred: array (4 + number of classes, number of anchors) with the boxes (x_c, y_c, w, h) and class scores
+    :param names: dictionary with the class names {class_id: class_name, ...}
+    :param ratio: resize ratio used by letterbox
+    :param pad: (left, top) padding used by letterbox
+    :param img_shape: shape of the original image
+    :param conf: confidence threshold
+    :param iou: IoU threshold of the NMS
+    :param max_det: maximum number of detections
+    :return: supervision.Detections in the coordinates of the original image
+    """
+    pred = pred.T
+    scores = pred[:, 4:]
+    class_id = scores.argmax(axis=1)
+    confidence = scores[np.arange(len(scores)), class_id]
+    keep = confidence > conf
+    boxes, class_id, confidence = pred[keep, :4], class_id[keep], confidence[keep]
+
+    xywh = boxes.copy()
+    xywh[:, :2] -= xywh[:, 2:] / 2  # top-left corner, as cv2.dnn.NMSBoxes expects
+    idx = cv2.dnn.NMSBoxes(xywh.tolist(), confidence.tolist(), conf, iou, top_k=max_det)
+    idx = np.asarray(idx, dtype=np.int64).reshape(-1)[:max_det]
+
+    xyxy = np.concatenate([xywh[idx, :2], xywh[idx, :2] + xywh[idx, 2:]], axis=1)
+    class_id = class_id[idx].astype(int)
+    return spv.Detections(xyxy=unletterbox(xyxy, ratio, pad, img_shape),
+                          confidence=confidence[idx].astype(np.float32),
+                          class_id=class_id,
+                          data={'class_name': np.array([names[c] for c in class_id])})
+
+
+def list_images(path, limit=None, seed=0):
+    """
+    :param path: folder with images, or a text file with one image path per line (e.g. split/images/val/images.txt)
+    :param limit: maximum number of images (a random sample is taken if there are more)
+    :param seed: seed of the sample
+    :return: list of image paths
+    """
+    path = Path(path)
+    if path.is_dir():
+        files = sorted(str(f) for f in path.iterdir() if f.suffix.lower() in IMAGE_EXTENSIONS)
+    else:
+        with open(path) as f:
+            files = [l.strip() for l in f if l.strip()]
+    if limit is not None and len(files) > limit:
+        idx = np.random.default_rng(seed).choice(len(files), limit, replace=False)
+        files = [files[i] for i in sorted(idx)]
+    return files
+
+
+def export_onnx(path_model, imgsz=640):
+    """
+    Export a YOLO model to ONNX, unless it was already exported after the last change of the .pt file
+    :param path_model: path to the .pt model
+    :param imgsz: network input size
+    :return: path to the .onnx model
+    """
+    path_model = Path(path_model)
+    path_onnx = path_model.with_suffix('.onnx')
+    if path_onnx.is_file() and path_onnx.stat().st_mtime >= path_model.stat().st_mtime:
+        return path_onnx
+
+    from ultralytics import YOLO
+    print("Exporting {} to ONNX".format(path_model))
+    return Path(YOLO(path_model).export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True))
+
+
+def _onnx_metadata(path_onnx):
+    """
+    :param path_onnx: path to an ONNX model exported by Ultralytics
+    :return: dictionary with the metadata (class names, image size, ...)
+    """
+    import onnx
+    model = onnx.load(str(path_onnx), load_external_data=False)
+    return {p.key: p.value for p in model.metadata_props}
+
+
+def quantize_onnx(path_onnx, calib_data, imgsz=640, n_images=200):
+    """
+    Quantize an ONNX model to INT8 (static quantization, QDQ format), unless it was already quantized
+    The box decoding at the end of the network is kept in float, because quantizing it ruins the box coordinates
+    :param path_onnx: path to the float model
+    :param calib_data: calibration images (folder or text file with one image path per line)
+    :param imgsz: network input size
+    :param n_images: number of calibration images
+    :return: path to the INT8 model
+    """
+    import onnx
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType, quantize_static,
+                                          quant_pre_process)
+
+    path_onnx = Path(path_onnx)
+    path_int8 = path_onnx.with_name(path_onnx.stem + "_int8.onnx")
+    if path_int8.is_file() and path_int8.stat().st_mtime >= path_onnx.stat().st_mtime:
+        return path_int8
+    if calib_data is None:
+        raise ValueError("INT8 quantization needs calibration images (calib_data)")
+
+    files = list_images(calib_data, limit=n_images)
+    print("Quantizing {} to INT8 with {} calibration images".format(path_onnx, len(files)))
+    model = onnx.load(str(path_onnx))
+    input_name = model.graph.input[0].name
+
+    # Ultralytics names the nodes after their module (/model.22/...): the last one is the detection head
+    modules = [n.name.split('/')[1].split('.')[1] for n in model.graph.node if n.name.startswith('/model.')]
+    modules = [int(m) for m in modules if m.isdigit()]
+    head = "/model.{}/".format(max(modules)) if modules else None
+    exclude = [n.name for n in model.graph.node if head and n.name.startswith(head) and n.op_type != 'Conv']
+
+    class ImageReader(CalibrationDataReader):
+        def __init__(self):
+            self.files = iter(files)
+
+        def get_next(self):
+            for f in self.files:
+                img = cv2.imread(f, cv2.IMREAD_COLOR)
+                if img is not None:
+                    return {input_name: preprocess([img], imgsz)[0]}
+            return None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path_pre = os.path.join(tmp, "preprocessed.onnx")
+        quant_pre_process(str(path_onnx), path_pre)
+        quantize_static(path_pre, str(path_int8), ImageReader(), quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, nodes_to_exclude=exclude)
+
+    # Keeping the class names and the rest of the Ultralytics metadata
+    quantized = onnx.load(str(path_int8))
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(model.metadata_props)
+    onnx.save(quantized, str(path_int8))
+    return path_int8
+
+
+class Backend:
+    """
+    Common steps of all the backends: letterbox the images, run the network and map the boxes back
+    """
+
+    dynamic = True  # False if the network only accepts its export size (imgsz)
+
+    def predict(self, images):
+        """
+        :param images: list of BGR images
+        :return: list of supervision.Detections (in the coordinates of each image)
+        """
+        blob, ratios, pads = self.preprocess(images)
+        return self.postprocess(self.forward(blob), images, ratios, pads)
+
+
+class TorchBackend(Backend):
+    """
+    The Ultralytics (PyTorch) model
+    It gets the letterboxed tensor, so Ultralytics does not resize the images again
+    """
+
+    def __init__(self, path_model, imgsz=640, conf=0.25, iou=0.7, threads=None):
+        import torch
+        from ultralytics import YOLO
+        if threads is not None:
+            torch.set_num_threads(threads)
+        self.torch = torch
+        self.model = YOLO(path_model)
+        self.names = self.model.model.names
+        self.imgsz = imgsz
+        self.conf, self.iou = conf, iou
+        self.preprocess = Preprocessor(imgsz)
+
+    def forward(self, blob):
+        """
+        :param blob: NCHW float32 blob (see Preprocessor)
+        :return: list of Ultralytics results (in the letterboxed coordinates, after the NMS)
+        """
+        return self.model(self.torch.from_numpy(blob), agnostic_nms=True, conf=self.conf, iou=self.iou,
+                          verbose=False)
+
+    def postprocess(self, results, images, ratios, pads):
+        detections = []
+        for result, img, ratio, pad in zip(results, images, ratios, pads):
+            det = spv.Detections.from_ultralytics(result)
+            det.xyxy = unletterbox(det.xyxy, ratio, pad, img.shape)
+            detections.append(det)
+        return detections
+
+
+class OnnxBackend(Backend):
+    """
+    An exported model run with ONNX Runtime on the CPU
+    """
+
+    def __init__(self, path_onnx, imgsz=640, conf=0.25, iou=0.7, threads=None):
+        """
+        :param path_onnx: path to the .onnx model
+        :param imgsz: network input size (it must match the exported model if it does not have dynamic axes)
+        :param conf: confidence threshold
+        :param iou: IoU threshold of the NMS
+        :param threads: number of threads of each inference call (None: one per physical core)
+        """
+        metadata = _onnx_metadata(path_onnx)
+        self.names = ast.literal_eval(metadata['names']) if 'names' in metadata else {}
+        self.imgsz = imgsz
+        self.conf, self.iou = conf, iou
+        self.threads = threads or _physical_cores()
+        self.preprocess = Preprocessor(imgsz)
+        self._load(path_onnx)
+
+    def _load(self, path_onnx):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = self.threads
+        options.inter_op_num_threads = 1  # YOLO is a chain of layers, there is nothing to run in parallel
+        self.session = ort.InferenceSession(str(path_onnx), options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.dynamic = not all(isinstance(d, int) for d in self.session.get_inputs()[0].shape[2:])
+
+    def forward(self, blob):
+        """
+        :param blob: NCHW float32 blob (see Preprocessor)
+        :return: raw network output (batch, 4 + number of classes, number of anchors)
+        """
+        return self.session.run(None, {self.input_name: blob})[0]
+
+    def postprocess(self, preds, images, ratios, pads):
+        return [decode_predictions(pred, self.names, ratio, pad, img.shape, self.conf, self.iou)
+                for pred, ratio, pad, img in zip(preds, ratios, pads, images)]
+
+
+class OpenVinoBackend(OnnxBackend):
+    """
+    An exported model compiled with OpenVINO for the CPU (it reads the same ONNX files)
+    """
+
+    def _load(self, path_onnx):
+        import openvino as ov
+        core = ov.Core()
+        config = {"PERFORMANCE_HINT": "LATENCY", "INFERENCE_NUM_THREADS": str(self.threads)}
+        self.compiled = core.compile_model(core.read_model(str(path_onnx)), "CPU", config)
+        self.output = self.compiled.output(0)
+        self.dynamic = self.compiled.input(0).get_partial_shape().is_dynamic
+
+    def forward(self, blob):
+        return self.compiled([blob])[self.output]
+
+
+def _physical_cores():
+    """ Hyper-threads do not speed up the inference, so only the physical cores are used """
+    try:
+        import psutil
+        return psutil.cpu_count(logical=False) or os.cpu_count() or 1
+    except ImportError:
+        return os.cpu_count() or 1
+
+
+def load_backend(path_model, backend='torch', imgsz=640, int8=False, calib_data=None, calib_images=200,
+                 threads=None, conf=0.25, iou=0.7):
+    """
+    Load a model with the given backend, exporting and quantizing it first if needed
+    :param path_model: path to the .pt model (or to an already exported .onnx model)
+    :param backend: 'torch', 'onnx' or 'openvino'
+    :param imgsz: network input size
+    :param int8: use the INT8 quantized model (onnx and openvino backends)
+    :param calib_data: calibration images for the quantization (folder or text file with image paths)
+    :param calib_images: number of calibration images
+    :param threads: number of inference threads (None: the default of each backend)
+    :param conf: confidence threshold
+    :param iou: IoU threshold of the NMS
+    :return: backend object, with the class names (.names) and a predict(images) method
+    """
+    path_model = Path(path_model)
+    if backend == 'torch':
+        return TorchBackend(path_model, imgsz=imgsz, conf=conf, iou=iou, threads=threads)
+    if not path_model.is_file():
+        raise FileNotFoundError("Model not found: {}".format(path_model))
+
+    path_onnx = path_model if path_model.suffix == '.onnx' else export_onnx(path_model, imgsz)
+    if int8:
+        path_onnx = quantize_onnx(path_onnx, calib_data, imgsz, calib_images)
+    backend_class = OpenVinoBackend if backend == 'openvino' else OnnxBackend
+    return backend_class(path_onnx, imgsz=imgsz, conf=conf, iou=iou, threads=threads)
+
+
+def add_backend_args(parser):
+    """
+    Add the backend options to a script's argument parser (see load_backend)
+    :param parser: argparse.ArgumentParser
+    :return: None
+    """
+    parser.add_argument('--backend', type=str, default='torch', choices=BACKENDS,
+                        help="Inference backend (onnx and openvino export the model to ONNX the first time)")
+    parser.add_argument('--imgsz', type=int, default=640, help="Network input size")
+    parser.add_argument('--int8', action='store_true', help="Use the INT8 quantized model (onnx and openvino)")
+    parser.add_argument('--calib_data', type=str,
+                        help="Images used to calibrate the INT8 model: a folder or a list of images like "
+                             "Face-Parts-Dataset/split/images/val/images.txt")
+    parser.add_argument('--calib_images', type=int, default=200, help="Number of calibration images")
+    parser.add_argument('--threads', type=int, help="Inference threads (default: number of physical cores)")
+
+
+def backend_from_args(args):
+    """
+    :param args: parsed arguments of a script that called add_backend_args (and has a path_model argument)
+    :return: backend object (see load_backend)
+    """
+    return load_backend(args.path_model, backend=args.backend, imgsz=args.imgsz, int8=args.int8,
+                        calib_data=args.calib_data, calib_images=args.calib_images, threads=args.threads)
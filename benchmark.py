@@ -0,0 +1,278 @@
+"""
+This script measures the speed of the inference pipeline (the same steps as run.py) on a synthetic image set
+
+Each stage is timed on its own, for every image resolution, batch size and number of threads:
+    decode (utils.decode_image), preprocess (letterbox), forward, nms, detections (Detections.from_ultralytics)
+    and report (ReportWriter)
+There is no separate smart_resize stage: like run.py, the pipeline never calls it. Large JPEGs are downscaled by
+the decoder itself (IMREAD_REDUCED_*, timed as decode) and the resize to the network input is part of the
+letterbox (timed as preprocess), so a smart_resize stage would time work that run.py does not do.
+The results (p50/p95/p99 latency of each stage per batch, and images/sec) are saved to a JSON file,
+which can be compared with a previous run to catch regressions:
+    python benchmark.py -m best.pt -o runs/benchmark/new.json --compare runs/benchmark/baseline.json
+"""
+
+import argparse
+import json
+import platform
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from utils import decode_image
+from backends import TorchBackend, add_backend_args, load_backend
+from reports import ReportWriter
+
+CORPUS_VERSION = 1
+STAGES = ['decode', 'preprocess', 'forward', 'nms', 'detections', 'report']
+
+
+def synthetic_image(rng, width, height):
+    """
+    Draw an image with a noisy gradient background and a few face-like shapes
+    :param rng: numpy random Generator
+    :param width: image width
+    :param height: image height
+    :return: BGR image
+    """
+    gradient = np.linspace(0, 1, width, dtype=np.float32)[None, :, None] * rng.uniform(0, 255, 3)
+    img = (gradient + rng.normal(0, 12, (height, width, 3))).clip(0, 255).astype(np.uint8)
+    for _ in range(rng.integers(1, 4)):
+        cx, cy = int(rng.uniform(0.2, 0.8) * width), int(rng.uniform(0.2, 0.8) * height)
+        size = int(rng.uniform(0.08, 0.25) * min(width, height))
+        skin = tuple(int(c) for c in rng.uniform(90, 230, 3))
+        cv2.ellipse(img, (cx, cy), (size, int(size * 1.3)), 0, 0, 360, skin, -1)
+        for dx in (-1, 1):
+            cv2.circle(img, (cx + dx * size // 3, cy - size // 3), max(2, size // 8), (50, 40, 30), -1)
+        cv2.ellipse(img, (cx, cy + size // 2), (size // 3, max(2, size // 10)), 0, 0, 360, (60, 60, 170), -1)
+    return img
+
+
+def build_corpus(path_corpus, resolutions, n_images, seed=0):
+    """
+    Create the synthetic image set, or reuse it if it was created with the same settings
+    :param path_corpus: output folder
+    :param resolutions: list of (width, height)
+    :param n_images: number of images of each resolution
+    :param seed: random seed (the same seed always gives the same images)
+    :return: dictionary {"WxH": [image paths, ...], ...}
+    """
+    path_corpus = Path(path_corpus)
+    path_info = path_corpus / "corpus.json"
+    info = {'version': CORPUS_VERSION, 'seed': seed, 'n_images': n_images,
+            'resolutions': ["{}x{}".format(w, h) for w, h in resolutions]}
+    corpus = {res: [str(path_corpus / res / "{:05d}.jpg".format(i)) for i in range(n_images)]
+              for res in info['resolutions']}
+    if path_info.is_file():
+        with open(path_info) as f:
+            if json.load(f) == info and all(Path(p).is_file() for files in corpus.values() for p in files):
+                return corpus
+
+    print("Building the synthetic corpus in {}".format(path_corpus))
+    for (w, h), res in zip(resolutions, info['resolutions']):
+        (path_corpus / res).mkdir(parents=True, exist_ok=True)
+        for i, path in enumerate(corpus[res]):
+            rng = np.random.default_rng([seed, w, h, i])
+            cv2.imwrite(path, synthetic_image(rng, w, h), [cv2.IMWRITE_JPEG_QUALITY, 90])
+    with open(path_info, 'w') as f:
+        json.dump(info, f, indent=2)
+    return corpus
+
+
+def timed_predict(model, imgs, times):
+    """
+    Run the model on a batch, timing the preprocess, forward, nms and detections stages separately
+    :param model: backend (see backends.py)
+    :param imgs: list of BGR images
+    :param times: dictionary {stage: seconds} where the durations are added
+    :return: list of supervision.Detections
+    """
+    start = time.perf_counter()
+    blob, ratios, pads = model.preprocess(imgs)
+    t_pre = time.perf_counter()
+    output = model.forward(blob)
+    t_fwd = time.perf_counter()
+    detections = model.postprocess(output, imgs, ratios, pads)
+    t_post = time.perf_counter()
+
+    times['preprocess'] += t_pre - start
+    if isinstance(model, TorchBackend):
+        # Ultralytics runs the NMS inside the forward call, but it times it (ms per image)
+        nms = output[0].speed['postprocess'] * len(imgs) / 1000 if output else 0
+        times['forward'] += t_fwd - t_pre - nms
+        times['nms'] += nms
+        times['detections'] += t_post - t_fwd
+    else:
+        times['forward'] += t_fwd - t_pre
+        times['nms'] += t_post - t_fwd  # decode_predictions also builds the Detections
+    return detections
+
+
+def percentiles(times):
+    """
+    :param times: list of durations (seconds)
+    :return: dictionary with the mean, p50, p95 and p99 (ms)
+    """
+    t = np.array(times) * 1000
+    return {'mean': float(t.mean()), 'p50': float(np.percentile(t, 50)),
+            'p95': float(np.percentile(t, 95)), 'p99': float(np.percentile(t, 99))}
+
+
+def run_case(model, files, batch_size, repeats=3, warmup=2):
+    """
+    Time every stage of the pipeline on a list of images
+    :param model: backend (see backends.py)
+    :param files: list of image paths
+    :param batch_size: number of images per inference call
+    :param repeats: number of passes over the images
+    :param warmup: number of batches run before timing
+    :return: dictionary with the latency percentiles of each stage (ms per batch) and the throughput
+    """
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+    for batch in batches[:warmup]:
+        model.predict([cv2.imread(f) for f in batch])
+
+    stage_times = {stage: [] for stage in STAGES + ['total']}
+    n_images = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        report = ReportWriter(Path(tmp) / "report.csv", model.names)
+        for _ in range(repeats):
+            for batch in batches:
+                times = dict.fromkeys(STAGES, 0.0)
+                start = time.perf_counter()
+                imgs, scales = zip(*[decode_image(f, min_size=model.imgsz) for f in batch])
+                times['decode'] = time.perf_counter() - start
+
+                detections = timed_predict(model, imgs, times)
+
+                start = time.perf_counter()
+                for f, det, scale in zip(batch, detections, scales):
+                    det.xyxy = det.xyxy * np.array(scale * 2, dtype=np.float32)
+                    report.add(Path(f).name, det)
+                times['report'] = time.perf_counter() - start
+
+                for stage, t in times.items():
+                    stage_times[stage].append(t)
+                stage_times['total'].append(sum(times.values()))
+                n_images += len(batch)
+        start = time.perf_counter()
+        report.close()
+        stage_times['report'][-1] += time.perf_counter() - start
+
+    return {'stages': {stage: percentiles(t) for stage, t in stage_times.items() if any(t)},
+            'images': n_images,
+            'images_per_sec': n_images / sum(stage_times['total'])}
+
+
+def compare(baseline, current, tolerance=0.1, min_diff_ms=0.5):
+    """
+    Compare two benchmark results
+    A regression is a p50/p95 latency that is slower (or a throughput that is lower) by more than the tolerance
+    :param baseline: results of the reference run
+    :param current: results of the new run
+    :param tolerance: allowed relative change
+    :param min_diff_ms: latency changes smaller than this are ignored (too small to be measured reliably)
+    :return: list of regression messages (empty if there are none)
+    """
+    key = lambda case: (case['resolution'], case['batch_size'], case['threads'])
+    old_cases = {key(case): case for case in baseline['results']}
+    regressions = []
+    for case in current['results']:
+        old = old_cases.get(key(case))
+        if old is None:
+            continue
+        name = "{} batch {} threads {}".format(*key(case))
+        if case['images_per_sec'] < old['images_per_sec'] * (1 - tolerance):
+            regressions.append("{}: {:.1f} images/sec (was {:.1f})".format(
+                name, case['images_per_sec'], old['images_per_sec']))
+        for stage, stats in case['stages'].items():
+            if stage not in old['stages']:
+                continue
+            for p in ['p50', 'p95']:
+                new_ms, old_ms = stats[p], old['stages'][stage][p]
+                if new_ms > old_ms * (1 + tolerance) and new_ms - old_ms > min_diff_ms:
+                    regressions.append("{}: {} {} {:.2f} ms (was {:.2f} ms)".format(name, stage, p, new_ms, old_ms))
+    return regressions
+
+
+def print_results(results):
+    for case in results['results']:
+        print("\n{} | batch {} | threads {} | {:.1f} images/sec".format(
+            case['resolution'], case['batch_size'], case['threads'], case['images_per_sec']))
+        for stage, stats in case['stages'].items():
+            print("{:>12}: p50 {:8.2f} ms | p95 {:8.2f} ms | p99 {:8.2f} ms".format(
+                stage, stats['p50'], stats['p95'], stats['p99']))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", '--path_model', type=str, help="Path to the model")
+    parser.add_argument("-o", '--path_output', type=str, default="runs/benchmark/results.json",
+                        help="The results (JSON) will be saved here")
+    parser.add_argument('--corpus', type=str, default="runs/benchmark/corpus", help="Folder of the synthetic images")
+    parser.add_argument('--resolutions', type=str, nargs='+', default=['640x480', '1280x720', '1920x1080'],
+                        help="Resolutions of the synthetic images (WxH)")
+    parser.add_argument('--n_images', type=int, default=32, help="Number of images of each resolution")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic images")
+    parser.add_argument("-b", '--batch_sizes', type=int, nargs='+', default=[1, 8], help="Batch sizes to test")
+    parser.add_argument('--thread_counts', type=int, nargs='+', default=[None],
+                        help="Numbers of inference threads to test (default: the backend's default)")
+    parser.add_argument('--repeats', type=int, default=3, help="Number of passes over the images")
+    parser.add_argument('--warmup', type=int, default=2, help="Number of batches run before timing")
+    parser.add_argument('--compare', type=str, help="Baseline results (JSON): exit with an error on regressions")
+    parser.add_argument('--results', type=str,
+                        help="Compare these results with the baseline instead of running the benchmark")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Allowed relative slowdown when comparing")
+    parser.add_argument('--min_diff_ms', type=float, default=0.5,
+                        help="Latency changes smaller than this are not regressions")
+    add_backend_args(parser)
+    args = parser.parse_args()
+
+    if args.results is not None:
+        with open(args.results) as f:
+            results = json.load(f)
+    elif args.path_model is None:
+        print("ERROR: No model (path_model) or results file (results) provided")
+        exit(1)
+    else:
+        resolutions = [tuple(int(v) for v in res.lower().split("x")) for res in args.resolutions]
+        corpus = build_corpus(args.corpus, resolutions, args.n_images, seed=args.seed)
+
+        results = {'config': {'model': args.path_model, 'backend': args.backend, 'int8': args.int8,
+                              'imgsz': args.imgsz, 'n_images': args.n_images, 'seed': args.seed,
+                              'repeats': args.repeats},
+                   'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                               'python': platform.python_version(), 'opencv': cv2.__version__},
+                   'results': []}
+        for threads in args.thread_counts:
+            model = load_backend(args.path_model, backend=args.backend, imgsz=args.imgsz, int8=args.int8,
+                                 calib_data=args.calib_data, calib_images=args.calib_images, threads=threads)
+            for res, files in corpus.items():
+                for batch_size in args.batch_sizes:
+                    case = run_case(model, files, batch_size, repeats=args.repeats, warmup=args.warmup)
+                    case.update(resolution=res, batch_size=batch_size, threads=threads)
+                    results['results'].append(case)
+                    print("{} | batch {} | threads {}: {:.1f} images/sec".format(
+                        res, batch_size, threads, case['images_per_sec']))
+
+        path_output = Path(args.path_output)
+        path_output.parent.mkdir(parents=True, exist_ok=True)
+        with open(path_output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print_results(results)
+        print("\nResults saved to ", str(path_output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, tolerance=args.tolerance, min_diff_ms=args.min_diff_ms)
+        if regressions:
+            print("\n{} regressions compared to {}:".format(len(regressions), args.compare))
+            for r in regressions:
+                print("    " + r)
+            exit(1)
+        print("\nNo regressions compared to {}".format(args.compare))
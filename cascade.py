@@ -0,0 +1,152 @@
+"""
+Two-stage face-region cascade (used by run.py and live_demo.py with --cascade)
+When the faces only take a small part of each frame, most of the work of the face parts model is spent on background.
+The cascade runs the same model on a small version of the frame first, with a low confidence threshold.
+Its (weak) face part detections are grouped into face regions, and only those regions are run at their native
+resolution, in a single batch. The boxes are then mapped back to the frame coordinates.
+"""
+
+import numpy as np
+
+from backends import Preprocessor
+from metrics import metrics
+from tiling import merge_detections
+
+
+def group_regions(xyxy, img_shape, margin=0.5, min_size=64):
+    """
+    Group boxes that are close to each other (the parts of the same face) into regions
+    :param xyxy: array of boxes, shape (N, 4)
+    :param img_shape: shape of the image
+    :param margin: the boxes are enlarged by this fraction of their size before grouping them,
+                   and the regions by the same fraction of theirs
+    :param min_size: minimum side of a region (pixels)
+    :return: int array of regions (x1, y1, x2, y2), shape (M, 4)
+    """
+    if len(xyxy) == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+
+    size = xyxy[:, 2:] - xyxy[:, :2]
+    grown = np.concatenate([xyxy[:, :2] - margin * size, xyxy[:, 2:] + margin * size], axis=1)
+    touch = ((grown[:, None, 0] < grown[None, :, 2]) & (grown[:, None, 2] > grown[None, :, 0]) &
+             (grown[:, None, 1] < grown[None, :, 3]) & (grown[:, None, 3] > grown[None, :, 1]))
+    np.fill_diagonal(touch, True)  # a zero-area box does not overlap itself, but it is in its own component
+
+    # Connected components: every box takes the smallest label of its neighbours until nothing changes
+    labels = np.arange(len(xyxy))
+    while True:
+        new_labels = np.where(touch, labels[None, :], len(xyxy)).min(axis=1)
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    regions = []
+    for label in np.unique(labels):
+        members = xyxy[labels == label]
+        x1, y1 = members[:, :2].min(axis=0)
+        x2, y2 = members[:, 2:].max(axis=0)
+        center = np.array([x1 + x2, y1 + y2]) / 2
+        half = np.maximum(np.array([x2 - x1, y2 - y1]) * (1 + 2 * margin), min_size) / 2
+        regions.append(np.concatenate([center - half, center + half]))
+
+    regions = np.round(np.array(regions)).astype(np.int64)
+    regions[:, [0, 2]] = regions[:, [0, 2]].clip(0, img_shape[1])
+    regions[:, [1, 3]] = regions[:, [1, 3]].clip(0, img_shape[0])
+    return regions
+
+
+class CascadePredictor:
+    """
+    Finds the face regions with a low resolution pass and runs the face parts model only inside them
+    It has the same predict(images) interface as the backends (see backends.py)
+    """
+
+    def __init__(self, backend, coarse_size=320, coarse_conf=0.05, margin=0.5, stride=32):
+        """
+        :param backend: backend object (see backends.load_backend)
+        :param coarse_size: network input size of the first pass
+        :param coarse_conf: confidence threshold of the first pass (low, so that every face gives some detection)
+        :param margin: how much the detections and the regions are enlarged (fraction of their size)
+        :param stride: the input size of the second pass is a multiple of the model stride
+        """
+        if not backend.dynamic:
+            print("WARNING: the model was exported without dynamic axes, the cascade runs both passes at", backend.imgsz)
+            coarse_size = backend.imgsz
+        self.backend = backend
+        self.names = backend.names
+        self.coarse_preprocess = Preprocessor(coarse_size)
+        self.coarse_conf = coarse_conf
+        self.margin = margin
+        self.stride = stride
+        self.preprocessors = {}  # one per input size of the second pass
+        self.n_regions = 0
+
+    def _coarse_pass(self, images):
+        conf = self.backend.conf
+        self.backend.conf = min(conf, self.coarse_conf)
+        try:
+            blob, ratios, pads = self.coarse_preprocess(images)
+            return self.backend.postprocess(self.backend.forward(blob), images, ratios, pads)
+        finally:
+            self.backend.conf = conf
+
+    def predict(self, images):
+        """
+        :param images: list of BGR images
+        :return: list of supervision.Detections (in the coordinates of each image)
+        """
+        with metrics.span("coarse"):
+            coarse = self._coarse_pass(images)
+
+        crops, owners, offsets = [], [], []
+        for i, (img, det) in enumerate(zip(images, coarse)):
+            for x1, y1, x2, y2 in group_regions(det.xyxy, img.shape, self.margin):
+                crops.append(img[y1:y2, x1:x2])
+                owners.append(i)
+                offsets.append((x1, y1, x1, y1))
+        self.n_regions += len(crops)
+
+        results = [[] for _ in images]
+        if crops:
+            # Native resolution: the crops are only shrunk if they are bigger than the usual network input
+            longest = max(max(crop.shape[:2]) for crop in crops)
+            size = min(self.backend.imgsz, int(np.ceil(longest / self.stride)) * self.stride)
+            if not self.backend.dynamic:
+                size = self.backend.imgsz
+            preprocess = self.preprocessors.setdefault(size, Preprocessor(size))
+            with metrics.span("regions"):
+                blob, ratios, pads = preprocess(crops)
+                detections = self.backend.postprocess(self.backend.forward(blob), crops, ratios, pads)
+            for owner, offset, det in zip(owners, offsets, detections):
+                det.xyxy = det.xyxy + np.array(offset, dtype=np.float32)
+                results[owner].append(det)
+
+        # Regions may overlap, so the same part can be found twice
+        return [merge_detections(dets, self.names, 'nms', self.backend.iou) for dets in results]
+
+
+def add_cascade_args(parser):
+    """
+    Add the cascade options to a script's argument parser (see CascadePredictor)
+    :param parser: argparse.ArgumentParser
+    :return: None
+    """
+    parser.add_argument('--cascade', action='store_true',
+                        help="Find the faces with a low resolution pass first and run the model only on them")
+    parser.add_argument('--cascade_size', type=int, default=320, help="Network input size of the first pass")
+    parser.add_argument('--cascade_conf', type=float, default=0.05, help="Confidence threshold of the first pass")
+    parser.add_argument('--cascade_margin', type=float, default=0.5,
+                        help="How much the face regions are enlarged (fraction of their size)")
+
+
+def cascade_from_args(backend, args):
+    """
+    :param backend: backend object (see backends.load_backend)
+    :param args: parsed arguments of a script that called add_cascade_args
+    :return: CascadePredictor if --cascade was given, the backend otherwise
+    """
+    if not args.cascade:
+        return backend
+    return CascadePredictor(backend, coarse_size=args.cascade_size, coarse_conf=args.cascade_conf,
+                            margin=args.cascade_margin)
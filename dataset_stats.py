@@ -0,0 +1,280 @@
+"""
+This script checks the YOLO labels of Face-Parts-Dataset (built by prepare_full_dataset.py) and prints statistics
+
+All the label files are read in a thread pool and parsed at once into a single array of boxes (with the offsets of
+the boxes of each file), so every check is a vectorized NumPy operation and 100k+ files take seconds:
+    - malformed files (lines without 5 numbers), empty files and label files that are not used by any split
+    - unknown class IDs, boxes outside the image, degenerate / tiny boxes and duplicated boxes
+    - images listed in the splits (images.txt) that do not exist or have no label file
+It also prints the number of boxes of each class for every source dataset (taken from manifest.json) and split,
+and the distribution of the box sizes of each class. Use --output to save everything to a JSON file.
+"""
+
+import argparse
+import json
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+SIZE_PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+SIZE_BINS = [0, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0]  # sqrt(w * h), relative to the image
+
+
+def img2label_path(path):
+    """
+    :param path: image path
+    :return: label path that Ultralytics uses for the image (/images/ -> /labels/, extension -> .txt)
+    """
+    sa, sb = os.sep + "images" + os.sep, os.sep + "labels" + os.sep
+    return sb.join(path.rsplit(sa, 1)).rsplit(".", 1)[0] + ".txt"
+
+
+def _read(paths):
+    contents = []
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                contents.append(f.read())
+        except OSError:
+            contents.append(None)
+    return contents
+
+
+def load_labels(label_files, workers=8):
+    """
+    Read and parse many YOLO label files at once
+    :param label_files: list of label file paths
+    :param workers: number of threads reading the files
+    :return: boxes (N, 5) float32 array (class, x, y, w, h) of all the files,
+             offsets (len(label_files) + 1,) so the boxes of file i are boxes[offsets[i]:offsets[i + 1]],
+             boolean array of the files that are missing or malformed (they have no boxes)
+    """
+    # The files are read in chunks: one task per file would cost more than reading these tiny files
+    chunks = [label_files[i:i + 1024] for i in range(0, len(label_files), 1024)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        contents = [c for chunk in pool.map(_read, chunks) for c in chunk]
+
+    # A file is well-formed if it has 5 numbers on every (non-empty) line
+    n_rows = np.zeros(len(contents), dtype=np.int64)
+    bad = np.zeros(len(contents), dtype=bool)
+    for i, c in enumerate(contents):
+        if c is None:
+            bad[i] = True
+            continue
+        n_tokens = [n for n in map(len, map(bytes.split, c.splitlines())) if n]
+        if any(n != 5 for n in n_tokens):
+            bad[i] = True  # e.g. a 4 and a 6 token line would shift the columns of the next boxes
+        n_rows[i] = len(n_tokens)
+
+    def parse(chunks, n):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)  # raised when a token is not a number
+            values = np.fromstring(b" ".join(chunks).decode('ascii', 'replace'), dtype=np.float32, sep=' ')
+        return values.reshape(-1, 5) if values.size == 5 * n else None
+
+    # All the good files are parsed in a single call, the slow path only runs if some of them have non-numbers
+    n_rows[bad] = 0
+    good = np.flatnonzero(~bad)
+    boxes = parse([contents[i] for i in good], n_rows.sum())
+    if boxes is None:
+        parsed = []
+        for i in good:
+            b = parse([contents[i]], n_rows[i])
+            if b is None:
+                bad[i], n_rows[i] = True, 0
+            else:
+                parsed.append(b)
+        boxes = np.concatenate(parsed) if parsed else np.zeros((0, 5), dtype=np.float32)
+
+    offsets = np.zeros(len(contents) + 1, dtype=np.int64)
+    np.cumsum(n_rows, out=offsets[1:])
+    return boxes, offsets, bad
+
+
+def box_anomalies(boxes, n_classes, min_size=0.002, tolerance=1e-3):
+    """
+    :param boxes: (N, 5) array (class, x, y, w, h) in normalized coordinates
+    :param n_classes: number of classes
+    :param min_size: boxes with a side smaller than this (relative to the image) are flagged as tiny
+    :param tolerance: how much a box may go out of the image (rounding of the label files)
+    :return: dictionary {anomaly: boolean mask of the boxes}
+    """
+    cls, xy, wh = boxes[:, 0], boxes[:, 1:3], boxes[:, 3:5]
+    x1y1, x2y2 = xy - wh / 2, xy + wh / 2
+    return {
+        'unknown_class': (cls != np.round(cls)) | (cls < 0) | (cls >= n_classes),
+        'out_of_image': ((x1y1 < -tolerance) | (x2y2 > 1 + tolerance)).any(axis=1),
+        'degenerate': (wh <= 0).any(axis=1) | ~np.isfinite(boxes).all(axis=1),
+        'tiny': ((wh > 0) & (wh < min_size)).any(axis=1),
+    }
+
+
+def duplicated_boxes(boxes, offsets):
+    """
+    :param boxes: (N, 5) array of boxes
+    :param offsets: offsets of the boxes of each file (see load_labels)
+    :return: boolean mask of the boxes that are an exact copy of an earlier box of the same file
+    """
+    file_idx = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    keys = np.column_stack([file_idx, boxes])
+    order = np.lexsort(keys.T[::-1])
+    same = np.zeros(len(boxes), dtype=bool)
+    same[order[1:]] = (keys[order[1:]] == keys[order[:-1]]).all(axis=1)
+    return same
+
+
+def size_distribution(boxes, names):
+    """
+    :param boxes: (N, 5) array of boxes
+    :param names: dictionary with the class names {class_id: class_name, ...}
+    :return: dictionary {class name: {percentiles of sqrt(w * h), histogram over SIZE_BINS, aspect ratio}}
+    """
+    sizes = np.sqrt(np.clip(boxes[:, 3] * boxes[:, 4], 0, None))
+    aspect = boxes[:, 3] / np.maximum(boxes[:, 4], 1e-9)
+    distribution = {}
+    for class_id, name in names.items():
+        mask = boxes[:, 0] == class_id
+        if not mask.any():
+            continue
+        distribution[name] = {
+            'percentiles': dict(zip(SIZE_PERCENTILES, np.percentile(sizes[mask], SIZE_PERCENTILES).round(4).tolist())),
+            'histogram': np.histogram(sizes[mask], bins=SIZE_BINS)[0].tolist(),
+            'median_aspect_ratio': round(float(np.median(aspect[mask])), 3),
+        }
+    return distribution
+
+
+def class_counts(boxes, offsets, groups, names):
+    """
+    :param boxes: (N, 5) array of boxes
+    :param offsets: offsets of the boxes of each file (see load_labels)
+    :param groups: group name of each file (e.g. its source dataset)
+    :param names: dictionary with the class names {class_id: class_name, ...}
+    :return: dictionary {group: {'files': n, class name: n boxes, ...}}
+    """
+    group_names, group_idx = np.unique(np.asarray(groups, dtype=str), return_inverse=True)
+    box_group = np.repeat(group_idx, np.diff(offsets))
+    cls = boxes[:, 0].astype(np.int64)
+    known = (cls >= 0) & (cls < len(names))
+    counts = np.bincount(box_group[known] * len(names) + cls[known],
+                         minlength=len(group_names) * len(names)).reshape(len(group_names), len(names))
+    files = np.bincount(group_idx, minlength=len(group_names))
+    return {g: dict({'files': int(files[i])}, **{names[c]: int(counts[i, c]) for c in range(len(names))})
+            for i, g in enumerate(group_names)}
+
+
+def source_datasets(path_manifest):
+    """
+    :param path_manifest: manifest.json written by prepare_full_dataset.py
+    :return: dictionary {label file: source dataset}
+    """
+    if not Path(path_manifest).is_file():
+        return {}
+    with open(path_manifest) as f:
+        entries = json.load(f)['entries']
+    return {p: entry['dataset'] for entry in entries.values() for p in entry['outputs'] if p.endswith(".txt")}
+
+
+def read_list(path):
+    """
+    :param path: text file with one path per line
+    :return: list of paths (empty if the file does not exist)
+    """
+    if not Path(path).is_file():
+        return []
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def print_table(title, rows, columns):
+    print("\n" + title)
+    print("{:>20}".format("") + "".join("{:>10}".format(c) for c in columns))
+    for name, row in rows.items():
+        print("{:>20}".format(name) + "".join("{:>10}".format(row.get(c, 0)) for c in columns))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", '--path_data', type=str, help="Path to the datasets folder")
+    parser.add_argument("-w", '--workers', type=int, default=8, help="Number of threads reading the label files")
+    parser.add_argument('--min_size', type=float, default=0.002,
+                        help="Boxes with a side smaller than this (fraction of the image) are flagged as tiny")
+    parser.add_argument('--max_listed', type=int, default=10, help="Number of examples printed for each problem")
+    parser.add_argument("-o", '--output', type=str, help="Save the statistics and all the problems to this JSON file")
+    args = parser.parse_args()
+
+    if args.path_data is not None:
+        path_datasets = Path(args.path_data)
+    else:
+        path_datasets = Path.home() / "Documents" / "Datasets"
+    path_face_parts = path_datasets / "Face-Parts-Dataset"
+    with open(path_face_parts / "split" / "data.yaml") as f:
+        names = {int(k): v for k, v in yaml.safe_load(f)['names'].items()}
+
+    # Every label file on disk, plus the ones the splits expect
+    path_labels = path_face_parts / "labels"
+    on_disk = sorted(e.path for e in os.scandir(path_labels) if e.name.endswith(".txt"))
+    splits = {}
+    for split in ['train', 'val', 'test']:
+        images = read_list(path_face_parts / "split" / "images" / split / "images.txt")
+        if images:
+            splits[split] = images
+    expected = {img2label_path(img): split for split, images in splits.items() for img in images}
+    label_files = on_disk + sorted(set(expected) - set(on_disk))
+
+    boxes, offsets, bad = load_labels(label_files, workers=args.workers)
+    n_boxes = np.diff(offsets)
+    sources = source_datasets(path_face_parts / "manifest.json")
+    datasets = [sources.get(p, "unknown") for p in label_files]
+    print("{} label files, {} boxes".format(len(label_files), len(boxes)))
+
+    # Problems of each box, reported with their file and line
+    box_file = np.repeat(np.arange(len(label_files)), n_boxes)
+    box_line = np.arange(len(boxes)) - offsets[box_file] + 1
+    masks = box_anomalies(boxes, len(names), min_size=args.min_size)
+    masks['duplicated'] = duplicated_boxes(boxes, offsets)
+    problems = {name: ["{}:{}".format(label_files[f], l) for f, l in zip(box_file[mask], box_line[mask])]
+                for name, mask in masks.items()}
+
+    # Problems of each file
+    exists = np.array([os.path.exists(p) for p in label_files])
+    problems['malformed_file'] = [p for p, b, e in zip(label_files, bad, exists) if b and e]
+    problems['empty_file'] = [p for p, n, b in zip(label_files, n_boxes, bad) if n == 0 and not b]
+    problems['not_in_any_split'] = [p for p in on_disk if p not in expected] if splits else []
+    problems['image_without_labels'] = [img for images in splits.values() for img in images
+                                        if not os.path.exists(img2label_path(img))]
+    problems['missing_image'] = [img for images in splits.values() for img in images if not os.path.exists(img)]
+
+    split_of = [expected.get(p, "none") for p in label_files]
+    stats = {'label_files': len(label_files),
+             'boxes': int(len(boxes)),
+             'datasets': class_counts(boxes, offsets, datasets, names),
+             'splits': class_counts(boxes, offsets, split_of, names),
+             'box_sizes': size_distribution(boxes, names),
+             'problem_counts': {k: len(v) for k, v in problems.items()}}
+
+    columns = ['files'] + list(names.values())
+    print_table("Boxes per source dataset", stats['datasets'], columns)
+    print_table("Boxes per split", stats['splits'], columns)
+    print("\nBox size sqrt(w * h) relative to the image (percentiles {})".format(SIZE_PERCENTILES))
+    for name, dist in stats['box_sizes'].items():
+        print("{:>20}: {}  (median w/h {})".format(name, " ".join("{:.3f}".format(v) for v in
+                                                                  dist['percentiles'].values()),
+                                                  dist['median_aspect_ratio']))
+
+    print("\nProblems")
+    for name, items in problems.items():
+        print("{:>20}: {}".format(name, len(items)))
+        for item in items[:args.max_listed]:
+            print("{:>20}  {}".format("", item))
+
+    if args.output is not None:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump({'stats': stats, 'problems': problems}, f, indent=2)
+        print("\nSaved to ", args.output)
@@ -0,0 +1,277 @@
+"""
+This script evaluates the report of run.py against YOLO labels, without running the model again
+
+The detections of all the images are matched with the ground truth boxes at once: the candidate pairs (same image
+and class) of every image are generated with NumPy, their IoUs computed in a single vectorized call, and the
+matching at each IoU threshold (0.50:0.95) follows Ultralytics' DetectionValidator, so the metrics can be
+compared with the ones of `yolo val`. It prints the precision, recall, F1, mAP50 and mAP50-95 of each class,
+the metrics at the given confidence thresholds, and saves the P, R, F1 and PR curves like images/F1_curve.png.
+Note that the report only has the detections above the confidence threshold of the model (0.25).
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+from backends import IMAGE_EXTENSIONS
+from dataset_stats import load_labels
+from reports import read_report
+from utils import image_size
+
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz  # renamed in NumPy 2
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+CONF_GRID = np.linspace(0, 1, 1000)
+
+
+def candidate_pairs(pred_keys, gt_keys):
+    """
+    All the (prediction, ground truth) pairs that share a key (image and class)
+    :param pred_keys: int array with the key of each prediction
+    :param gt_keys: int array with the key of each ground truth box, sorted
+    :return: prediction indices and ground truth indices of the pairs
+    """
+    start = np.searchsorted(gt_keys, pred_keys, side='left')
+    counts = np.searchsorted(gt_keys, pred_keys, side='right') - start
+    pair_pred = np.repeat(np.arange(len(pred_keys)), counts)
+    first = np.repeat(np.cumsum(counts) - counts, counts)  # position of the first pair of each prediction
+    pair_gt = np.repeat(start, counts) + np.arange(counts.sum()) - first
+    return pair_pred, pair_gt
+
+
+def pair_iou(a, b):
+    """
+    :param a: array of boxes (x1, y1, x2, y2), shape (N, 4)
+    :param b: array of boxes (x1, y1, x2, y2), shape (N, 4)
+    :return: IoU of a[i] and b[i], shape (N,)
+    """
+    inter = np.prod(np.clip(np.minimum(a[:, 2:], b[:, 2:]) - np.maximum(a[:, :2], b[:, :2]), 0, None), axis=1)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / np.maximum(area_a + area_b - inter, 1e-9)
+
+
+def match_predictions(pair_pred, pair_gt, iou, n_pred, iou_thresholds=IOU_THRESHOLDS):
+    """
+    Mark the true positives at each IoU threshold, like DetectionValidator.match_predictions in Ultralytics
+    (every prediction and every ground truth box is used at most once, the pairs with the highest IoU first)
+    :param pair_pred: prediction index of each candidate pair
+    :param pair_gt: ground truth index of each candidate pair
+    :param iou: IoU of each candidate pair
+    :param n_pred: number of predictions
+    :param iou_thresholds: IoU thresholds
+    :return: boolean array (n_pred, len(iou_thresholds))
+    """
+    tp = np.zeros((n_pred, len(iou_thresholds)), dtype=bool)
+    order = np.argsort(-iou, kind='stable')
+    pair_pred, pair_gt, iou = pair_pred[order], pair_gt[order], iou[order]
+    for j, threshold in enumerate(iou_thresholds):
+        keep = iou >= threshold
+        p, g = pair_pred[keep], pair_gt[keep]
+        first = np.unique(p, return_index=True)[1]
+        p, g = p[first], g[first]
+        first = np.unique(g, return_index=True)[1]
+        tp[p[first], j] = True
+    return tp
+
+
+def smooth(y, f=0.05):
+    """ Box filter of fraction f (the one Ultralytics uses to pick the best confidence threshold) """
+    nf = round(len(y) * f * 2) // 2 + 1
+    p = np.ones(nf // 2)
+    yp = np.concatenate((p * y[0], y, p * y[-1]), 0)
+    return np.convolve(yp, np.ones(nf) / nf, mode="valid")
+
+
+def compute_ap(recall, precision):
+    """
+    :param recall: recall curve
+    :param precision: precision curve
+    :return: average precision (COCO 101-point interpolation), precision envelope, recall with the end points
+    """
+    mrec = np.concatenate(([0.0], recall, [1.0]))
+    mpre = np.concatenate(([1.0], precision, [0.0]))
+    mpre = np.flip(np.maximum.accumulate(np.flip(mpre)))
+    x = np.linspace(0, 1, 101)
+    return trapezoid(np.interp(x, mrec, mpre), x), mpre, mrec
+
+
+def ap_per_class(tp, conf, pred_cls, target_cls, eps=1e-16):
+    """
+    Precision, recall and AP of each class, like ap_per_class in Ultralytics
+    :param tp: true positives (n_pred, n_iou_thresholds)
+    :param conf: confidence of each prediction
+    :param pred_cls: class of each prediction
+    :param target_cls: class of each ground truth box
+    :return: dictionary with the classes, their number of boxes, the P/R/F1 curves over CONF_GRID (n_classes, 1000),
+             the PR curves at IoU 0.5 and the AP (n_classes, n_iou_thresholds)
+    """
+    order = np.argsort(-conf, kind='stable')
+    tp, conf, pred_cls = tp[order], conf[order], pred_cls[order]
+    classes, n_targets = np.unique(target_cls, return_counts=True)
+
+    p_curve = np.zeros((len(classes), len(CONF_GRID)))
+    r_curve = np.zeros((len(classes), len(CONF_GRID)))
+    pr_curve = np.zeros((len(classes), len(CONF_GRID)))
+    ap = np.zeros((len(classes), tp.shape[1]))
+    for ci, c in enumerate(classes):
+        mask = pred_cls == c
+        if not mask.any():
+            continue
+        tpc = tp[mask].cumsum(0)
+        fpc = (~tp[mask]).cumsum(0)
+        recall = tpc / (n_targets[ci] + eps)
+        precision = tpc / (tpc + fpc)
+        r_curve[ci] = np.interp(-CONF_GRID, -conf[mask], recall[:, 0], left=0)
+        p_curve[ci] = np.interp(-CONF_GRID, -conf[mask], precision[:, 0], left=1)
+        for j in range(tp.shape[1]):
+            ap[ci, j], mpre, mrec = compute_ap(recall[:, j], precision[:, j])
+            if j == 0:
+                pr_curve[ci] = np.interp(CONF_GRID, mrec, mpre)
+
+    f1_curve = 2 * p_curve * r_curve / (p_curve + r_curve + eps)
+    return {'classes': classes, 'n_targets': n_targets, 'p': p_curve, 'r': r_curve, 'f1': f1_curve,
+            'pr': pr_curve, 'ap': ap}
+
+
+def plot_curve(curves, names, path, xlabel, ylabel, x=CONF_GRID, best_by_max=True):
+    """
+    Plot a curve per class and their mean, like Ultralytics' plot_mc_curve
+    :param curves: array (n_classes, len(x))
+    :param names: name of each class
+    :param path: output image
+    :param xlabel: label of the x axis
+    :param ylabel: label of the y axis
+    :param x: x values
+    :param best_by_max: show the maximum of the mean curve (and where it is) in the legend
+    :return: None
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(1, 1, figsize=(9, 6), tight_layout=True)
+    for curve, name in zip(curves, names):
+        ax.plot(x, smooth(curve) if best_by_max else curve, linewidth=1, label=name)
+    mean = curves.mean(0)
+    if best_by_max:
+        mean = smooth(mean)
+        label = "all classes {:.2f} at {:.3f}".format(mean.max(), x[mean.argmax()])
+    else:
+        label = "all classes"
+    ax.plot(x, mean, linewidth=3, color="blue", label=label)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1)
+    ax.legend(bbox_to_anchor=(1.04, 1), loc="upper left")
+    fig.savefig(path, dpi=250)
+    plt.close(fig)
+
+
+def load_ground_truth(path_labels, image_names, sizes):
+    """
+    :param path_labels: folder with the YOLO labels (one <image name>.txt per image)
+    :param image_names: list of image file names
+    :param sizes: array of image sizes (height, width), shape (N, 2)
+    :return: image index (M,), class (M,) and boxes (M, 4) in pixels of all the ground truth boxes
+    """
+    files = [os.path.join(path_labels, os.path.splitext(n)[0] + ".txt") for n in image_names]
+    boxes, offsets, _ = load_labels(files)
+    img_idx = np.repeat(np.arange(len(files)), np.diff(offsets))
+    h, w = sizes[img_idx, 0], sizes[img_idx, 1]
+    xc, yc, bw, bh = boxes[:, 1] * w, boxes[:, 2] * h, boxes[:, 3] * w, boxes[:, 4] * h
+    xyxy = np.stack([xc - bw / 2, yc - bh / 2, xc + bw / 2, yc + bh / 2], axis=1)
+    return img_idx, boxes[:, 0].astype(np.int64), xyxy
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", '--path_report', type=str, required=True,
+                        help="Report of run.py (report.csv, .parquet or .feather)")
+    parser.add_argument("-p", '--path_data', type=str, required=True, help="Folder with the images given to run.py")
+    parser.add_argument("-l", '--path_labels', type=str, required=True,
+                        help="Folder with the YOLO labels of the images (<image name>.txt)")
+    parser.add_argument('--data', type=str, help="data.yaml with the class names (default: the names in the report)")
+    parser.add_argument('--conf_thresholds', type=float, nargs='+', default=[0.25, 0.5],
+                        help="Also show the metrics at these confidence thresholds")
+    parser.add_argument("-o", '--path_output', type=str, default="runs/evaluation",
+                        help="The curves and the metrics (JSON) will be saved here")
+    parser.add_argument('--no_plots', action='store_true', help="Do not save the curves")
+    args = parser.parse_args()
+
+    # Every image of the folder is evaluated (images without detections are not in the report)
+    image_names = sorted(f for f in os.listdir(args.path_data) if f.lower().endswith(IMAGE_EXTENSIONS))
+    image_index = {name: i for i, name in enumerate(image_names)}
+    sizes = np.array([image_size(os.path.join(args.path_data, n)) or (0, 0) for n in image_names], dtype=np.float32)
+
+    report = read_report(args.path_report)
+    in_folder = report['image_name'].isin(image_index)
+    if not in_folder.all():
+        print("WARNING: {} detections of images that are not in {}".format((~in_folder).sum(), args.path_data))
+        report = report[in_folder]
+    pred_img = report['image_name'].map(image_index).to_numpy(np.int64)
+    pred_cls = report['class_id'].to_numpy(np.int64)
+    pred_conf = report['confidence'].to_numpy(np.float32)
+    pred_xyxy = report[['x1', 'y1', 'x2', 'y2']].to_numpy(np.float32)
+
+    gt_img, gt_cls, gt_xyxy = load_ground_truth(args.path_labels, image_names, sizes)
+
+    if args.data is not None:
+        with open(args.data) as f:
+            names = {int(k): v for k, v in yaml.safe_load(f)['names'].items()}
+    else:
+        names = dict(zip(report['class_id'].astype(int), report['detection']))
+    n_classes = int(max([*names, pred_cls.max(initial=-1), gt_cls.max(initial=-1)]) + 1)
+
+    # Candidate pairs: same image and same class
+    pred_keys = pred_img * n_classes + pred_cls
+    gt_order = np.argsort(gt_img * n_classes + gt_cls, kind='stable')
+    gt_img, gt_cls, gt_xyxy = gt_img[gt_order], gt_cls[gt_order], gt_xyxy[gt_order]
+    pair_pred, pair_gt = candidate_pairs(pred_keys, gt_img * n_classes + gt_cls)
+    iou = pair_iou(pred_xyxy[pair_pred], gt_xyxy[pair_gt])
+    tp = match_predictions(pair_pred, pair_gt, iou, len(pred_keys))
+    results = ap_per_class(tp, pred_conf, pred_cls, gt_cls)
+    print("{} images, {} detections, {} ground truth boxes, {} candidate pairs".format(
+        len(image_names), len(pred_keys), len(gt_cls), len(iou)))
+
+    # Best confidence threshold: the maximum of the (smoothed) mean F1 curve, like Ultralytics
+    class_names = [names.get(int(c), str(c)) for c in results['classes']]
+    best = int(smooth(results['f1'].mean(0), 0.1).argmax())
+    ap50, ap = results['ap'][:, 0], results['ap'].mean(1)
+    print("\nBest confidence threshold: {:.3f}".format(CONF_GRID[best]))
+    print("{:>12}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}".format("class", "boxes", "P", "R", "F1", "mAP50", "mAP50-95"))
+    rows = [(name, n, results['p'][i, best], results['r'][i, best], results['f1'][i, best], ap50[i], ap[i])
+            for i, (name, n) in enumerate(zip(class_names, results['n_targets']))]
+    rows.append(("all", int(results['n_targets'].sum()), results['p'][:, best].mean(), results['r'][:, best].mean(),
+                 results['f1'][:, best].mean(), ap50.mean(), ap.mean()))
+    for row in rows:
+        print("{:>12}{:>10}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}".format(*row))
+
+    # Other thresholds are just other points of the same curves
+    at_thresholds = {}
+    for conf in args.conf_thresholds:
+        i = int(np.abs(CONF_GRID - conf).argmin())
+        at_thresholds[conf] = {name: {'p': float(results['p'][c, i]), 'r': float(results['r'][c, i]),
+                                      'f1': float(results['f1'][c, i])} for c, name in enumerate(class_names)}
+        print("\nconf {:.2f}: ".format(conf) + "  ".join(
+            "{} P {:.3f} R {:.3f} F1 {:.3f}".format(name, m['p'], m['r'], m['f1'])
+            for name, m in at_thresholds[conf].items()))
+
+    path_output = Path(args.path_output)
+    path_output.mkdir(parents=True, exist_ok=True)
+    with open(path_output / "metrics.json", 'w') as f:
+        json.dump({'best_conf': float(CONF_GRID[best]),
+                   'classes': {row[0]: dict(zip(['boxes', 'p', 'r', 'f1', 'map50', 'map50_95'],
+                                                [int(row[1])] + [float(v) for v in row[2:]])) for row in rows},
+                   'thresholds': at_thresholds}, f, indent=2)
+    if not args.no_plots:
+        plot_curve(results['f1'], class_names, path_output / "F1_curve.png", "Confidence", "F1")
+        plot_curve(results['p'], class_names, path_output / "P_curve.png", "Confidence", "Precision")
+        plot_curve(results['r'], class_names, path_output / "R_curve.png", "Confidence", "Recall")
+        plot_curve(results['pr'], class_names, path_output / "PR_curve.png", "Recall", "Precision", best_by_max=False)
+    print("\nResults saved to ", str(path_output))
@@ -0,0 +1,193 @@
+"""
+Disk cache of decoded and resized training images, shared by all the training runs (train.py --image_cache)
+Decoding the full resolution JPEGs/BMPs and resizing them to the training size takes most of the data loading
+time, and it gives the same result in every run of a sweep. The cache keeps the resized images as uint8 .npy
+files, which are memory-mapped when they are read back (no decoding, and the OS page cache is shared by all the
+DataLoader workers).
+
+Each image is stored under the SHA-1 of its file content and the training size, so a changed image gets a new
+entry and the same image can be cached at several sizes. A SQLite index (safe to use from several DataLoader
+workers and runs at the same time) remembers the hash of every source file, the original size of the images and
+when each entry was last used: the least recently used entries are deleted when the cache grows over its budget.
+"""
+
+import hashlib
+import math
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+TOUCH_INTERVAL = 300  # seconds between two updates of the last access time of an entry
+SYNC_INTERVAL = 30  # seconds between two reads of the real cache size (other workers and runs also add entries)
+
+
+def file_sha1(path):
+    """
+    :param path: path to a file
+    :return: SHA-1 of its content (hexadecimal)
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def resize_long_side(im, imgsz):
+    """
+    Resize the long side of an image to imgsz, exactly like Ultralytics' BaseDataset.load_image (rect mode)
+    :param im: image
+    :param imgsz: training image size
+    :return: resized image
+    """
+    h0, w0 = im.shape[:2]
+    r = imgsz / max(h0, w0)
+    if r != 1:
+        w, h = (min(math.ceil(w0 * r), imgsz), min(math.ceil(h0 * r), imgsz))
+        im = cv2.resize(im, (w, h), interpolation=cv2.INTER_LINEAR)
+    return im
+
+
+class ImageCache:
+    """
+    Disk-backed LRU cache of resized images
+    """
+
+    def __init__(self, path, imgsz=640, max_gb=20.0):
+        """
+        :param path: cache folder (it can be shared by several runs)
+        :param imgsz: training image size
+        :param max_gb: size budget of the cached arrays (GB)
+        """
+        self.path = Path(path)
+        self.imgsz = imgsz
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._db = None
+        self._pid = None
+        self._total = None  # running size of the cache (bytes), as seen by this process
+        self._synced_at = 0.0
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS files "
+                            "(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, sha1 TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS entries "
+                            "(key TEXT PRIMARY KEY, h0 INTEGER, w0 INTEGER, nbytes INTEGER, last_access REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access)")
+
+    @property
+    def db(self):
+        # Opened on first use in every process, SQLite connections cannot be shared by forked DataLoader workers
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path / "index.sqlite", timeout=60, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._pid = os.getpid()
+            self._total = None
+        return self._db
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_db'] = None
+        return state
+
+    def _sha1(self, path):
+        """ Hash of a source file, only computed again when its size or mtime change """
+        st = os.stat(path)
+        row = self.db.execute("SELECT size, mtime, sha1 FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+        sha1 = file_sha1(path)
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (path, st.st_size, st.st_mtime_ns, sha1))
+        return sha1
+
+    def _array_path(self, key):
+        return self.path / key[:2] / (key + ".npy")
+
+    def load(self, path):
+        """
+        Get a resized image, decoding and caching it if needed
+        :param path: path to the source image
+        :return: resized image, original (h, w), or (None, None) if the image could not be read
+        """
+        path = str(path)
+        key = "{}_{}".format(self._sha1(path), self.imgsz)
+        row = self.db.execute("SELECT h0, w0, last_access FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            try:
+                # A copy of the mapped pages: some augmentations modify the images in place
+                im = np.array(np.load(self._array_path(key), mmap_mode='r'))
+            except (FileNotFoundError, ValueError):
+                im = None  # deleted by another run, or written halfway
+            if im is not None:
+                now = time.time()
+                if now - row[2] > TOUCH_INTERVAL:
+                    self.db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+                return im, (row[0], row[1])
+
+        im = cv2.imread(path)
+        if im is None:
+            return None, None
+        h0, w0 = im.shape[:2]
+        im = resize_long_side(im, self.imgsz)
+        self._store(key, im, (h0, w0))
+        return im, (h0, w0)
+
+    def _store(self, key, im, shape):
+        """ Save an array (atomically, other workers may read it at the same time) and evict old entries """
+        path = self._array_path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix(".{}.tmp".format(os.getpid()))
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(im))
+        os.replace(tmp_path, path)
+        nbytes = path.stat().st_size
+        self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                        (key, shape[0], shape[1], nbytes, time.time()))
+        # The running total avoids summing the whole table after every new image
+        if self._total is None or time.time() - self._synced_at > SYNC_INTERVAL:
+            self.size()
+        else:
+            self._total += nbytes
+        if self._total > self.max_bytes:
+            self.evict()
+
+    def size(self):
+        """
+        :return: total size of the cached arrays (bytes)
+        """
+        self._total = self.db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()[0]
+        self._synced_at = time.time()
+        return self._total
+
+    def evict(self, target=0.9):
+        """
+        Delete the least recently used entries if the cache is over its budget
+        :param target: fraction of the budget left after evicting (so that it does not run on every new image)
+        :return: number of deleted entries
+        """
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return 0
+        excess += int((1 - target) * self.max_bytes)
+        deleted = []
+        for key, nbytes in self.db.execute("SELECT key, nbytes FROM entries ORDER BY last_access"):
+            deleted.append(key)
+            excess -= nbytes
+            self._total -= nbytes
+            if excess <= 0:
+                break
+        self.db.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k in deleted])
+        for key in deleted:
+            self._array_path(key).unlink(missing_ok=True)  # open memory maps keep working on POSIX
+        return len(deleted)
+
+    def stats(self):
+        """
+        :return: text with the number of cached images and their size
+        """
+        n = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return "{} images, {:.2f} GB of {:.2f} GB".format(n, self.size() / 1024 ** 3, self.max_bytes / 1024 ** 3)
@@ -0,0 +1,63 @@
+"""
+Helpers to feed a YOLO model with batches of images that are decoded ahead of time
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import decode_image
+from metrics import metrics, DEPTH_BUCKETS
+
+
+def iter_image_batches(path_data, file_names, batch_size=1, workers=4, min_size=640):
+    """
+    Decode the images in a thread pool and yield them in batches.
+    OpenCV releases the GIL while decoding, so the threads really run in parallel.
+    Only a few batches are decoded ahead of the consumer, so memory stays bounded.
+    The images are not resized (the backends letterbox them), but large JPEG images are decoded at a reduced size.
+    :param path_data: folder with the images
+    :param file_names: list of image file names (inside path_data)
+    :param batch_size: number of images per batch
+    :param workers: number of decoding threads
+    :param min_size: network input size (see utils.decode_image)
+    :return: generator of (names, images, scales) tuples, the scales map each image to its original size
+    """
+    max_pending = max(2 * batch_size, workers) + batch_size
+    names = iter(file_names)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+
+        def submit_next():
+            f = next(names, None)
+            if f is None:
+                return False
+            pending.append((f, pool.submit(decode_image, os.path.join(path_data, f), min_size)))
+            return True
+
+        while len(pending) < max_pending and submit_next():
+            pass
+
+        batch_names, batch_imgs, batch_scales = [], [], []
+        while pending:
+            f, future = pending.popleft()
+            submit_next()
+            # Few decoded images waiting means that decoding is the bottleneck, many means that the model is
+            if metrics.enabled:
+                metrics.observe("decoded_queue_depth", sum(fut.done() for _, fut in pending), buckets=DEPTH_BUCKETS)
+            with metrics.span("io_wait"):
+                img, scale = future.result()
+            if img is None:
+                print("WARNING: Could not read {}, skipping it".format(f))
+                metrics.count("unreadable_images")
+                continue
+
+            batch_names.append(f)
+            batch_imgs.append(img)
+            batch_scales.append(scale)
+            if len(batch_imgs) == batch_size:
+                yield batch_names, batch_imgs, batch_scales
+                batch_names, batch_imgs, batch_scales = [], [], []
+
+        if batch_imgs:
+            yield batch_names, batch_imgs, batch_scales
@@ -8,12 +8,16 @@ from pathlib import Path
 import argparse
 import time
 
-from ultralytics import YOLO
 import cv2
-import numpy as np
-import imageio
 import supervision as spv
 from utils import annotate_frame
+from annotation import add_annotation_args, annotators_from_args
+from backends import add_backend_args, backend_from_args
+from cascade import add_cascade_args, cascade_from_args
+from tracking import add_tracking_args, tracking_from_args
+from streaming import open_source, run_pipeline
+from recorder import StreamRecorder
+from metrics import metrics, add_metrics_args, enable_from_args, save_from_args
 
 
 if __name__ == "__main__":
@@ -21,65 +25,115 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-m", '--path_model', type=str, help="Path to the model")
     parser.add_argument("-i", '--camera_id', type=int, help="Camera ID")
+    parser.add_argument("-s", '--source', type=str,
+                        help="Video file or 'synthetic' to use instead of the camera")
     parser.add_argument('--save_gif', type=str,
                         help="Save the video to a GIF file in given location")
+    parser.add_argument('--save_video', type=str, help="Save the video to a MP4/AVI file")
+    parser.add_argument('--record_fps', type=int, default=30, help="Frame rate of the saved video")
+    parser.add_argument('--record_scale', type=float, default=1.0, help="Resize factor of the saved frames")
+    parser.add_argument('--record_every', type=int, default=1, help="Save one of every N frames")
+    parser.add_argument('--record_max_seconds', type=float,
+                        help="Only save the last N seconds of the session (kept in a ring buffer)")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Run capture, inference and display on separate threads (dropping stale frames)")
+    parser.add_argument('--no_show', action='store_true', help="Disable cv2.imshow")
+    parser.add_argument('--max_frames', type=int, help="Stop after this number of frames")
+    add_annotation_args(parser)
+    add_tracking_args(parser)
+    add_cascade_args(parser)
+    add_backend_args(parser)
+    add_metrics_args(parser)
     args = parser.parse_args()
+    enable_from_args(args)
 
     # Loading the model
     try:
         print("Loading the model")
-        path_model = Path(args.path_model)
-        model = YOLO(path_model)
+        model = cascade_from_args(backend_from_args(args), args)
     except FileNotFoundError:
         print("ERROR: Could not load the YOLO model")
         exit()
 
     # This will draw the detections
     class_colors = spv.ColorPalette.from_hex(['#ffff66', '#66ffcc', '#ff99ff', '#ffcc99'])
-    class_names_dict = model.model.names
-    bbox_annotator = spv.BoundingBoxAnnotator(thickness=2, color=class_colors)
-    label_annotator = spv.LabelAnnotator(color=class_colors, text_color=spv.Color.from_hex("#000000"))
-
-    # Reading frames from the webcam
-    cap = cv2.VideoCapture(args.camera_id)
-
-    # Exporting to GIF
-    frames = []
-    times = []
-    make_gif = args.save_gif is not None
-    if make_gif:
-        if Path(args.save_gif).is_file():
-            path_gif = Path(args.save_gif)
-        else:
-            path_gif = Path(args.save_gif) / "live_demo.gif"
+    class_names_dict = model.names
+    bbox_annotator, label_annotator = annotators_from_args(class_colors, args)
 
-    # Read from camera and run the YOLO model on each frame
-    while True:
-        frame_ok, frame = cap.read()
-
-        if frame_ok:
-            start_time = time.time()
-            result = model(frame, agnostic_nms=True, verbose=False)[0]
-            detections = spv.Detections.from_ultralytics(result)
+    # Reading frames from the webcam (or a video file)
+    cap = open_source(args.source if args.source is not None else args.camera_id)
 
+    # Exporting to GIF (or video): the frames are encoded in the background while the demo runs
+    recorders = []
+    if args.save_gif is not None:
+        if Path(args.save_gif).is_dir():
+            path_gif = Path(args.save_gif) / "live_demo.gif"
+        else:
+            path_gif = Path(args.save_gif)
+        recorders.append(path_gif)
+    if args.save_video is not None:
+        recorders.append(Path(args.save_video))
+    recorders = [StreamRecorder(path, fps=args.record_fps, scale=args.record_scale, every_n=args.record_every,
+                                max_seconds=args.record_max_seconds) for path in recorders]
+
+    # With --track, the model only runs on key frames and the face parts are tracked in between
+    adaptive = tracking_from_args(model, args)
+
+    def detect(frame):
+        if adaptive is not None:
+            return adaptive(frame)
+        return model.predict([frame])[0]
+
+    def render(frame, detections):
+        """ Draws the detections and returns False when the user wants to quit """
+        metrics.count_detections(detections, class_names_dict)
+        with metrics.span("annotate"):
             frame = annotate_frame(frame, detections, bbox_annotator, label_annotator, class_names_dict)
-            cv2.imshow("Face parts", frame)
-            k = cv2.waitKey(1)
-
-            if make_gif:
-                frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-                times.append(time.time() - start_time)
-
-            if k == ord("q"):
-                break
-
-    cv2.destroyAllWindows()
+        k = -1
+        if not args.no_show:
+            with metrics.span("display"):
+                cv2.imshow("Face parts", frame)
+                k = cv2.waitKey(1)
+
+        timestamp = time.perf_counter()
+        for recorder in recorders:
+            recorder.add(frame, timestamp)
+        return k != ord("q")
+
+    if args.pipeline:
+        # Capture and inference run on their own threads, so the latency is set by the slowest stage
+        stage_times = run_pipeline(cap, detect, render, max_frames=args.max_frames)
+        print(stage_times.summary())
+    else:
+        # Read from camera and run the YOLO model on each frame
+        n_frames = 0
+        while args.max_frames is None or n_frames < args.max_frames:
+            with metrics.span("capture"):
+                frame_ok, frame = cap.read()
+
+            if frame_ok:
+                n_frames += 1
+                with metrics.span("inference"):
+                    detections = detect(frame)
+                with metrics.span("render"):
+                    keep_going = render(frame, detections)
+                if not keep_going:
+                    break
+            elif args.source is not None:
+                break  # end of the video
+
+    if not args.no_show:
+        cv2.destroyAllWindows()
     cap.release()
-
-    # Exporting to GIF
-    # Source: https://pysource.com/2021/03/25/create-an-animated-gif-in-real-time-with-opencv-and-python/
-    if make_gif:
-        print("\nSaving the stream to ", path_gif)
-        avg_time = np.array(times).mean()
-        fps = round(1 / avg_time)
-        imageio.mimsave(path_gif, frames, format='GIF', fps=fps)
+    if adaptive is not None:
+        print("The model ran on {} of {} frames".format(adaptive.n_key_frames, adaptive.frame_index + 1))
+
+    # Encoding the last frames
+    for recorder in recorders:
+        print("\nSaving the stream to ", recorder.path)
+        recorder.close()
+        metrics.count("recorder_dropped_frames", recorder.n_dropped)
+        if recorder.n_dropped:
+            print("WARNING: {} frames were dropped because the encoder was too slow".format(recorder.n_dropped))
+
+    save_from_args(args)
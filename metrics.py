@@ -0,0 +1,363 @@
+"""
+Lightweight timing and counter layer used by run.py, live_demo.py and prepare_full_dataset.py
+
+    from metrics import metrics
+    with metrics.span("decode"):
+        img = cv2.imread(path)
+    metrics.count("detections", 3, cls="eye")
+    metrics.observe("queue_depth", len(queue), buckets=DEPTH_BUCKETS)
+
+Nothing is recorded until metrics.enable() is called: a disabled span is a shared object that does nothing,
+so the instrumentation can stay in the hot loops. At the end of a run, the histograms and counters can be
+written in the Prometheus text format, and the spans as a Chrome trace (chrome://tracing or ui.perfetto.dev).
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+PREFIX = "face_parts"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class _NullSpan:
+    """ Span used while the metrics are disabled """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    """ Times the code inside a with block and records it as a stage latency (and a trace event) """
+
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.record_span(self.name, self.start, time.perf_counter() - self.start, self.labels)
+        return False
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, like the Prometheus ones
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+
+class Metrics:
+    """
+    Thread-safe registry of stage latencies, histograms, counters and trace events
+    """
+
+    def __init__(self, max_events=1000000):
+        """
+        :param max_events: maximum number of trace events kept in memory (the rest are counted and dropped)
+        """
+        self.enabled = False
+        self.tracing = False
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}  # (name, labels) -> value
+        self.events = []
+        self.dropped_events = 0
+        self.t0 = time.perf_counter()
+
+    def enable(self, trace=False):
+        """
+        Start recording
+        :param trace: also keep every span as a Chrome trace event
+        :return: None
+        """
+        self.enabled = True
+        self.tracing = trace
+        self.t0 = time.perf_counter()
+
+    def span(self, name, **labels):
+        """
+        :param name: stage name
+        :param labels: extra Prometheus labels (e.g. dataset="helen")
+        :return: context manager that times its block
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, tuple(sorted(labels.items())))
+
+    def record_span(self, name, start, duration, labels=()):
+        """
+        Record a stage latency measured elsewhere
+        :param name: stage name
+        :param start: time.perf_counter() at the start of the stage
+        :param duration: seconds
+        :param labels: tuple of (label, value) pairs
+        :return: None
+        """
+        if not self.enabled:
+            return
+        key = ("stage_seconds", (("stage", name),) + tuple(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(duration)
+            if self.tracing:
+                if len(self.events) < self.max_events:
+                    self.events.append({"name": name, "cat": "stage", "ph": "X",
+                                        "ts": (start - self.t0) * 1e6, "dur": duration * 1e6,
+                                        "pid": os.getpid(), "tid": threading.get_ident(),
+                                        "args": dict(labels)})
+                else:
+                    self.dropped_events += 1
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """
+        Add a value to a histogram (e.g. a queue depth)
+        :param name: histogram name
+        :param value: observed value
+        :param buckets: upper bounds of the buckets (only used the first time)
+        :param labels: extra Prometheus labels
+        :return: None
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+            if self.tracing and len(self.events) < self.max_events:
+                self.events.append({"name": name, "ph": "C", "ts": (time.perf_counter() - self.t0) * 1e6,
+                                    "pid": os.getpid(), "args": {name: value}})
+
+    def count(self, name, n=1, **labels):
+        """
+        Increase a counter (e.g. dropped frames, detections of a class)
+        :param name: counter name
+        :param n: increment
+        :param labels: extra Prometheus labels
+        :return: None
+        """
+        if not self.enabled or n == 0:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def count_detections(self, detections, class_names_dict):
+        """
+        Count the detections of each class
+        :param detections: supervision Detections object
+        :param class_names_dict: dictionary with model's class names {class_id: class_name, ...}
+        :return: None
+        """
+        if not self.enabled or len(detections) == 0:
+            return
+        ids, counts = np.unique(detections.class_id, return_counts=True)
+        for class_id, n in zip(ids, counts):
+            self.count("detections", int(n), cls=class_names_dict.get(int(class_id), str(class_id)))
+
+    def take(self):
+        """
+        Remove everything recorded so far and return it (a worker process sends it to the main one, see merge)
+        :return: picklable tuple (histograms, counters, events, dropped events)
+        """
+        with self.lock:
+            state = (self.histograms, self.counters, self.events, self.dropped_events)
+            self.histograms, self.counters, self.events, self.dropped_events = {}, {}, [], 0
+        return state
+
+    def merge(self, state):
+        """
+        Add the metrics recorded by another process
+        :param state: tuple returned by take() in the other process
+        :return: None
+        """
+        histograms, counters, events, dropped_events = state
+        with self.lock:
+            for key, histogram in histograms.items():
+                if key in self.histograms:
+                    self.histograms[key].merge(histogram)
+                else:
+                    self.histograms[key] = histogram
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            room = max(0, self.max_events - len(self.events))
+            self.events.extend(events[:room])
+            self.dropped_events += dropped_events + max(0, len(events) - room)
+
+    def summary(self):
+        """
+        :return: text with the mean latency and number of calls of each stage, and the counters
+        """
+        lines = []
+        with self.lock:
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name == "stage_seconds" and h.count:
+                    lines.append("{:>30}: mean {:8.2f} ms | {} calls".format(
+                        _format_labels(labels[1:], labels[0][1]), 1000 * h.sum / h.count, h.count))
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("{:>30}: {}".format(_format_labels(labels, name), value))
+        return "\n".join(lines)
+
+    def prometheus_text(self):
+        """
+        :return: the histograms and counters in the Prometheus text format
+        """
+        lines = []
+        with self.lock:
+            families = {}
+            for (name, labels), h in self.histograms.items():
+                families.setdefault(name, []).append((labels, h))
+            for name, series in sorted(families.items()):
+                metric = "{}_{}".format(PREFIX, name)
+                lines.append("# TYPE {} histogram".format(metric))
+                for labels, h in sorted(series, key=lambda s: s[0]):
+                    cumulative = 0
+                    for le, n in zip([_format_number(b) for b in h.buckets] + ["+Inf"], h.counts):
+                        cumulative += n
+                        lines.append("{}_bucket{} {}".format(metric, _prometheus_labels(labels + (("le", le),)),
+                                                             cumulative))
+                    lines.append("{}_sum{} {}".format(metric, _prometheus_labels(labels), _format_number(h.sum)))
+                    lines.append("{}_count{} {}".format(metric, _prometheus_labels(labels), h.count))
+
+            families = {}
+            for (name, labels), value in self.counters.items():
+                families.setdefault(name, []).append((labels, value))
+            for name, series in sorted(families.items()):
+                metric = "{}_{}_total".format(PREFIX, name)
+                lines.append("# TYPE {} counter".format(metric))
+                for labels, value in sorted(series):
+                    lines.append("{}{} {}".format(metric, _prometheus_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        Save the histograms and counters in the Prometheus text format (e.g. for the node_exporter textfile collector)
+        :param path: output file
+        :return: None
+        """
+        text = self.prometheus_text()
+
+        # Written to a temporary file first, so a collector never reads half a file
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def write_chrome_trace(self, path):
+        """
+        Save the spans as a Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev)
+        :param path: output JSON file
+        :return: None
+        """
+        with self.lock:
+            events = list(self.events)
+            names = {e["tid"] for e in events if "tid" in e}
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        events += [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                    "args": {"name": thread_names.get(tid, str(tid))}} for tid in names]
+        if self.dropped_events:
+            print("WARNING: {} trace events were dropped (max_events={})".format(self.dropped_events, self.max_events))
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def _format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = ['{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for k, v in labels]
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_labels(labels, name):
+    return name + "".join("[{}={}]".format(k, v) for k, v in labels)
+
+
+# Shared by all the modules of a script
+metrics = Metrics()
+
+
+def add_metrics_args(parser):
+    """
+    Add the metrics options to a script's argument parser
+    :param parser: argparse.ArgumentParser
+    :return: None
+    """
+    parser.add_argument('--metrics', type=str, help="Save the stage latencies and counters here (Prometheus text)")
+    parser.add_argument('--trace', type=str, help="Save a Chrome trace (JSON) of all the stages here")
+
+
+def enable_from_args(args):
+    """
+    Enable the metrics if the script was asked to save them (see add_metrics_args)
+    :param args: parsed arguments
+    :return: None
+    """
+    if args.metrics is not None or args.trace is not None:
+        metrics.enable(trace=args.trace is not None)
+
+
+def save_from_args(args):
+    """
+    Save the metrics requested by the script arguments (see add_metrics_args)
+    :param args: parsed arguments
+    :return: None
+    """
+    if not metrics.enabled:
+        return
+    print(metrics.summary())
+    if args.metrics is not None:
+        metrics.write_prometheus(args.metrics)
+        print("Metrics saved to ", args.metrics)
+    if args.trace is not None:
+        metrics.write_chrome_trace(args.trace)
+        print("Trace saved to ", args.trace)
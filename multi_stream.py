@@ -0,0 +1,108 @@
+"""
+This script loads a YOLO model once and runs it on several cameras, video files or stream URLs at the same time
+
+Every source is read on its own thread, and a scheduler batches the latest frame of each stream into a single
+inference call, so the model is loaded once and the CPU threads are not oversubscribed by one process per camera.
+"""
+
+from pathlib import Path
+import argparse
+import time
+
+import cv2
+import supervision as spv
+from utils import annotate_frame
+from annotation import add_annotation_args, annotators_from_args
+from backends import add_backend_args, backend_from_args
+from streaming import open_source, run_multi_stream
+from recorder import StreamRecorder
+from metrics import metrics, add_metrics_args, enable_from_args, save_from_args
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", '--path_model', type=str, help="Path to the model")
+    parser.add_argument("-s", '--sources', type=str, nargs='+', required=True,
+                        help="Camera IDs, video files, stream URLs or 'synthetic'")
+    parser.add_argument("-b", '--batch_size', type=int,
+                        help="Maximum number of frames per inference call (default: number of sources)")
+    parser.add_argument('--max_wait_ms', type=float, default=5,
+                        help="How long a frame may wait for the frames of other streams to fill the batch")
+    parser.add_argument('--no_pacing', action='store_true',
+                        help="Read video files as fast as possible instead of at their frame rate")
+    parser.add_argument('--save_dir', type=str, help="Save the annotated video of each stream in this folder")
+    parser.add_argument('--record_fps', type=int, default=30, help="Frame rate of the saved videos")
+    parser.add_argument('--record_scale', type=float, default=1.0, help="Resize factor of the saved frames")
+    parser.add_argument('--no_show', action='store_true', help="Disable cv2.imshow")
+    parser.add_argument('--max_frames', type=int, help="Stop after this number of frames (all the streams)")
+    add_annotation_args(parser)
+    add_backend_args(parser)
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    enable_from_args(args)
+
+    # Loading the model (once for all the streams)
+    try:
+        print("Loading the model")
+        model = backend_from_args(args)
+    except FileNotFoundError:
+        print("ERROR: Could not load the YOLO model")
+        exit()
+
+    # This will draw the detections
+    class_colors = spv.ColorPalette.from_hex(['#ffff66', '#66ffcc', '#ff99ff', '#ffcc99'])
+    class_names_dict = model.names
+    bbox_annotator, label_annotator = annotators_from_args(class_colors, args)
+
+    # Video files are read at their frame rate, so they behave like cameras
+    caps = [open_source(source, paced=not args.no_pacing) for source in args.sources]
+    for source, cap in zip(args.sources, caps):
+        if not cap.isOpened():
+            print("ERROR: Could not open", source)
+            exit()
+
+    # One annotated video per stream
+    recorders = [None] * len(caps)
+    if args.save_dir is not None:
+        Path(args.save_dir).mkdir(parents=True, exist_ok=True)
+        recorders = [StreamRecorder(Path(args.save_dir) / "stream_{}.mp4".format(i), fps=args.record_fps,
+                                    scale=args.record_scale) for i in range(len(caps))]
+
+    def render(stream, frame, detections):
+        """ Draws the detections of a stream and returns False when the user wants to quit """
+        metrics.count_detections(detections, class_names_dict)
+        metrics.count("frames", stream=stream)
+        with metrics.span("annotate"):
+            frame = annotate_frame(frame, detections, bbox_annotator, label_annotator, class_names_dict)
+        k = -1
+        if not args.no_show:
+            with metrics.span("display"):
+                cv2.imshow("Face parts - {}".format(args.sources[stream]), frame)
+                k = cv2.waitKey(1)
+
+        if recorders[stream] is not None:
+            recorders[stream].add(frame, time.perf_counter())
+        return k != ord("q")
+
+    start = time.perf_counter()
+    stage_times, n_processed = run_multi_stream(caps, model.predict, render,
+                                                batch_size=args.batch_size or len(caps),
+                                                max_wait=args.max_wait_ms / 1000, max_frames=args.max_frames)
+    elapsed = time.perf_counter() - start
+    print(stage_times.summary())
+    for source, n in zip(args.sources, n_processed):
+        print("{}: {} frames ({:.1f} FPS)".format(source, n, n / elapsed))
+
+    if not args.no_show:
+        cv2.destroyAllWindows()
+    for cap in caps:
+        cap.release()
+
+    # Encoding the last frames
+    for recorder in recorders:
+        if recorder is not None:
+            print("\nSaving the stream to ", recorder.path)
+            recorder.close()
+
+    save_from_args(args)
@@ -5,13 +5,19 @@ I need to do this before uploading the images to CVAT.
 Author: Ignacio Hernández Montilla, 2023
 """
 
-import shutil
 from pathlib import Path
+import argparse
 import pandas as pd
+from utils import link_file, LINK_MODES
 
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--link_mode', type=str, default='copy', choices=LINK_MODES,
+                        help="How the images are put in the joined folder (falls back to copy if linking fails)")
+    args = parser.parse_args()
+
     # I will annotate the V2 and V3 subsets of FASSEG
 
     path_fasseg = Path.home() / "Documents" / "Datasets" / "FASSEG"
@@ -24,7 +30,7 @@ if __name__ == "__main__":
         images = list(path_fasseg_v.glob("*_RGB/*.bmp" if v == 2 else "*_RGB/**/*.bmp"))
         print("{}: {} images".format(path_fasseg_v, len(images)))
         for f in images:
-            shutil.copy(f, path_joined_images / f.name)
+            link_file(f, path_joined_images / f.name, args.link_mode)
             split_info.loc[len(split_info), :] = [f.name, v, int("Train_" in str(f))]
 
     split_info.to_csv(path_joined_images.parent / "split_info.csv", index=False)
@@ -7,21 +7,30 @@ Author: Ignacio Hernández Montilla, 2023
 """
 import os
 from utils import *
-import shutil
 import glob
 from pathlib import Path
 from unidecode import unidecode
 
 import pandas as pd
 import yaml
+from shards import write_shards
+from metrics import metrics, add_metrics_args, enable_from_args, save_from_args
 
 import argparse
+import hashlib
+import json
+import time
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 import random
 random.seed(420)
 
+IMSHOW_WAIT_TIME = 33  # for cv2.imshow
+CONVERSION_VERSION = 2  # increase it when the landmark-to-box conversion changes (forces a full rebuild)
 
-def process_names(names, split, path_data, path_dest, skip=[]):
+
+def process_names(names, split, path_data, path_dest, skip=[], available=None):
     """
     This function reads the split data of all datasets
      and saves it following the YOLO folder structure
@@ -30,6 +39,7 @@ def process_names(names, split, path_data, path_dest, skip=[]):
     :param path_data: path to the data
     :param path_dest: path to the exported data
     :param skip: list of image names that we may want to skip
+    :param available: set of image paths that were built (the rest are skipped), or None to keep all of them
     :return: None
     """
 
@@ -44,25 +54,440 @@ def process_names(names, split, path_data, path_dest, skip=[]):
     names[2] = names[0].apply(lambda x: os.path.join(path_data, "labels", os.path.splitext(x)[0] + ".txt"))
     path_imgs_txt = os.path.join(path_dest, "images", split, "images.txt")
     path_labels_txt = os.path.join(path_dest, "labels", split, "labels.txt")
-    use_imgs = names.loc[~names[0].isin(skip), 1]
-    use_labels = names.loc[~names[0].isin(skip), 2]
+    use = ~names[0].isin(skip)
+    if available is not None:
+        use &= names[1].isin(available)
+    use_imgs = names.loc[use, 1]
+    use_labels = names.loc[use, 2]
     use_imgs.to_csv(path_imgs_txt, header=False, index=False)
     use_labels.to_csv(path_labels_txt, header=False, index=False)
 
 
+def run_jobs(func, tasks, jobs=1):
+    """
+    Run a function over a list of tasks, using a pool of processes if jobs > 1
+    The results are returned in the same order as the tasks, so the output does not depend on the number of jobs
+    :param func: function that takes a single task (use functools.partial for the fixed arguments)
+    :param tasks: list of tasks
+    :param jobs: number of processes
+    :return: list of results
+    """
+    if jobs <= 1 or len(tasks) <= 1:
+        return [func(t) for t in tasks]
+
+    chunk_size = max(1, len(tasks) // (jobs * 8))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        if not metrics.enabled:
+            return list(pool.map(func, tasks, chunksize=chunk_size))
+        # The spans recorded inside the workers come back with the results
+        results = []
+        for result, state in pool.map(partial(collect_metrics, func, metrics.tracing, metrics.t0), tasks,
+                                      chunksize=chunk_size):
+            metrics.merge(state)
+            results.append(result)
+        return results
+
+
+def collect_metrics(func, trace, t0, task):
+    """
+    Run a function in a worker process, recording its metrics apart so they can be merged in the main process
+    :param func: function that takes a single task
+    :param trace: also keep the trace events
+    :param t0: time origin of the main process metrics (time.perf_counter is the same clock in all processes)
+    :param task: task
+    :return: result, metrics recorded while running it (see Metrics.take)
+    """
+    metrics.take()  # a forked worker starts with a copy of what the main process had recorded
+    metrics.enable(trace)
+    metrics.t0 = t0
+    result = func(task)
+    return result, metrics.take()
+
+
+def timed_call(func, task):
+    """
+    Run a function and measure how long it took (the time is measured inside the worker process)
+    :param func: function that takes a single task
+    :param task: task
+    :return: result, start time (time.perf_counter), duration (seconds)
+    """
+    start = time.perf_counter()
+    result = func(task)
+    return result, start, time.perf_counter() - start
+
+
+def file_signature(path, use_hash=False):
+    """
+    Get a signature of a file to know if it has changed since the last build
+    :param path: path to the file
+    :param use_hash: also compute the SHA-1 of the content (slower, but survives touching or re-downloading a file)
+    :return: dictionary with the size, the modification time and (optionally) the hash
+    """
+    st = os.stat(path)
+    signature = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+    if use_hash:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        signature['sha1'] = sha1.hexdigest()
+    return signature
+
+
+def mapping_version(*objs):
+    """
+    Hash of everything that defines how the labels are generated (e.g. the landmark indices of each part)
+    Changing any of these objects (or CONVERSION_VERSION) invalidates the outputs built with them
+    :param objs: JSON-serializable objects
+    :return: hexadecimal hash
+    """
+    return hashlib.sha1(json.dumps([CONVERSION_VERSION, *objs], sort_keys=True).encode()).hexdigest()
+
+
+class BuildManifest:
+    """
+    Keeps track of the inputs and outputs of every converted image, so that a rebuild only processes
+    new or changed images and deletes the outputs that are not produced anymore
+    """
+
+    def __init__(self, path, use_hash=False, rebuild=False, link_mode='copy'):
+        """
+        :param path: path to the manifest (JSON file)
+        :param use_hash: compare the content of the inputs (SHA-1) when their size or mtime changed
+        :param rebuild: ignore the previous manifest and process everything again
+        :param link_mode: how the images are put in the output folder (outputs made with another mode are rebuilt)
+        """
+        self.path = Path(path)
+        self.use_hash = use_hash
+        self.link_mode = link_mode
+        self.old_entries = {}
+        if self.path.is_file() and not rebuild:
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == CONVERSION_VERSION:
+                self.old_entries = manifest['entries']
+        self.entries = {}
+
+    def _input_unchanged(self, path, signature):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if st.st_size == signature['size'] and st.st_mtime_ns == signature['mtime']:
+            return True
+        if self.use_hash and 'sha1' in signature and st.st_size == signature['size']:
+            if file_signature(path, use_hash=True)['sha1'] == signature['sha1']:
+                signature['mtime'] = st.st_mtime_ns  # same content, no need to hash it again next time
+                return True
+        return False
+
+    def is_fresh(self, key, mapping):
+        """
+        Check if the outputs of a task are up to date (and keep its entry if they are)
+        :param key: unique ID of the task
+        :param mapping: mapping version of the task (see mapping_version)
+        :return: True if the task does not need to be processed again
+        """
+        entry = self.old_entries.get(key)
+        fresh = (entry is not None and entry['mapping'] == mapping and
+                 entry.get('link_mode') == self.link_mode and
+                 all(os.path.exists(p) for p in entry['outputs']) and
+                 all(self._input_unchanged(p, sig) for p, sig in entry['inputs'].items()))
+        if fresh:
+            self.entries[key] = entry
+        return fresh
+
+    def record(self, key, dataset, mapping, inputs, outputs):
+        """
+        Save the inputs and outputs of a processed task
+        :param key: unique ID of the task
+        :param dataset: name of the source dataset
+        :param mapping: mapping version of the task (see mapping_version)
+        :param inputs: list of input files
+        :param outputs: list of output files
+        :return: None
+        """
+        self.entries[key] = {'dataset': dataset,
+                             'mapping': mapping,
+                             'link_mode': self.link_mode,
+                             'inputs': {p: file_signature(p, self.use_hash) for p in inputs},
+                             'outputs': outputs}
+
+    def remove_stale(self):
+        """
+        Delete the outputs of the previous build that are not produced by this build
+        :return: number of deleted files
+        """
+        current = self.outputs()
+        stale = set(p for entry in self.old_entries.values() for p in entry['outputs']) - current
+        for p in stale:
+            if os.path.lexists(p):
+                os.remove(p)
+        return len(stale)
+
+    def outputs(self):
+        """
+        :return: set of all the files produced by this build
+        """
+        return set(p for entry in self.entries.values() for p in entry['outputs'])
+
+    def save(self):
+        """
+        Write the manifest to disk
+        :return: None
+        """
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': CONVERSION_VERSION, 'entries': self.entries}, f)
+        os.replace(tmp_path, self.path)
+
+
+def run_cached_jobs(func, tasks, keys, mappings, manifest, dataset, jobs=1):
+    """
+    Same as run_jobs, but skipping the tasks whose outputs are up to date according to the manifest
+    The function must return a list of input files and a list of output files
+    :param func: function that takes a single task
+    :param tasks: list of tasks
+    :param keys: unique ID of each task
+    :param mappings: mapping version of each task (a single string for all of them is also accepted)
+    :param manifest: BuildManifest
+    :param dataset: name of the source dataset
+    :param jobs: number of processes
+    :return: None
+    """
+    if isinstance(mappings, str):
+        mappings = [mappings] * len(tasks)
+
+    todo = [i for i, k in enumerate(keys) if not manifest.is_fresh(k, mappings[i])]
+    with metrics.span("convert", dataset=dataset):
+        results = run_jobs(partial(timed_call, func), [tasks[i] for i in todo], jobs)
+    for i, ((inputs, outputs), start, duration) in zip(todo, results):
+        metrics.record_span("image", start, duration, (("dataset", dataset),))
+        manifest.record(keys[i], dataset, mappings[i], inputs, outputs)
+    metrics.count("images_processed", len(todo), dataset=dataset)
+    metrics.count("images_unchanged", len(tasks) - len(todo), dataset=dataset)
+    print("[{}] {} images processed, {} unchanged".format(dataset, len(todo), len(tasks) - len(todo)))
+
+
+def convert_landmarks(img_source, points, groups, label_dest, show=False):
+    """
+    Convert the facial landmarks of an image to YOLO boxes and save them to a label file
+    :param img_source: path to the image
+    :param points: array of (X,Y) points, shape (N_points, 2), or (N_faces, N_points, 2) for many faces
+    :param groups: class IDs and landmark indices of each face part (see utils.part_index_groups)
+    :param label_dest: path to the output label file
+    :param show: show the landmarks and the boxes
+    :return: True if the label was saved, False if the image could not be read
+    """
+    if show:
+        img = cv2.imread(img_source, cv2.IMREAD_COLOR)
+        size = None if img is None else img.shape[:2]
+    else:
+        # The labels only need the image size, which can be read from the header of the file
+        # (image_size falls back to decoding the image when the header can not be parsed)
+        with metrics.span("size_probe"):
+            size = image_size(img_source)
+    if size is None:
+        print("WARNING: could not read {}, skipping it".format(img_source))
+        return False
+
+    img_h, img_w = size
+    if show:
+        img, ratio = smart_resize(img)
+        cv2.imshow("Image", img)
+        cv2.waitKey(IMSHOW_WAIT_TIME)
+
+    # Converting each face part into a bounding box (using the YOLO format)
+    class_ids, idx = groups
+    with metrics.span("label"):
+        img_labels, boxes = landmarks_to_yolo(points, class_ids, idx, img_h, img_w)
+        write_yolo_labels(label_dest, img_labels)
+
+    if show:
+        for x, y in points.reshape(-1, 2):
+            img = cv2.circle(img, (int(x*ratio), int(y*ratio)), 3, (0, 255, 255), -1)
+        for x, y, w, h in boxes.reshape(-1, 4):
+            img = cv2.rectangle(img,
+                                (int(x*ratio), int(y*ratio)),
+                                (int((x+w)*ratio), int((y+h)*ratio)), (0, 0, 255), 2)
+        cv2.imshow("Image", img)
+        cv2.waitKey(IMSHOW_WAIT_TIME)
+    return True
+
+
+def process_helen_image(ann, path_images, path_annotations, path_dest_images, path_dest_labels,
+                        groups, skip_imgs, show=False, link_mode='copy'):
+    """
+    Convert one Helen annotation file
+    :param ann: annotation file name
+    :param path_images: folder with the Helen images
+    :param path_annotations: folder with the Helen annotations
+    :param path_dest_images: the image will be copied here
+    :param path_dest_labels: the YOLO label will be saved here
+    :param groups: class IDs and landmark indices of each face part (see utils.part_index_groups)
+    :param skip_imgs: set of image names that are not used
+    :param show: show the landmarks and the boxes
+    :param link_mode: how the image is put in the output folder (see utils.link_file)
+    :return: list of input files, list of output files (both empty if the image was skipped)
+    """
+    with open(os.path.join(path_annotations, ann)) as f:
+        lines = [l.rstrip() for l in f.readlines()]
+
+    img_name = lines.pop(0)
+    img_name = "{}.jpg".format(img_name)
+    if img_name in skip_imgs:
+        return [], []
+
+    print("[HELEN] {}: {} landmarks".format(img_name, len(lines)))
+    img_source = os.path.join(path_images, img_name)
+    label_dest = os.path.join(path_dest_labels, os.path.splitext(img_name)[0] + ".txt")
+    if not convert_landmarks(img_source, parse_landmarks(lines), groups, label_dest, show):
+        return [], []
+
+    # Saving the data
+    img_dest = os.path.join(path_dest_images, img_name)
+    link_file(img_source, img_dest, link_mode)
+    return [img_source, os.path.join(path_annotations, ann)], [img_dest, label_dest]
+
+
+def process_afw_image(n, path_afw, path_dest_images, path_dest_labels, groups, show=False, link_mode='copy'):
+    """
+    Convert the annotations of one AFW image (all of its faces go to the same label file)
+    :param n: image name (without the face suffix)
+    :param path_afw: folder with the AFW dataset
+    :param path_dest_images: the image will be copied here
+    :param path_dest_labels: the YOLO label will be saved here
+    :param groups: class IDs and landmark indices of each face part (see utils.part_index_groups)
+    :param show: show the landmarks and the boxes
+    :param link_mode: how the image is put in the output folder (see utils.link_file)
+    :return: list of input files, list of output files (both empty if the image was skipped)
+    """
+    # For images with more than one face, the images are named like this:
+    #   - 18489332_1.jpg
+    #   - 18489332_2.jpg
+    # We just want a single image (18489332.jpg)
+    grouped_images = sorted(glob.glob(os.path.join(path_afw, "{}_*.jpg".format(n))))
+    grouped_points = sorted(glob.glob(os.path.join(path_afw, "{}_*.pts".format(n))))
+    if not grouped_images:
+        return [], []
+    faces = []
+    for pts_file in grouped_points:
+        with open(pts_file) as f:
+            lines = [l.rstrip() for l in f.readlines()][3:-1]  # keeping just the important lines
+        faces.append(parse_landmarks(lines))
+    if not faces:
+        print("[AFW] {}: no .pts files, skipping it".format(n))
+        return [], []
+    print("[AFW] {}: {} faces, {} landmarks".format(n, len(faces), len(faces[0])))
+
+    img_source = grouped_images[0]
+    img_dest = os.path.join(path_dest_images, "{}.jpg".format(n))
+    label_dest = os.path.join(path_dest_labels, "{}.txt".format(n))
+    if not convert_landmarks(img_source, np.stack(faces), groups, label_dest, show):
+        return [], []
+    link_file(img_source, img_dest, link_mode)
+    return grouped_images + grouped_points, [img_dest, label_dest]
+
+
+def process_menpo2D_image(task, path_menpo2D, path_dest_images, path_dest_labels, groups, show=False,
+                          link_mode='copy'):
+    """
+    Convert the annotations of one Menpo2D image
+    :param task: tuple (split name, image path, list of landmark coordinates as strings)
+    :param path_menpo2D: folder with the Menpo2D dataset
+    :param path_dest_images: the image will be copied here
+    :param path_dest_labels: the YOLO label will be saved here
+    :param groups: class IDs and landmark indices of each face part, for each image type
+    :param show: show the landmarks and the boxes
+    :param link_mode: how the image is put in the output folder (see utils.link_file)
+    :return: list of input files, list of output files (both empty if the image was skipped)
+    """
+    split_name, img_path, landmarks = task
+    img_source = os.path.join(path_menpo2D, split_name.capitalize(), img_path)
+    img_dest = os.path.join(path_dest_images, os.path.basename(img_path))
+
+    # Detecting if the image is semifrontal (68 landmarks) or profile (39 landmarks)
+    points = np.array(landmarks, dtype=np.float64)[14:].reshape(-1, 2)
+    img_type = 'profile' if len(points) == 39 else 'semifrontal'
+    print("[Menpo2D] {}: {} landmarks".format(os.path.basename(img_path), len(points)))
+
+    label_name = os.path.splitext(os.path.basename(img_path))[0]
+    label_dest = os.path.join(path_dest_labels, "{}.txt".format(label_name))
+    if not convert_landmarks(img_source, points, groups[img_type], label_dest, show):
+        return [], []
+    link_file(img_source, img_dest, link_mode)
+    return [img_source], [img_dest, label_dest]
+
+
+def process_lapa_image(task, path_lapa, path_dest_images, path_dest_labels, groups, show=False, link_mode='copy'):
+    """
+    Convert the annotations of one LaPa image
+    :param task: tuple (split name, image name)
+    :param path_lapa: folder with the LaPa dataset
+    :param path_dest_images: the image will be copied here
+    :param path_dest_labels: the YOLO label will be saved here
+    :param groups: class IDs and landmark indices of each face part (see utils.part_index_groups)
+    :param show: show the landmarks and the boxes
+    :param link_mode: how the image is put in the output folder (see utils.link_file)
+    :return: list of input files, list of output files (both empty if the image was skipped)
+    """
+    split_name, img_name = task
+    img_source = os.path.join(path_lapa, split_name, "images", img_name)
+    img_dest = os.path.join(path_dest_images, img_name)
+
+    img_landmarks = os.path.join(path_lapa, split_name, "landmarks", img_name.split(".")[0] + ".txt")
+    with open(img_landmarks) as f:
+        lines = [l.rstrip() for l in f.readlines()]
+        num_landmarks = lines[0]
+        lines = lines[1:]  # excluding the first line
+        print("[LaPa] {}: {} landmarks".format(img_name, num_landmarks))
+
+    label_name = os.path.splitext(img_name)[0]
+    label_dest = os.path.join(path_dest_labels, "{}.txt".format(label_name))
+    if not convert_landmarks(img_source, parse_landmarks(lines), groups, label_dest, show):
+        return [], []
+    link_file(img_source, img_dest, link_mode)
+    return [img_source, img_landmarks], [img_dest, label_dest]
+
+
+def copy_annotated_image(task, link_mode='copy'):
+    """
+    Copy an image and its YOLO label (for the datasets that were annotated on CVAT)
+    :param task: tuple (image source, image destination, label source, label destination)
+    :param link_mode: how the files are put in the output folder (see utils.link_file)
+    :return: list of input files, list of output files
+    """
+    img_source, img_dest, label_source, label_dest = task
+    link_file(img_source, img_dest, link_mode)
+    link_file(label_source, label_dest, link_mode)
+    return [img_source, label_source], [img_dest, label_dest]
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", '--data_dir', type=str, help="Path to the folder with all the datasets to be combined")
     parser.add_argument('--no_show', action='store_true', help="Disable cv2.imshow")
+    parser.add_argument("-j", '--jobs', type=int, default=1, help="Number of processes used to convert the images")
+    parser.add_argument('--rebuild', action='store_true', help="Ignore the build manifest and process every image")
+    parser.add_argument('--hash', action='store_true',
+                        help="Compare file contents (not just size and mtime) to detect changed images")
+    parser.add_argument('--link_mode', type=str, default='copy', choices=LINK_MODES,
+                        help="How the images are put in Face-Parts-Dataset (falls back to copy if linking fails)")
+    parser.add_argument('--shards', action='store_true', help="Also pack each split into a shard (see shards.py)")
+    parser.add_argument('--shard_image_size', type=int, default=640, help="Long side of the images stored in the shards")
+    add_metrics_args(parser)
     args = parser.parse_args()
+    enable_from_args(args)
     if args.data_dir is not None:
         path_datasets = args.data_dir
     else:
         path_datasets = os.path.join(Path.home(), "Documents", "Datasets")
 
     SHOW_IMAGES = not args.no_show
-    IMSHOW_WAIT_TIME = 33  # for cv2.imshow
+    if SHOW_IMAGES and args.jobs > 1:
+        print("Showing the images is only possible with a single job (--jobs 1), disabling it")
+        SHOW_IMAGES = False
 
     # Original data from Helen
     # I downloaded all the images and put them in an 'images' folder
@@ -103,6 +528,10 @@ if __name__ == "__main__":
     path_processed_images.mkdir(parents=True, exist_ok=True)
     path_processed_labels.mkdir(parents=True, exist_ok=True)
 
+    # Only new or changed images are processed (see BuildManifest)
+    manifest = BuildManifest(path_processed_dataset / "manifest.json", use_hash=args.hash, rebuild=args.rebuild,
+                             link_mode=args.link_mode)
+
     ########################################
     # PART 1: PROCESSING THE HELEN DATASET #
     ########################################
@@ -132,64 +561,29 @@ if __name__ == "__main__":
                          'eyebrow': [list(range(154, 174)), list(range(174, 194))]}  # left and right
     use_parts = [p for p in part_points_helen.keys() if p != "jaw"]
 
-    for ann in os.listdir(path_helen_annotations):
-        with open(os.path.join(path_helen_annotations, ann)) as f:
-            lines = [l.rstrip() for l in f.readlines()]
-
-        img_name = lines.pop(0)
-        img_name = "{}.jpg".format(img_name)
-
-        if img_name not in skip_imgs:
-            print("[HELEN] {}: {} landmarks".format(img_name, len(lines)))
-
-            img = cv2.imread(os.path.join(path_helen_images, img_name), cv2.IMREAD_COLOR)
-            img_h, img_w = img.shape[:2]
-            img, ratio = smart_resize(img)
-
-            if SHOW_IMAGES:
-                cv2.imshow("Image", img)
-                cv2.waitKey(IMSHOW_WAIT_TIME)
-
-            # Converting each face part into a bounding box (using the YOLO format)
-            img_labels = pd.DataFrame(columns=['class', 'x', 'y', 'w', 'h'])
-            for part_id, part_name in enumerate(use_parts):
-                for idxs in part_points_helen[part_name]:
-                    points = [lines[i] for i in idxs]
-                    contour = []
-                    for i, p in enumerate(points):
-                        x, y = [float(c) for c in p.split(" , ")]
-                        contour.append([x, y])
-                        img = cv2.circle(img, (int(x*ratio), int(y*ratio)), 3, (0, 255, 255), -1)
-
-                    # Getting the bounding box in YOLO format
-                    x, y, w, h = points_to_yolo(img_labels, contour, part_id, img_h, img_w)
-
-                    img = cv2.rectangle(img,
-                                        (int(x*ratio), int(y*ratio)),
-                                        (int((x+w)*ratio), int((y+h)*ratio)), (0, 0, 255), 2)
-
-            if SHOW_IMAGES:
-                cv2.imshow("Image", img)
-                cv2.waitKey(IMSHOW_WAIT_TIME)
-
-            # Saving the data
-            img_source = os.path.join(path_helen_images, img_name)
-            img_dest = os.path.join(path_processed_images, img_name)
-            shutil.copy(img_source, img_dest)
-            label_dest = os.path.join(path_processed_labels, os.path.splitext(img_name)[0] + ".txt")
-            img_labels.round(6).to_csv(label_dest, header=False, index=False, sep=" ")
+    convert_helen = partial(process_helen_image, path_images=path_helen_images,
+                            path_annotations=path_helen_annotations,
+                            path_dest_images=path_processed_images, path_dest_labels=path_processed_labels,
+                            groups=part_index_groups(part_points_helen, use_parts),
+                            skip_imgs=frozenset(skip_imgs), show=SHOW_IMAGES, link_mode=args.link_mode)
+    helen_annotations = sorted(os.listdir(path_helen_annotations))
+    run_cached_jobs(convert_helen, helen_annotations,
+                    keys=[os.path.join(path_helen_annotations, ann) for ann in helen_annotations],
+                    mappings=mapping_version(part_points_helen, use_parts, sorted(skip_imgs)),
+                    manifest=manifest, dataset="Helen", jobs=args.jobs)
 
     ########################################
     # PART 2: PROCESSING THE PEXELS IMAGES #
     ########################################
 
     # Copying the images and the labels to the final folder
-    pexels_sets = os.listdir(path_pexels_dataset)
+    pexels_sets = sorted(os.listdir(path_pexels_dataset))
     pexels_names = []
+    pexels_tasks = []
     for s in pexels_sets:
         path_pexels_annotations = os.path.join(path_pexels_dataset, s, "annotations", "obj_train_data")
         path_pexels_images = os.path.join(path_pexels_dataset, s, "images")
-        pexels_labels = os.listdir(path_pexels_annotations)
+        pexels_labels = sorted(os.listdir(path_pexels_annotations))
 
         for l in pexels_labels:
             # Cleaning the names to avoid files with weird accents and characters
@@ -197,13 +591,14 @@ if __name__ == "__main__":
             pexels_names.append(file_name_cleaned)
 
             img_name = os.path.splitext(l)[0] + ".jpg"
-            img_source = os.path.join(path_pexels_images, img_name)
-            img_dest = os.path.join(path_processed_images, file_name_cleaned + ".jpg")
-            shutil.copy(img_source, img_dest)
+            pexels_tasks.append((os.path.join(path_pexels_images, img_name),
+                                 os.path.join(path_processed_images, file_name_cleaned + ".jpg"),
+                                 os.path.join(path_pexels_annotations, l),
+                                 os.path.join(path_processed_labels, file_name_cleaned + ".txt")))
 
-            label_source = os.path.join(path_pexels_annotations, l)
-            label_dest = os.path.join(path_processed_labels, file_name_cleaned + ".txt")
-            shutil.copy(label_source, label_dest)
+    run_cached_jobs(partial(copy_annotated_image, link_mode=args.link_mode), pexels_tasks,
+                    keys=[t[2] for t in pexels_tasks], mappings=mapping_version(),
+                    manifest=manifest, dataset="Pexels", jobs=args.jobs)
 
     # Separate the Pexels dataset in training and validation
     train_pct = 0.7
@@ -218,7 +613,8 @@ if __name__ == "__main__":
 
     # Make train/val splits
     afw_images = glob.glob(os.path.join(path_afw_dataset, "*.jpg"))
-    afw_names = list(set([os.path.basename(f).split("_")[0] for f in afw_images]))  # removes duplicates
+    # The names are sorted because the order of a set changes between runs (and so would the shuffled splits)
+    afw_names = sorted(set([os.path.basename(f).split("_")[0] for f in afw_images]))  # removes duplicates
     random.shuffle(afw_names)
     train_size = int(train_pct * len(afw_names))
     afw_train_names = pd.DataFrame({0: afw_names[:train_size]})
@@ -230,57 +626,18 @@ if __name__ == "__main__":
                        'nose': [list(range(27, 36)) + [21, 22]],
                        'mouth': [list(range(48, 68))],
                        'eyebrow': [list(range(17, 22)), list(range(22, 27))]}  # left and right
-    for n in afw_names:
-        grouped_images = glob.glob(os.path.join(path_afw_dataset, "{}*.jpg".format(n)))
-        grouped_points = glob.glob(os.path.join(path_afw_dataset, "{}*.pts".format(n)))
-
-        for i, img_name in enumerate(grouped_images):
-            # For images with more than one face, the images are named like this:
-            #   - 18489332_1.jpg
-            #   - 18489332_2.jpg
-            # We just want a single image (18489332.jpg)
-            img_source = os.path.join(path_afw_dataset, img_name)
-            img_dest = os.path.join(path_processed_images, "{}.jpg".format(n))
-            shutil.copy(img_source, img_dest)
-
-            with open(os.path.join(path_afw_dataset, grouped_points[i])) as f:
-                lines = [l.rstrip() for l in f.readlines()][3:-1]  # keeping just the important lines
-
-            # Processing the labels
-            if i == 0:
-                img = cv2.imread(os.path.join(img_source), cv2.IMREAD_COLOR)
-                img_h, img_w = img.shape[:2]
-                img, ratio = smart_resize(img)
-
-                if SHOW_IMAGES:
-                    cv2.imshow("Image", img)
-                    cv2.waitKey(IMSHOW_WAIT_TIME)
-                print("[AFW] {}: {} landmarks".format(n, len(lines)))
-
-            img_labels = pd.DataFrame(columns=['class', 'x', 'y', 'w', 'h'])
-            for part_id, part_name in enumerate(use_parts):
-                for idxs in part_points_afw[part_name]:
-                    points = [lines[j] for j in idxs]
-                    contour = []
-                    for _, p in enumerate(points):
-                        x, y = [float(c) for c in p.split(" ")]
-                        contour.append([x, y])
-                        img = cv2.circle(img, (int(x * ratio), int(y * ratio)), 3, (0, 255, 255), -1)
-
-                    # Getting the bounding box in YOLO format
-                    x, y, w, h = points_to_yolo(img_labels, contour, part_id, img_h, img_w)
-
-                    # Showing the box
-                    img = cv2.rectangle(img,
-                                        (int(x*ratio), int(y*ratio)),
-                                        (int((x+w)*ratio), int((y+h)*ratio)), (0, 0, 255), 2)
-
-            if SHOW_IMAGES:
-                cv2.imshow("Image", img)
-                cv2.waitKey(IMSHOW_WAIT_TIME)
-
-            label_dest = os.path.join(path_processed_labels, "{}.txt".format(n))
-            img_labels.round(6).to_csv(label_dest, header=False, index=False, sep=" ")
+    convert_afw = partial(process_afw_image, path_afw=path_afw_dataset,
+                          path_dest_images=path_processed_images, path_dest_labels=path_processed_labels,
+                          groups=part_index_groups(part_points_afw, use_parts), show=SHOW_IMAGES,
+                          link_mode=args.link_mode)
+    afw_mapping = mapping_version(part_points_afw, use_parts)
+    afw_groups = {}
+    for f in sorted(afw_images):
+        afw_groups.setdefault(os.path.basename(f).split("_")[0], []).append(os.path.basename(f))
+    # The faces of each image are part of the mapping, so adding a face to an image triggers its conversion
+    run_cached_jobs(convert_afw, afw_names, keys=[os.path.join(path_afw_dataset, n) for n in afw_names],
+                    mappings=[afw_mapping + ":" + ",".join(afw_groups[n]) for n in afw_names],
+                    manifest=manifest, dataset="AFW", jobs=args.jobs)
 
     #########################################
     # PART 4: PROCESSING THE MENPO2D IMAGES #
@@ -315,54 +672,20 @@ if __name__ == "__main__":
                                      'mouth': [list(range(27, 39))],
                                      'eyebrow': [list(range(12, 16))]}}
 
-    for split_name, split_data in menpo2D_split_data.items():
-        split_images, split_landmarks = split_data['images'], split_data['landmarks']
-
-        for i, img_path in enumerate(split_images):
-            img_source = os.path.join(path_menpo2D_dataset, split_name.capitalize(), img_path)
-            img_dest = os.path.join(path_processed_images, os.path.basename(img_path))
-            shutil.copy(img_source, img_dest)
-
-            # Detecting if the image is semifrontal (68 landmarks) or profile (39 landmarks)
-            img_landmarks = [float(lmk) for lmk in split_landmarks[i]]
-            x_points, y_points = img_landmarks[14::2], img_landmarks[15::2]
-            img_type = 'profile' if len(x_points) == 39 else 'semifrontal'
-
-            img = cv2.imread(os.path.join(img_source), cv2.IMREAD_COLOR)
-            img_h, img_w = img.shape[:2]
-            img, ratio = smart_resize(img)
-
-            if SHOW_IMAGES:
-                cv2.imshow("Image", img)
-                cv2.waitKey(IMSHOW_WAIT_TIME)
-            print("[Menpo2D] {}: {} landmarks".format(os.path.basename(img_path), len(x_points)))
-
-            img_labels = pd.DataFrame(columns=['class', 'x', 'y', 'w', 'h'])
-            for part_id, part_name in enumerate(use_parts):
-                for idxs in part_points_menpo[img_type][part_name]:
-                    x_points_part = [x_points[j] for j in idxs]
-                    y_points_part = [y_points[j] for j in idxs]
-                    contour = []
-
-                    for x, y in zip(x_points_part, y_points_part):
-                        contour.append([x, y])
-                        img = cv2.circle(img, (int(x * ratio), int(y * ratio)), 3, (0, 255, 255), -1)
-
-                    # Getting the bounding box in YOLO format
-                    x, y, w, h = points_to_yolo(img_labels, contour, part_id, img_h, img_w)
-
-                    # Showing the box
-                    img = cv2.rectangle(img,
-                                        (int(x*ratio), int(y*ratio)),
-                                        (int((x+w)*ratio), int((y+h)*ratio)), (0, 0, 255), 2)
-
-            if SHOW_IMAGES:
-                cv2.imshow("Image", img)
-                cv2.waitKey(IMSHOW_WAIT_TIME)
-
-            label_name = os.path.splitext(os.path.basename(img_path))[0]
-            label_dest = os.path.join(path_processed_labels, "{}.txt".format(label_name))
-            img_labels.round(6).to_csv(label_dest, header=False, index=False, sep=" ")
+    menpo2D_tasks = [(split_name, img_path, landmarks)
+                     for split_name, split_data in menpo2D_split_data.items()
+                     for img_path, landmarks in zip(split_data['images'], split_data['landmarks'])]
+    convert_menpo2D = partial(process_menpo2D_image, path_menpo2D=path_menpo2D_dataset,
+                              path_dest_images=path_processed_images, path_dest_labels=path_processed_labels,
+                              groups={t: part_index_groups(p, use_parts) for t, p in part_points_menpo.items()},
+                              show=SHOW_IMAGES, link_mode=args.link_mode)
+    # The landmarks are not in a file of their own, so they are part of the mapping of each image
+    menpo2D_mapping = mapping_version(part_points_menpo, use_parts)
+    run_cached_jobs(convert_menpo2D, menpo2D_tasks,
+                    keys=[os.path.join(path_menpo2D_dataset, s.capitalize(), p) for s, p, _ in menpo2D_tasks],
+                    mappings=[menpo2D_mapping + ":" + hashlib.sha1(" ".join(lmks).encode()).hexdigest()
+                              for _, _, lmks in menpo2D_tasks],
+                    manifest=manifest, dataset="Menpo2D", jobs=args.jobs)
 
     ######################################
     # PART 5: PREPARING THE LAPA DATASET #
@@ -378,62 +701,31 @@ if __name__ == "__main__":
 
     lapa_train_names = []
     lapa_val_names = []
+    lapa_tasks = []
 
     for split_name in ['train', 'val']:  # we're not using the test set (at least for now)
         path_lapa_images = os.path.join(path_lapa_dataset, split_name, "images")
-        path_lapa_landmarks = os.path.join(path_lapa_dataset, split_name, "landmarks")
         split_images = os.listdir(path_lapa_images)
         if split_name == 'train':
             split_images = [f for f in split_images if not any([n in f for n in exclude_prefix])]
 
         for img_name in split_images:
-
-            img_source = os.path.join(path_lapa_images, img_name)
-            img_dest = os.path.join(path_processed_images, img_name)
-            shutil.copy(img_source, img_dest)
-
-            img = cv2.imread(img_source, cv2.IMREAD_COLOR)
-            img_h, img_w = img.shape[:2]
-            img, ratio = smart_resize(img)
-
-            img_landmarks = os.path.join(path_lapa_landmarks, img_name.split(".")[0] + ".txt")
-            img_labels = pd.DataFrame(columns=['class', 'x', 'y', 'w', 'h'])
-            with open(img_landmarks) as f:
-                lines = [l.rstrip() for l in f.readlines()]
-                num_landmarks = lines[0]
-                lines = lines[1:]  # excluding the first line
-                print("[LaPa] {}: {} landmarks".format(img_name, num_landmarks))
-
-                for part_id, part_name in enumerate(use_parts):
-                    for idxs in part_points_lapa[part_name]:
-                        part_points = [lines[i] for i in idxs]
-                        contour = []
-                        for i, p in enumerate(part_points):
-                            x, y = [float(c) for c in p.split(" ")]
-                            contour.append([x, y])
-                            img = cv2.circle(img, (int(x * ratio), int(y * ratio)), 3, (0, 255, 255), -1)
-
-                        # Getting the bounding box in YOLO format
-                        x, y, w, h = points_to_yolo(img_labels, contour, part_id, img_h, img_w)
-
-                        # Showing the box
-                        img = cv2.rectangle(img,
-                                            (int(x*ratio), int(y*ratio)),
-                                            (int((x+w)*ratio), int((y+h)*ratio)), (0, 0, 255), 2)
-
-                if SHOW_IMAGES:
-                    cv2.imshow("Image", img)
-                    cv2.waitKey(IMSHOW_WAIT_TIME)
-
+            lapa_tasks.append((split_name, img_name))
             label_name = os.path.splitext(img_name)[0]
-            label_dest = os.path.join(path_processed_labels, "{}.txt".format(label_name))
-            img_labels.round(6).to_csv(label_dest, header=False, index=False, sep=" ")
-
             if split_name == 'train':
                 lapa_train_names.append(label_name)
             else:
                 lapa_val_names.append(label_name)
 
+    convert_lapa = partial(process_lapa_image, path_lapa=path_lapa_dataset,
+                           path_dest_images=path_processed_images, path_dest_labels=path_processed_labels,
+                           groups=part_index_groups(part_points_lapa, use_parts), show=SHOW_IMAGES,
+                           link_mode=args.link_mode)
+    run_cached_jobs(convert_lapa, lapa_tasks,
+                    keys=[os.path.join(path_lapa_dataset, s, "images", n) for s, n in lapa_tasks],
+                    mappings=mapping_version(part_points_lapa, use_parts),
+                    manifest=manifest, dataset="LaPa", jobs=args.jobs)
+
     lapa_train_names = pd.DataFrame({0: lapa_train_names})
     lapa_val_names = pd.DataFrame({0: lapa_val_names})
 
@@ -442,6 +734,7 @@ if __name__ == "__main__":
     ##########################################################
 
     fasseg_names = []
+    fasseg_tasks = []
     path_fasseg_annotations = os.path.join(path_fasseg_dataset, "annotations", "obj_train_data")
     path_fasseg_images = os.path.join(path_fasseg_dataset, "images")
     fasseg_labels = os.listdir(path_fasseg_annotations)
@@ -451,13 +744,19 @@ if __name__ == "__main__":
         fasseg_names.append(file_name)
 
         img_name = file_name + ".bmp"
-        img_source = os.path.join(path_fasseg_images, img_name)
-        img_dest = os.path.join(path_processed_images, file_name + ".bmp")
-        shutil.copy(img_source, img_dest)
+        fasseg_tasks.append((os.path.join(path_fasseg_images, img_name),
+                             os.path.join(path_processed_images, file_name + ".bmp"),
+                             os.path.join(path_fasseg_annotations, l),
+                             os.path.join(path_processed_labels, file_name + ".txt")))
+
+    run_cached_jobs(partial(copy_annotated_image, link_mode=args.link_mode), fasseg_tasks,
+                    keys=[t[2] for t in fasseg_tasks], mappings=mapping_version(),
+                    manifest=manifest, dataset="FASSEG", jobs=args.jobs)
 
-        label_source = os.path.join(path_fasseg_annotations, l)
-        label_dest = os.path.join(path_processed_labels, file_name + ".txt")
-        shutil.copy(label_source, label_dest)
+    # Removing the images and labels that are not generated anymore (e.g. deleted or renamed source images)
+    with metrics.span("manifest"):
+        print("Removed {} stale files".format(manifest.remove_stale()))
+        manifest.save()
 
     # Separate the FASSEG dataset in training and validation
     fasseg_splits = pd.read_csv(os.path.join(path_fasseg_dataset, "split_info.csv"))
@@ -471,7 +770,9 @@ if __name__ == "__main__":
     ##################################
 
     # Using the original Helen splits (test will be used for validation) and adding the Pexels and AFW splits
+    # Only the images recorded in the manifest are listed
     skip_helen_ids = [os.path.splitext(s)[0] for s in skip_imgs]
+    built_outputs = manifest.outputs()
 
     train_names = pd.read_csv(os.path.join(path_helen_dataset, 'trainnames.txt'), header=None)
     train_names = pd.concat([train_names,
@@ -480,7 +781,7 @@ if __name__ == "__main__":
                              menpo2D_train_names,
                              lapa_train_names,
                              fasseg_train_names], ignore_index=True)
-    process_names(train_names, "train", path_processed_dataset, path_yolo_data, skip_helen_ids)
+    process_names(train_names, "train", path_processed_dataset, path_yolo_data, skip_helen_ids, built_outputs)
 
     test_names = pd.read_csv(os.path.join(path_helen_dataset, 'testnames.txt'), header=None)
     test_names = pd.concat([test_names,
@@ -489,7 +790,7 @@ if __name__ == "__main__":
                             menpo2D_test_names,
                             lapa_val_names,
                             fasseg_val_names], ignore_index=True)
-    process_names(test_names, "val", path_processed_dataset, path_yolo_data, skip_helen_ids)
+    process_names(test_names, "val", path_processed_dataset, path_yolo_data, skip_helen_ids, built_outputs)
 
     # Creating the YAML file for training
     # Make sure that the class IDs are the same for all datasets! (i.e. 'eye' is class 0 in all datasets)
@@ -501,4 +802,30 @@ if __name__ == "__main__":
                 'names': {i: p for i, p in enumerate(use_parts)}}
         yaml.dump(data, f, default_flow_style=False, sort_keys=False)
 
+    #####################################################
+    # PART 8: PACKING THE SPLITS INTO SHARDS (OPTIONAL) #
+    #####################################################
+
+    if args.shards:
+        path_shards = path_processed_dataset / "shards"
+        for split in ["train", "val"]:
+            with open(path_yolo_images / split / "images.txt") as f:
+                split_images = f.read().splitlines()
+            with open(path_yolo_labels / split / "labels.txt") as f:
+                split_labels = f.read().splitlines()
+            with metrics.span("shards", split=split):
+                n = write_shards(split_images, split_labels, path_shards / split,
+                                 imgsz=args.shard_image_size, workers=max(args.jobs, 4))
+            print("Packed {} {} images into {}".format(n, split, path_shards / split))
+
+        # Same YAML file, but pointing to the shard folders (use it with train.py --shards)
+        with open(path_shards / 'data.yaml', 'w') as f:
+            data = {'path': str(path_shards),
+                    'train': "train",
+                    'val': "val",
+                    'test': '',
+                    'names': {i: p for i, p in enumerate(use_parts)}}
+            yaml.dump(data, f, default_flow_style=False, sort_keys=False)
+
+    save_from_args(args)
     print("\nDone!")
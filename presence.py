@@ -0,0 +1,345 @@
+"""
+Index of the face parts found in each image, built by run.py next to the report (runs/reports/presence)
+For every image (including the ones without detections) it keeps a bitmask of the classes that were found,
+the number of boxes of each class and their maximum confidence. The arrays are stored as .npy files that are
+memory-mapped when the index is opened, next to the sorted table of image names, so that a query is a few
+vectorized comparisons over columns and looking up an image is a binary search, even with millions of images.
+
+    python presence.py -o runs/reports mouth '!eye'          images with a mouth but no eye
+    python presence.py -o runs/reports 'eyebrow>=2' --count  number of images with two or more eyebrows
+    python presence.py -o runs/reports 'nose@0.6'            images with a nose found with confidence >= 0.6
+    python presence.py -o runs/reports --image 12_1.jpg      face parts of an image
+"""
+
+import argparse
+import json
+import operator
+import os
+import re
+import time
+from pathlib import Path
+
+import numpy as np
+
+OPERATORS = {'>=': operator.ge, '<=': operator.le, '==': operator.eq, '=': operator.eq, '>': operator.gt,
+             '<': operator.lt}
+TERM_PATTERN = re.compile(r"^(!)?([^!<>=@]+?)(?:(>=|<=|==|=|>|<)(\d+))?(?:@([0-9.]+))?$")
+
+
+def mask_dtype(n_classes):
+    """
+    :param n_classes: number of classes
+    :return: smallest unsigned integer type with a bit per class
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if n_classes <= np.iinfo(dtype).bits:
+            return dtype
+    raise ValueError("The presence index supports up to 64 classes")
+
+
+def save_index(path, names, counts, max_conf, class_names_dict):
+    """
+    Write a new version of the index: the arrays go to new files, and index.json is replaced last, so readers
+    always see a complete version
+    :param path: index folder
+    :param names: image names, sorted (array of UTF-8 bytes)
+    :param counts: number of boxes of each class in each image, shape (n_classes, n_images)
+    :param max_conf: maximum confidence of each class in each image (0 if not found), shape (n_classes, n_images)
+    :param class_names_dict: dictionary with model's class names {class_id: class_name, ...}
+    :return: None
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    generation = read_meta(path).get('generation', -1) + 1 if (path / "index.json").is_file() else 0
+    counts = np.minimum(counts, np.iinfo(np.uint16).max).astype(np.uint16)
+    bits = (np.uint64(1) << np.arange(len(counts), dtype=np.uint64))[:, None]
+    mask = np.bitwise_or.reduce(np.where(counts > 0, bits, np.uint64(0)), axis=0).astype(mask_dtype(len(counts)))
+
+    arrays = {'names': names, 'mask': mask, 'counts': counts, 'max_conf': max_conf.astype(np.float16)}
+    for key, array in arrays.items():
+        np.save(path / "{}.{}.npy".format(key, generation), np.ascontiguousarray(array))
+    meta = {'generation': generation, 'n_images': len(names),
+            'classes': {str(k): v for k, v in class_names_dict.items()}}
+    with open(path / "index.json.tmp", 'w') as f:
+        json.dump(meta, f)
+    os.replace(path / "index.json.tmp", path / "index.json")
+
+    # Readers that opened the previous version keep their memory maps
+    for f in path.glob("*.npy"):
+        if not f.name.endswith(".{}.npy".format(generation)):
+            f.unlink(missing_ok=True)
+
+
+def read_meta(path):
+    """
+    :param path: index folder
+    :return: dictionary with the current version of the index, its number of images and the class names
+    """
+    with open(Path(path) / "index.json") as f:
+        return json.load(f)
+
+
+def encode_names(names):
+    """
+    :param names: list of image names
+    :return: array of UTF-8 bytes (the sorted name table is compared byte by byte)
+    """
+    return np.array([n.encode('utf-8') for n in names], dtype=bytes) if len(names) else np.empty(0, dtype='S1')
+
+
+class PresenceWriter:
+    """
+    Collects the face parts of the processed images and merges them into the index on disk
+    """
+
+    def __init__(self, path, class_names_dict, append=False, chunk_size=65536):
+        """
+        :param path: index folder
+        :param class_names_dict: dictionary with model's class names {class_id: class_name, ...}
+        :param append: add the images to the existing index instead of replacing it
+        :param chunk_size: number of images kept in memory before merging them into the index
+        """
+        self.path = Path(path)
+        self.class_names_dict = class_names_dict
+        self.n_classes = max(class_names_dict) + 1
+        self.append = append
+        self.chunk_size = chunk_size
+        self._names = []
+        self._counts = np.zeros((chunk_size, self.n_classes), dtype=np.int64)
+        self._max_conf = np.zeros((chunk_size, self.n_classes), dtype=np.float32)
+
+    def add(self, image_name, detections):
+        """
+        :param image_name: image file name
+        :param detections: supervision Detections object (it can be empty)
+        :return: None
+        """
+        i = len(self._names)
+        self._names.append(image_name)
+        self._counts[i] = 0
+        self._max_conf[i] = 0
+        if len(detections):
+            known = detections.class_id < self.n_classes
+            class_id = detections.class_id[known]
+            self._counts[i] = np.bincount(class_id, minlength=self.n_classes)
+            np.maximum.at(self._max_conf[i], class_id, detections.confidence[known])
+        if len(self._names) == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Merge the collected images into the index (an image that is already in it is replaced)
+        :return: None
+        """
+        n = len(self._names)
+        if n == 0 and self.append:
+            return
+        names = encode_names(self._names)
+        # Sorted by name, keeping only the last version of an image that was added twice
+        order = np.argsort(names, kind='stable')
+        names = names[order]
+        last = np.append(names[1:] != names[:-1], True) if n else np.empty(0, dtype=bool)
+        order, names = order[last], names[last]
+        counts, max_conf = self._counts[:n][order].T, self._max_conf[:n][order].T
+
+        if self.append and (self.path / "index.json").is_file():
+            old = PresenceIndex(self.path)
+            old_names = np.asarray(old.names)
+            pos = np.searchsorted(old_names, names)
+            found = pos < len(old_names)
+            found[found] = old_names[pos[found]] == names[found]
+            keep = np.ones(len(old_names), dtype=bool)
+            keep[pos[found]] = False
+            old_names = old_names[keep]
+            pos = np.searchsorted(old_names, names)
+            dtype = np.promote_types(old_names.dtype, names.dtype)
+            names = np.insert(old_names.astype(dtype), pos, names)
+            counts = np.insert(np.asarray(old.counts)[:, keep], pos, counts, axis=1)
+            max_conf = np.insert(np.asarray(old.max_conf)[:, keep], pos, max_conf, axis=1)
+            del old
+        save_index(self.path, names, counts, max_conf, self.class_names_dict)
+        self.append = True  # the next chunks are merged into this one
+        self._names = []
+
+    def close(self):
+        self.flush()
+
+
+class PresenceIndex:
+    """
+    Read-only view of the presence index (memory-mapped)
+    """
+
+    def __init__(self, path):
+        """
+        :param path: index folder
+        """
+        self.path = Path(path)
+        for attempt in range(3):
+            meta = read_meta(self.path)
+            try:
+                arrays = {key: np.load(self.path / "{}.{}.npy".format(key, meta['generation']),
+                                       mmap_mode='r' if meta['n_images'] else None)
+                          for key in ('names', 'mask', 'counts', 'max_conf')}
+                break
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+                time.sleep(0.1)  # replaced by a writer while it was being opened
+        self.names = arrays['names']
+        self.mask = arrays['mask']
+        self.counts = arrays['counts']
+        self.max_conf = arrays['max_conf']
+        self.class_names_dict = {int(k): v for k, v in meta['classes'].items()}
+        self.class_ids = {v: k for k, v in self.class_names_dict.items()}
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, image_name):
+        """
+        :param image_name: image file name
+        :return: dictionary {class_name: (number of boxes, maximum confidence)}, None if the image is not indexed
+        """
+        key = image_name.encode('utf-8')
+        i = int(np.searchsorted(self.names, key))
+        if i == len(self.names) or self.names[i] != key:
+            return None
+        return {name: (int(self.counts[c, i]), round(float(self.max_conf[c, i]), 3))
+                for c, name in self.class_names_dict.items()}
+
+    def parse_term(self, term):
+        """
+        :param term: 'mouth' (found), '!eye' (not found), 'eyebrow>=2' (number of boxes, also <=, ==, >, <)
+                     or 'nose@0.6' (found with confidence >= 0.6)
+        :return: negated, class ID, comparison (or None), number of boxes, minimum confidence (or None)
+        """
+        match = TERM_PATTERN.match(term.strip())
+        if match is None or match.group(2) not in self.class_ids:
+            raise ValueError("Invalid query term '{}' (classes: {})".format(term, ", ".join(self.class_ids)))
+        negated, name, op, count, conf = match.groups()
+        return (negated is not None, self.class_ids[name], OPERATORS[op] if op else None,
+                int(count) if count else None, float(conf) if conf else None)
+
+    def select(self, terms):
+        """
+        :param terms: list of query terms (see parse_term), all of them must be true
+        :return: boolean array with the images that match
+        """
+        required, forbidden = 0, 0
+        selected = np.ones(len(self), dtype=bool)
+        for term in terms:
+            negated, class_id, op, count, conf = self.parse_term(term)
+            if op is None and conf is None:
+                # Plain presence terms are all checked at once on the bitmasks
+                if negated:
+                    forbidden |= 1 << class_id
+                else:
+                    required |= 1 << class_id
+                continue
+            match = np.ones(len(self), dtype=bool)
+            if op is not None:
+                match &= op(self.counts[class_id], count)
+            if conf is not None:
+                match &= self.max_conf[class_id] >= conf
+            selected &= ~match if negated else match
+        if required or forbidden:
+            selected &= (self.mask & self.mask.dtype.type(required | forbidden)) == required
+        return selected
+
+    def query(self, terms, limit=None):
+        """
+        :param terms: list of query terms (see parse_term)
+        :param limit: maximum number of names
+        :return: sorted list of the image names that match
+        """
+        idx = np.flatnonzero(self.select(terms))[:limit]
+        return [name.decode('utf-8') for name in self.names[idx]]
+
+    def class_stats(self):
+        """
+        :return: dictionary {class_name: (images with the class, total number of boxes)}
+        """
+        return {name: (int(np.count_nonzero(self.counts[c])), int(self.counts[c].sum(dtype=np.int64)))
+                for c, name in self.class_names_dict.items()}
+
+
+def build_from_report(path_output):
+    """
+    Build the index of a run.py output folder from its report (for reports written before the index existed)
+    The images without detections are taken from processed.tsv
+    :param path_output: run.py output folder
+    :return: number of indexed images
+    """
+    from reports import read_report
+    from watcher import ProcessedIndex
+
+    path_output = Path(path_output)
+    report = read_report(path_output / "report.csv")
+    # Classes without detections keep the name they had in the previous index
+    class_names_dict = dict(zip(report['class_id'].astype(int), report['detection']))
+    if (path_output / "presence" / "index.json").is_file():
+        class_names_dict = {**{int(k): v for k, v in read_meta(path_output / "presence")['classes'].items()},
+                            **class_names_dict}
+    class_names_dict = {c: class_names_dict.get(c, str(c)) for c in range(max(class_names_dict, default=-1) + 1)}
+    processed = ProcessedIndex(path_output / "processed.tsv").entries
+    names = np.unique(encode_names(sorted(set(processed) | set(report['image_name'].unique()))))
+
+    n_classes = len(class_names_dict)
+    image_idx = np.searchsorted(names, encode_names(report['image_name'].tolist()))
+    flat = report['class_id'].to_numpy(np.int64) * len(names) + image_idx
+    counts = np.bincount(flat, minlength=n_classes * len(names)).reshape(n_classes, len(names))
+    max_conf = np.zeros(n_classes * len(names), dtype=np.float32)
+    np.maximum.at(max_conf, flat, report['confidence'].to_numpy(np.float32))
+    save_index(path_output / "presence", names, counts, max_conf.reshape(n_classes, len(names)), class_names_dict)
+    return len(names)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", '--path_output', type=str, default="runs/reports",
+                        help="Output folder of run.py (the index is in its 'presence' folder)")
+    parser.add_argument('terms', type=str, nargs='*',
+                        help="Query terms, all must be true: 'mouth', '!eye', 'eyebrow>=2', 'nose@0.6'")
+    parser.add_argument('--count', action='store_true', help="Only print the number of matching images")
+    parser.add_argument('--limit', type=int, help="Maximum number of image names to print")
+    parser.add_argument('--image', type=str, help="Print the face parts of this image")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="Build the index again from report.csv and processed.tsv")
+    args = parser.parse_args()
+
+    path_index = Path(args.path_output) / "presence"
+    if args.rebuild:
+        start = time.perf_counter()
+        n_images = build_from_report(args.path_output)
+        print("{} images indexed in {:.2f} s".format(n_images, time.perf_counter() - start))
+    if not (path_index / "index.json").is_file():
+        print("ERROR: No presence index in", args.path_output)
+        exit()
+    index = PresenceIndex(path_index)
+
+    if args.image is not None:
+        parts = index.lookup(args.image)
+        if parts is None:
+            print("ERROR: {} is not in the index".format(args.image))
+            exit()
+        for name, (count, conf) in parts.items():
+            print("{:>12} {:>4} {:>7.3f}".format(name, count, conf))
+    elif args.terms:
+        start = time.perf_counter()
+        try:
+            selected = index.select(args.terms)
+        except ValueError as e:
+            print("ERROR:", e)
+            exit()
+        elapsed = time.perf_counter() - start
+        if args.count:
+            print("{} of {} images match ({:.1f} ms)".format(np.count_nonzero(selected), len(index), 1000 * elapsed))
+        else:
+            for name in index.names[np.flatnonzero(selected)[:args.limit]]:
+                print(name.decode('utf-8'))
+    elif not args.rebuild:
+        print("{} images".format(len(index)))
+        for name, (n_images, n_boxes) in index.class_stats().items():
+            print("{:>12} in {} images ({} boxes)".format(name, n_images, n_boxes))
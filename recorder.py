@@ -0,0 +1,163 @@
+"""
+Bounded recorder for live_demo.py: the frames are encoded on a background thread while the demo runs,
+so memory does not grow with the length of the session
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+import cv2
+
+
+class _GifWriter:
+    """
+    Writes an animated GIF one frame at a time (each frame with its own duration)
+    """
+
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.count = 0
+
+    def write(self, frame, duration):
+        """
+        :param frame: BGR image
+        :param duration: how long the frame is shown (seconds)
+        :return: None
+        """
+        from PIL import Image, GifImagePlugin
+
+        im = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)).quantize(colors=256)
+        duration = max(20, int(round(duration * 1000)))  # most viewers slow down frames shorter than 20 ms
+        if self.count == 0:
+            header, _ = GifImagePlugin.getheader(im, info={'loop': 0, 'duration': duration})
+            for chunk in header:
+                self.f.write(chunk)
+        for chunk in GifImagePlugin.getdata(im, duration=duration, include_color_table=True):
+            self.f.write(chunk)
+        self.count += 1
+
+    def close(self):
+        self.f.write(b";")  # GIF trailer
+        self.f.close()
+
+
+class _VideoWriter:
+    """
+    Writes a constant frame rate video with cv2.VideoWriter: the frames are repeated or skipped
+    according to their timestamps, so the video plays at the same speed as the live demo
+    """
+
+    def __init__(self, path, fps):
+        self.path = str(path)
+        self.fps = fps
+        self.writer = None
+        self.count = 0
+        self.elapsed = 0
+
+    def write(self, frame, duration):
+        """
+        :param frame: BGR image
+        :param duration: how long the frame is shown (seconds)
+        :return: None
+        """
+        if self.writer is None:
+            fourcc = cv2.VideoWriter_fourcc(*("mp4v" if self.path.lower().endswith(".mp4") else "MJPG"))
+            self.writer = cv2.VideoWriter(self.path, fourcc, self.fps, (frame.shape[1], frame.shape[0]))
+        self.elapsed += duration
+        while self.count < round(self.elapsed * self.fps) or self.count == 0:
+            self.writer.write(frame)
+            self.count += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+
+
+class StreamRecorder:
+    """
+    Records the annotated frames of the live demo to a GIF or a video file (.mp4, .avi)
+    The frames go through a bounded queue to a background thread that downscales and encodes them
+    """
+
+    def __init__(self, path, fps=30, scale=1.0, every_n=1, max_seconds=None, queue_size=32):
+        """
+        :param path: output file (.gif, .mp4 or .avi)
+        :param fps: frame rate of the video files (GIF frames keep their real duration)
+        :param scale: resize factor of the recorded frames
+        :param every_n: record one of every N frames
+        :param max_seconds: only keep the last N seconds (written when the recorder is closed), None to keep all
+        :param queue_size: frames waiting to be encoded (if the encoder is slower, new frames are dropped)
+        """
+        self.path = Path(path)
+        self.scale = scale
+        self.every_n = max(1, every_n)
+        self.max_seconds = max_seconds
+        if self.path.suffix.lower() == ".gif":
+            self.writer = _GifWriter(self.path)
+        else:
+            self.writer = _VideoWriter(self.path, fps)
+
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.ring = deque()  # (timestamp, frame) of the last max_seconds
+        self.pending = None  # last frame, written when the next one arrives (that's when its duration is known)
+        self.last_duration = 1 / fps
+        self.n_added = 0
+        self.n_dropped = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, frame, timestamp=None):
+        """
+        Queue a frame to be recorded (it never blocks: if the encoder is behind, the frame is dropped)
+        :param frame: BGR image (it must not be modified afterwards)
+        :param timestamp: capture time in seconds (time.perf_counter() if None)
+        :return: None
+        """
+        self.n_added += 1
+        if (self.n_added - 1) % self.every_n:
+            return
+        try:
+            self.frames.put_nowait((time.perf_counter() if timestamp is None else timestamp, frame))
+        except queue.Full:
+            self.n_dropped += 1
+
+    def _run(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                break
+            timestamp, frame = item
+            if self.scale != 1:
+                frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+            if self.max_seconds is not None:
+                self.ring.append((timestamp, frame))
+                while timestamp - self.ring[0][0] > self.max_seconds:
+                    self.ring.popleft()
+            else:
+                self._write(timestamp, frame)
+
+    def _write(self, timestamp, frame):
+        if self.pending is not None:
+            pending_timestamp, pending_frame = self.pending
+            self.last_duration = timestamp - pending_timestamp
+            self.writer.write(pending_frame, self.last_duration)
+        self.pending = (timestamp, frame)
+
+    def close(self):
+        """
+        Encode the remaining frames and close the file
+        :return: None
+        """
+        self.frames.put(None)
+        self.thread.join()
+        for timestamp, frame in self.ring:
+            self._write(timestamp, frame)
+        self.ring.clear()
+        if self.pending is not None:
+            self.writer.write(self.pending[1], self.last_duration)
+            self.pending = None
+        self.writer.close()
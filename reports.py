@@ -0,0 +1,191 @@
+"""
+Writers for the detection reports generated by run.py
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+REPORT_COLUMNS = ['image_name', 'detection', 'x1', 'y1', 'x2', 'y2', 'confidence', 'class_id']
+REPORT_FORMATS = ['csv', 'parquet', 'feather']
+
+
+def read_report(path):
+    """
+    Load a report written by ReportWriter
+    :param path: path to the report (.csv, .parquet or .feather)
+    :return: dataframe with the REPORT_COLUMNS
+    """
+    path = Path(path)
+    if path.suffix == ".parquet":
+        return pd.read_parquet(path)
+    if path.suffix == ".feather":
+        return pd.read_feather(path)
+    return pd.read_csv(path, dtype={'image_name': str, 'detection': str, 'x1': np.int32, 'y1': np.int32,
+                                    'x2': np.int32, 'y2': np.int32, 'confidence': np.float32, 'class_id': np.int16})
+
+
+class ReportWriter:
+    """
+    Accumulates the detections in preallocated column buffers and writes them to disk in chunks.
+    The CSV file is appended after every chunk, so a crash only loses the last (unflushed) chunk.
+    Parquet and Feather files are written with pyarrow, one row group / record batch per chunk.
+    """
+
+    def __init__(self, path_report, class_names_dict, formats=('csv',), chunk_size=65536, append=False):
+        """
+        :param path_report: path to the report (the extension is replaced for each format)
+        :param class_names_dict: dictionary with model's class names {class_id: class_name, ...}
+        :param formats: list of output formats (csv, parquet, feather)
+        :param chunk_size: number of detections kept in memory before writing them
+        :param append: add the detections to an existing CSV report instead of replacing it
+        """
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive, not {}".format(chunk_size))
+        self.path_report = Path(path_report)
+        self.class_names_dict = class_names_dict
+        self.formats = list(formats)
+        self.chunk_size = chunk_size
+        self.paths = {fmt: self.path_report.with_suffix("." + fmt) for fmt in self.formats}
+
+        # Column buffers (image names are stored as an index to self._names)
+        self._image_idx = np.empty(chunk_size, dtype=np.int64)
+        self._xyxy = np.empty((chunk_size, 4), dtype=np.int32)
+        self._confidence = np.empty(chunk_size, dtype=np.float32)
+        self._class_id = np.empty(chunk_size, dtype=np.int16)
+        self._names = []
+        self._size = 0
+
+        self._csv_header = True
+        self._arrow_writers = {}
+        for fmt in self.formats:
+            if fmt not in REPORT_FORMATS:
+                raise ValueError("Unknown report format: {}".format(fmt))
+            if append and fmt != 'csv':
+                raise ValueError("Only CSV reports can be appended to, not {}".format(fmt))
+        if 'csv' in self.formats:
+            if append and self.paths['csv'].is_file() and self.paths['csv'].stat().st_size > 0:
+                self._csv_header = False
+            else:
+                self.paths['csv'].unlink(missing_ok=True)
+
+    def add(self, image_name, detections):
+        """
+        Add all the detections of an image to the report
+        :param image_name: image file name
+        :param detections: supervision Detections object
+        :return: None
+        """
+        n = len(detections)
+        if n == 0:
+            return
+
+        image_idx = len(self._names)
+        self._names.append(image_name)
+        xyxy = detections.xyxy.astype(np.int32)
+        confidence = detections.confidence if detections.confidence is not None else np.full(n, np.nan)
+        start = 0
+        while start < n:
+            # An image may not fit in what is left of the buffers, so it can span two chunks
+            count = min(n - start, self.chunk_size - self._size)
+            end = self._size + count
+            self._image_idx[self._size:end] = image_idx
+            self._xyxy[self._size:end] = xyxy[start:start + count]
+            self._confidence[self._size:end] = confidence[start:start + count]
+            self._class_id[self._size:end] = detections.class_id[start:start + count]
+            self._size = end
+            start += count
+            if self._size == self.chunk_size:
+                self.flush()
+                if start < n:
+                    image_idx = len(self._names)
+                    self._names.append(image_name)
+
+    def _chunk(self):
+        """
+        Build a dataframe with the buffered detections
+        :return: dataframe with the REPORT_COLUMNS
+        """
+        n = self._size
+        class_id = self._class_id[:n]
+        names = np.array(self._names, dtype=object)
+        return pd.DataFrame({'image_name': names[self._image_idx[:n]],
+                             'detection': pd.Series(class_id).map(self.class_names_dict).to_numpy(),
+                             'x1': self._xyxy[:n, 0],
+                             'y1': self._xyxy[:n, 1],
+                             'x2': self._xyxy[:n, 2],
+                             'y2': self._xyxy[:n, 3],
+                             'confidence': self._confidence[:n],
+                             'class_id': class_id}, columns=REPORT_COLUMNS)
+
+    def flush(self):
+        """
+        Write the buffered detections to disk and empty the buffers
+        :return: None
+        """
+        if self._size == 0:
+            return
+
+        chunk = self._chunk()
+        if 'csv' in self.formats:
+            with open(self.paths['csv'], 'a', newline='') as f:
+                chunk.to_csv(f, header=self._csv_header, index=False, float_format="%.4f")
+            self._csv_header = False
+
+        for fmt in self.formats:
+            if fmt != 'csv':
+                self._write_arrow(fmt, chunk)
+
+        self._size = 0
+        self._names = []
+
+    def _write_arrow(self, fmt, chunk):
+        """
+        Append a chunk to a Parquet or Feather file
+        :param fmt: 'parquet' or 'feather'
+        :param chunk: dataframe with the detections
+        :return: None
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.ipc
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing {} reports requires pyarrow (pip install pyarrow)".format(fmt))
+
+        # Explicit schema, so that an empty chunk has the same column types as the others
+        schema = pa.schema([('image_name', pa.string()), ('detection', pa.string()), ('x1', pa.int32()),
+                            ('y1', pa.int32()), ('x2', pa.int32()), ('y2', pa.int32()),
+                            ('confidence', pa.float32()), ('class_id', pa.int16())])
+        table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+        if fmt not in self._arrow_writers:
+            if fmt == 'parquet':
+                self._arrow_writers[fmt] = pq.ParquetWriter(self.paths[fmt], table.schema)
+            else:
+                # Feather V2 is the Arrow IPC file format, which can be written batch by batch
+                self._arrow_writers[fmt] = pa.ipc.new_file(self.paths[fmt], table.schema)
+        self._arrow_writers[fmt].write_table(table)
+
+    def close(self):
+        """
+        Flush the remaining detections and close the output files
+        :return: None
+        """
+        self.flush()
+        if 'csv' in self.formats and self._csv_header:
+            # No detections at all: still write an empty report with the header
+            pd.DataFrame(columns=REPORT_COLUMNS).to_csv(self.paths['csv'], index=False)
+        for fmt in self.formats:
+            if fmt != 'csv' and fmt not in self._arrow_writers:
+                self._write_arrow(fmt, self._chunk())  # same for Parquet and Feather: an empty table
+        for writer in self._arrow_writers.values():
+            writer.close()
+        self._arrow_writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -7,11 +7,19 @@ Author: Ignacio Hernández Montilla, 2023
 import os
 from pathlib import Path
 import argparse
+import dataclasses
 
-import pandas as pd
-from ultralytics import YOLO
 import supervision as spv
 from utils import *
+from annotation import add_annotation_args, annotators_from_args
+from backends import add_backend_args, backend_from_args
+from inference import iter_image_batches
+from metrics import metrics, add_metrics_args, enable_from_args, save_from_args
+from reports import ReportWriter, REPORT_FORMATS
+from tiling import TiledPredictor, MERGE_METHODS
+from cascade import add_cascade_args, cascade_from_args
+from watcher import ProcessedIndex, file_entries, watch
+from presence import PresenceWriter
 
 
 if __name__ == "__main__":
@@ -22,48 +30,136 @@ if __name__ == "__main__":
     parser.add_argument("-o", '--path_output', type=str, default="runs/reports", help="The output will be saved here")
     parser.add_argument("--show", action="store_true", help="Show the predictions")
     parser.add_argument("--frame_time", type=int, default=30, help="Duration (ms) of each frame")
+    parser.add_argument("-b", '--batch_size', type=int, default=1, help="Number of images per inference call")
+    parser.add_argument("-w", '--workers', type=int, default=4, help="Number of threads decoding images in advance")
+    parser.add_argument("-f", '--formats', type=str, nargs='+', default=['csv'], choices=REPORT_FORMATS,
+                        help="Report formats (parquet and feather need pyarrow)")
+    parser.add_argument('--chunk_size', type=int, default=65536,
+                        help="Number of detections kept in memory before writing them to the report")
+    parser.add_argument('--tiles', action='store_true',
+                        help="Run large images in overlapping tiles at full resolution (finds smaller faces)")
+    parser.add_argument('--tile_size', type=int, default=640, help="Tile side (pixels of the original image)")
+    parser.add_argument('--tile_overlap', type=float, default=0.2, help="Overlap between tiles (fraction of a tile)")
+    parser.add_argument('--tile_merge', type=str, default='nms', choices=MERGE_METHODS,
+                        help="How the boxes of different tiles are merged")
+    parser.add_argument('--tile_iou', type=float, default=0.5, help="IoU threshold used to merge the boxes")
+    parser.add_argument('--tile_batch', type=int, default=16, help="Maximum number of tiles per inference call")
+    parser.add_argument('--no_coarse', action='store_true',
+                        help="Run every tile instead of skipping the ones without faces in a first pass")
+    parser.add_argument('--coarse_conf', type=float, default=0.05,
+                        help="Confidence threshold of the first pass (a tile is run if it has a detection above it)")
+    parser.add_argument('--watch', action='store_true',
+                        help="Keep watching the folder and append the detections of new images to the report")
+    parser.add_argument('--watch_interval', type=float, default=2.0, help="Seconds between two scans of the folder")
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help="Wait until a new file has not changed for this many seconds (it may be uploading)")
+    parser.add_argument('--recheck_interval', type=float, default=60.0,
+                        help="Seconds between two scans that also look for changed images (0 to never do it)")
+    add_annotation_args(parser)
+    add_cascade_args(parser)
+    add_backend_args(parser)
+    add_metrics_args(parser)
     args = parser.parse_args()
+    enable_from_args(args)
 
     # Loading the model
     try:
-        path_model = Path(args.path_model)
-        model = YOLO(path_model)
+        model = backend_from_args(args)
     except FileNotFoundError:
         print("ERROR: Could not load the YOLO model")
         exit()
+    if args.tiles and args.cascade:
+        print("ERROR: --tiles and --cascade cannot be used together")
+        exit()
+    if args.chunk_size <= 0:
+        print("ERROR: --chunk_size must be positive")
+        exit()
+    if args.watch and args.formats != ['csv']:
+        print("ERROR: --watch can only append to CSV reports")
+        exit()
+    model = cascade_from_args(model, args)
+    if args.tiles:
+        model = TiledPredictor(model, tile_size=args.tile_size, overlap=args.tile_overlap, merge=args.tile_merge,
+                               iou=args.tile_iou, batch_size=args.tile_batch, coarse=not args.no_coarse,
+                               coarse_conf=args.coarse_conf)
 
     # Get the results
     if args.path_data:
         path_output = Path(args.path_output)
         path_output.mkdir(exist_ok=True, parents=True)
         path_report = path_output / "report.csv"
-        report = pd.DataFrame(columns=['image_name', 'detection', 'x1', 'y1', 'x2', 'y2'])
+
+        # Images already in the report (a new report starts a new index, and --watch continues the previous one)
+        index = ProcessedIndex(path_output / "processed.tsv",
+                               reset=not (args.watch and path_report.is_file()))
 
         class_colors = spv.ColorPalette.from_hex(['#ffff66', '#66ffcc', '#ff99ff', '#ffcc99'])
-        class_names_dict = model.model.names
-        bbox_annotator = spv.BoundingBoxAnnotator(thickness=2, color=class_colors)
-        label_annotator = spv.LabelAnnotator(color=class_colors, text_color=spv.Color.from_hex("#000000"))
-
-        for f in os.listdir(args.path_data):
-            img = cv2.imread(os.path.join(args.path_data, f))
-            img, _ = smart_resize(img, new_size=640)
-            result = model(img, agnostic_nms=True, verbose=False)[0]
-            detections = spv.Detections.from_ultralytics(result)
-
-            for i, bbox in enumerate(detections.xyxy):
-                x1, y1, x2, y2 = bbox.astype(int)
-                label = class_names_dict[detections.class_id[i]]
-                report.loc[len(report), :] = [f, label, x1, y1, x2, y2]
-
-            if args.show:
-                img = annotate_frame(img, detections, bbox_annotator, label_annotator, class_names_dict)
-                cv2.imshow("Face parts", img)
-                k = cv2.waitKey(args.frame_time)
+        class_names_dict = model.names
+        report = ReportWriter(path_report, class_names_dict, formats=args.formats, chunk_size=args.chunk_size,
+                              append=len(index) > 0)
+        presence = PresenceWriter(path_output / "presence", class_names_dict, append=len(index) > 0)
+        bbox_annotator, label_annotator = annotators_from_args(class_colors, args)
+
+        def process(file_names):
+            # Images are decoded in the background while the model runs on the previous batch
+            # (the backend letterboxes them, so they are only resized once, and tiles and face regions are run at
+            # the full resolution)
+            batches = iter_image_batches(args.path_data, file_names,
+                                         batch_size=args.batch_size, workers=args.workers,
+                                         min_size=None if args.tiles or args.cascade else args.imgsz)
+            for names, imgs, scales in batches:
+                with metrics.span("inference"):
+                    batch_detections = model.predict(imgs)
+
+                for f, img, scale, detections in zip(names, imgs, scales, batch_detections):
+                    metrics.count_detections(detections, class_names_dict)
+                    if args.show:
+                        with metrics.span("annotate"):
+                            img, ratio = smart_resize(img, new_size=640)
+                            shown = dataclasses.replace(detections, xyxy=detections.xyxy * ratio)
+                            img = annotate_frame(img, shown, bbox_annotator, label_annotator, class_names_dict)
+                        cv2.imshow("Face parts", img)
+                        k = cv2.waitKey(args.frame_time)
+
+                    # The report is in the pixel coordinates of the original image
+                    detections.xyxy = detections.xyxy * np.array(scale * 2, dtype=np.float32)
+                    with metrics.span("report"):
+                        report.add(f, detections)
+                        presence.add(f, detections)  # also the images without detections
+
+        try:
+            if args.watch:
+                def process_new(file_names):
+                    process(file_names)
+                    report.flush()  # the detections are on disk before the images are added to the index
+                    presence.flush()
+
+                print("Watching {} (Ctrl+C to stop)".format(args.path_data))
+                n_new = watch(args.path_data, index, process_new, interval=args.watch_interval, settle=args.settle,
+                              recheck_interval=args.recheck_interval or None)
+                print("{} new images processed".format(n_new))
+            else:
+                file_names = os.listdir(args.path_data)
+                process(file_names)
+                report.flush()
+                presence.flush()
+                index.add(file_entries(args.path_data, file_names))
+        finally:
+            # Whatever happens, the detections found so far are written to disk
+            with metrics.span("report"):
+                report.close()
+                presence.close()
+            save_from_args(args)
 
         if args.show:
             cv2.destroyAllWindows()
-        report.to_csv(path_report, index=False)
-        print("Report saved to ", str(path_report))
+        if args.tiles:
+            print("{} tiles processed, {} skipped by the first pass".format(model.n_tiles, model.n_skipped))
+        if args.cascade:
+            print("{} face regions processed".format(model.n_regions))
+        for path in report.paths.values():
+            print("Report saved to ", str(path))
+        print("Face part index saved to ", str(presence.path))
     else:
         print("ERROR: No data folder (path_data) provided")
         exit()
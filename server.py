@@ -0,0 +1,250 @@
+"""
+This script keeps a YOLO model loaded and serves it over HTTP on the local machine
+
+    POST /predict   image in the body (raw bytes) or one or more images in a multipart/form-data form
+    GET  /health    status of the model and of the batching queue
+    GET  /metrics   request, queue and inference latencies in the Prometheus text format
+
+Concurrent requests are collected into micro-batches: the first request of a batch waits at most --max_wait_ms
+for others to arrive, and the whole batch goes through the model in a single call.
+Only the Python standard library is used for the server, so nothing else has to be installed.
+"""
+
+from concurrent.futures import Future
+from email.parser import BytesParser
+from email.policy import default as email_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from backends import add_backend_args, backend_from_args
+from metrics import metrics, DEPTH_BUCKETS
+
+
+class MicroBatcher(threading.Thread):
+    """
+    Collects the images of concurrent requests and runs them through the model in batches
+    """
+
+    def __init__(self, predict_fn, max_batch=8, max_wait=0.01):
+        """
+        :param predict_fn: function that takes a list of images and returns a list of detections
+        :param max_batch: maximum number of images per inference call
+        :param max_wait: how long (seconds) the first image of a batch waits for others
+        """
+        super().__init__(daemon=True)
+        self.predict_fn = predict_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.n_batches = 0
+        self.n_images = 0
+        self.stopped = threading.Event()
+
+    def submit(self, image):
+        """
+        :param image: BGR image
+        :return: concurrent.futures.Future with the supervision.Detections of the image
+        """
+        future = Future()
+        self.requests.put((time.perf_counter(), image, future))
+        return future
+
+    def _collect(self):
+        try:
+            batch = [self.requests.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while not self.stopped.is_set():
+            batch = self._collect()
+            if not batch:
+                continue
+            start = time.perf_counter()
+            for t_submit, _, _ in batch:
+                metrics.record_span("queue_wait", t_submit, start - t_submit)
+            metrics.observe("batch_size", len(batch), buckets=DEPTH_BUCKETS)
+            metrics.observe("queue_depth", self.requests.qsize(), buckets=DEPTH_BUCKETS)
+
+            try:
+                with metrics.span("inference"):
+                    detections = self.predict_fn([image for _, image, _ in batch])
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.n_batches += 1
+            self.n_images += len(batch)
+            for (_, _, future), det in zip(batch, detections):
+                future.set_result(det)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def detections_to_json(detections, class_names_dict, img_shape):
+    """
+    :param detections: supervision Detections object
+    :param class_names_dict: dictionary with model's class names {class_id: class_name, ...}
+    :param img_shape: shape of the image
+    :return: JSON-serializable dictionary
+    """
+    return {
+        "width": int(img_shape[1]),
+        "height": int(img_shape[0]),
+        "detections": [
+            {"class_id": int(class_id), "class_name": class_names_dict[int(class_id)],
+             "confidence": round(float(confidence), 4), "box": [round(float(v), 1) for v in xyxy]}
+            for xyxy, confidence, class_id in zip(detections.xyxy, detections.confidence, detections.class_id)
+        ],
+    }
+
+
+def parse_images(body, content_type):
+    """
+    :param body: request body
+    :param content_type: Content-Type header
+    :return: list of (name, encoded image bytes)
+    """
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=email_policy).parsebytes(
+            b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        return [(part.get_filename() or part.get_param("name", header="content-disposition"),
+                 part.get_payload(decode=True)) for part in message.iter_parts()]
+    return [(None, body)]
+
+
+def make_handler(batcher, class_names_dict, model_name, max_body, timeout):
+    """
+    :param batcher: MicroBatcher
+    :param class_names_dict: dictionary with model's class names {class_id: class_name, ...}
+    :param model_name: shown by /health
+    :param max_body: maximum request size (bytes)
+    :param timeout: maximum time (seconds) a request waits for its detections
+    :return: BaseHTTPRequestHandler subclass
+    """
+    started = time.time()
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send(self, code, body, content_type="application/json"):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode() if content_type == "application/json" else body.encode()
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            metrics.count("responses", code=code)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send(200, {"status": "ok" if batcher.is_alive() else "error", "model": model_name,
+                                 "classes": class_names_dict, "uptime_seconds": round(time.time() - started, 1),
+                                 "queue_depth": batcher.requests.qsize(), "batches": batcher.n_batches,
+                                 "images": batcher.n_images})
+            elif self.path == "/metrics":
+                self._send(200, metrics.prometheus_text(), "text/plain; version=0.0.4")
+            else:
+                self._send(404, {"error": "unknown path " + self.path})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send(404, {"error": "unknown path " + self.path})
+                return
+            with metrics.span("request"):
+                length = int(self.headers.get("Content-Length", 0))
+                if length <= 0:
+                    self._send(400, {"error": "empty request"})
+                    return
+                if length > max_body:
+                    self._send(413, {"error": "request larger than {} bytes".format(max_body)})
+                    return
+
+                with metrics.span("decode"):
+                    files = parse_images(self.rfile.read(length), self.headers.get("Content-Type", ""))
+                    images = [cv2.imdecode(np.frombuffer(data or b"", np.uint8), cv2.IMREAD_COLOR)
+                              for _, data in files]
+                bad = [name or str(i) for i, ((name, _), img) in enumerate(zip(files, images)) if img is None]
+                if not files or bad:
+                    self._send(400, {"error": "could not decode the images", "images": bad})
+                    return
+
+                # Every image goes into the shared queue, so the images of one request can be batched with others
+                futures = [batcher.submit(img) for img in images]
+                try:
+                    results = [detections_to_json(f.result(timeout), class_names_dict, img.shape)
+                               for f, img in zip(futures, images)]
+                except Exception as e:
+                    self._send(500, {"error": str(e) or type(e).__name__})
+                    return
+                for (name, _), result in zip(files, results):
+                    result["name"] = name
+                    metrics.count("detections", len(result["detections"]))
+
+            if len(results) == 1 and files[0][0] is None:
+                self._send(200, results[0])
+            else:
+                self._send(200, {"images": results})
+
+        def log_message(self, format, *args):
+            pass  # one line per request would flood the console
+
+    return Handler
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", '--path_model', type=str, help="Path to the model")
+    parser.add_argument('--host', type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument('--port', type=int, default=8000, help="Port to listen on")
+    parser.add_argument('--max_batch', type=int, default=8, help="Maximum number of images per inference call")
+    parser.add_argument('--max_wait_ms', type=float, default=10,
+                        help="How long the first image of a batch waits for other requests")
+    parser.add_argument('--max_body_mb', type=float, default=32, help="Maximum request size (MB)")
+    parser.add_argument('--timeout', type=float, default=30, help="Maximum time a request waits for its detections")
+    add_backend_args(parser)
+    args = parser.parse_args()
+    metrics.enable()
+
+    # Loading the model (it stays loaded while the server runs)
+    try:
+        print("Loading the model")
+        model = backend_from_args(args)
+    except FileNotFoundError:
+        print("ERROR: Could not load the YOLO model")
+        exit()
+
+    # Warming up, so the first request does not pay for the lazy initialization of the backend
+    model.predict([np.zeros((args.imgsz, args.imgsz, 3), dtype=np.uint8)])
+
+    batcher = MicroBatcher(model.predict, max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000)
+    batcher.start()
+    handler = make_handler(batcher, model.names, args.path_model, int(args.max_body_mb * 1024 * 1024), args.timeout)
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    print("Serving on http://{}:{} (POST /predict, GET /health, GET /metrics)".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
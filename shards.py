@@ -0,0 +1,147 @@
+"""
+Packed training shards: all the (pre-resized, encoded) images of a split in one large file plus an index,
+and all the YOLO boxes in a single NumPy array. Reading them avoids opening thousands of small files every epoch.
+
+Each shard folder contains:
+    - images.bin: encoded images, one after the other
+    - index.npz: image names, byte offsets of each image in images.bin, original image shapes,
+                 YOLO boxes (class, x, y, w, h) of all images and the offsets of the boxes of each image
+"""
+
+import math
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+
+def _encode_image(path, imgsz, ext, quality):
+    """
+    Read an image, resize its long side to imgsz (like Ultralytics does) and encode it
+    :param path: path to the image
+    :param imgsz: training image size
+    :param ext: encoding format ('.jpg' or '.png')
+    :param quality: JPEG quality
+    :return: encoded bytes, original (height, width)
+    """
+    im = cv2.imread(str(path), cv2.IMREAD_COLOR)
+    if im is None:
+        raise FileNotFoundError("Image Not Found {}".format(path))
+
+    h0, w0 = im.shape[:2]
+    r = imgsz / max(h0, w0)
+    if r < 1:  # only downsizing, images smaller than imgsz are stored as they are
+        w, h = min(math.ceil(w0 * r), imgsz), min(math.ceil(h0 * r), imgsz)
+        im = cv2.resize(im, (w, h), interpolation=cv2.INTER_AREA)
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if ext == '.jpg' else []
+    ok, buf = cv2.imencode(ext, im, params)
+    if not ok:
+        raise ValueError("Could not encode {}".format(path))
+    return buf.tobytes(), (h0, w0)
+
+
+def _read_labels(path):
+    """
+    :param path: path to a YOLO label file
+    :return: array of labels (class, x, y, w, h), empty if the file does not exist
+    """
+    if not Path(path).is_file():
+        return np.zeros((0, 5), dtype=np.float32)
+    return np.loadtxt(path, dtype=np.float32, ndmin=2).reshape(-1, 5)
+
+
+def write_shards(image_files, label_files, path_out, imgsz=640, ext='.jpg', quality=95, workers=8):
+    """
+    Pack the images and labels of a split into a shard folder
+    :param image_files: list of image paths
+    :param label_files: list of label paths (same order as image_files)
+    :param path_out: output folder
+    :param imgsz: training image size (the images are stored with their long side resized to it)
+    :param ext: image encoding ('.jpg' is smaller, '.png' is lossless)
+    :param quality: JPEG quality
+    :param workers: number of threads used to decode and encode the images
+    :return: number of packed images
+    """
+    path_out = Path(path_out)
+    path_out.mkdir(parents=True, exist_ok=True)
+
+    n = len(image_files)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    shapes = np.zeros((n, 2), dtype=np.int32)
+    box_offsets = np.zeros(n + 1, dtype=np.int64)
+    boxes = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool, open(path_out / "images.bin", 'wb') as f:
+        encoded = pool.map(lambda p: _encode_image(p, imgsz, ext, quality), image_files)
+        for i, ((buf, shape), label_file) in enumerate(zip(encoded, label_files)):
+            f.write(buf)
+            offsets[i + 1] = offsets[i] + len(buf)
+            shapes[i] = shape
+            labels = _read_labels(label_file)
+            boxes.append(labels)
+            box_offsets[i + 1] = box_offsets[i] + len(labels)
+
+    boxes = np.concatenate(boxes) if boxes else np.zeros((0, 5), dtype=np.float32)
+    np.savez(path_out / "index.npz",
+             im_files=np.array([str(p) for p in image_files]),
+             offsets=offsets, shapes=shapes, boxes=boxes, box_offsets=box_offsets)
+    return n
+
+
+def is_shard_dir(path):
+    """
+    :param path: any path
+    :return: True if it is a shard folder
+    """
+    return isinstance(path, (str, Path)) and (Path(path) / "index.npz").is_file()
+
+
+class ShardReader:
+    """
+    Random access to the images and labels of a shard folder
+    The images file is memory-mapped, so only the bytes of the requested images are read
+    """
+
+    def __init__(self, path):
+        """
+        :param path: shard folder
+        """
+        self.path = Path(path)
+        with np.load(self.path / "index.npz") as index:
+            self.im_files = index['im_files'].tolist()
+            self.offsets = index['offsets']
+            self.shapes = index['shapes']
+            self.boxes = index['boxes']
+            self.box_offsets = index['box_offsets']
+        self._blob = None
+
+    @property
+    def blob(self):
+        # Opened on first use, so that every DataLoader worker maps the file on its own
+        if self._blob is None:
+            self._blob = np.memmap(self.path / "images.bin", dtype=np.uint8, mode='r')
+        return self._blob
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_blob'] = None  # pickling a memmap would copy the whole file
+        return state
+
+    def __len__(self):
+        return len(self.im_files)
+
+    def image(self, i):
+        """
+        :param i: image index
+        :return: decoded BGR image (resized when the shard was written)
+        """
+        buf = self.blob[self.offsets[i]:self.offsets[i + 1]]
+        return cv2.imdecode(np.asarray(buf), cv2.IMREAD_COLOR)
+
+    def labels(self, i):
+        """
+        :param i: image index
+        :return: array of labels (class, x, y, w, h) of the image
+        """
+        return self.boxes[self.box_offsets[i]:self.box_offsets[i + 1]]
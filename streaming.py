@@ -0,0 +1,459 @@
+"""
+Threaded capture / inference / display pipeline for live_demo.py (one source) and multi_stream.py (many sources)
+Each stage runs on its own thread and the stages are connected by bounded queues that drop stale frames,
+so the latency follows the slowest stage instead of the sum of all of them.
+"""
+
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from metrics import metrics, DEPTH_BUCKETS
+
+
+class SyntheticSource:
+    """
+    Frame source with the same interface as cv2.VideoCapture (read/release) that draws moving shapes
+    Useful to test the pipeline without a camera
+    """
+
+    def __init__(self, width=640, height=480, n_frames=300, fps=30):
+        """
+        :param width: frame width
+        :param height: frame height
+        :param n_frames: number of frames before the source ends (None for an endless source)
+        :param fps: frames per second (0 to return the frames as fast as possible)
+        """
+        self.width, self.height = width, height
+        self.n_frames = n_frames
+        self.period = 1 / fps if fps else 0
+        self.count = 0
+        self.next_time = time.perf_counter()
+
+    def read(self):
+        if self.n_frames is not None and self.count >= self.n_frames:
+            return False, None
+        if self.period:
+            delay = self.next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_time = max(self.next_time, time.perf_counter() - self.period) + self.period
+
+        t = self.count
+        frame = np.full((self.height, self.width, 3), 40, dtype=np.uint8)
+        cx = int((0.5 + 0.3 * np.sin(t / 20)) * self.width)
+        cy = int((0.5 + 0.2 * np.cos(t / 30)) * self.height)
+        cv2.ellipse(frame, (cx, cy), (80, 110), 0, 0, 360, (150, 180, 220), -1)
+        cv2.circle(frame, (cx - 30, cy - 30), 10, (60, 40, 30), -1)
+        cv2.circle(frame, (cx + 30, cy - 30), 10, (60, 40, 30), -1)
+        cv2.ellipse(frame, (cx, cy + 45), (30, 10), 0, 0, 360, (60, 60, 180), -1)
+        self.count += 1
+        return True, frame
+
+    def isOpened(self):
+        return True
+
+    def get(self, prop):
+        return {cv2.CAP_PROP_FPS: 1 / self.period if self.period else 0,
+                cv2.CAP_PROP_FRAME_WIDTH: self.width,
+                cv2.CAP_PROP_FRAME_HEIGHT: self.height}.get(prop, 0)
+
+    def release(self):
+        pass
+
+
+class PacedSource:
+    """
+    Wraps a video file so that it gives its frames at the video frame rate, like a camera would
+    """
+
+    def __init__(self, cap):
+        """
+        :param cap: cv2.VideoCapture of a video file
+        """
+        self.cap = cap
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        self.period = 1 / fps if fps and fps > 0 else 1 / 30
+        self.next_time = time.perf_counter()
+
+    def read(self):
+        delay = self.next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_time = max(self.next_time, time.perf_counter() - self.period) + self.period
+        return self.cap.read()
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def release(self):
+        self.cap.release()
+
+
+def open_source(source, paced=False):
+    """
+    Open a camera, a video file, a stream URL (e.g. rtsp://...) or a synthetic source
+    :param source: camera ID (int or digit string), path to a video file, URL or "synthetic"
+    :param paced: give the frames of video files at their frame rate instead of as fast as they are decoded
+                  (to use them as stand-ins for cameras)
+    :return: object with the cv2.VideoCapture interface
+    """
+    if isinstance(source, str) and source == "synthetic":
+        return SyntheticSource()
+    if isinstance(source, str) and source.isdigit():
+        source = int(source)
+    cap = cv2.VideoCapture(source)
+    if paced and isinstance(source, str) and "://" not in source:
+        return PacedSource(cap)
+    return cap
+
+
+def is_live_source(cap):
+    """
+    :param cap: object with the cv2.VideoCapture interface (see open_source)
+    :return: True for cameras and stream URLs, False for video files and synthetic sources, which have an end
+    """
+    if isinstance(cap, (SyntheticSource, PacedSource)):
+        return False
+    return cap.get(cv2.CAP_PROP_FRAME_COUNT) <= 0  # cameras and streams do not know their number of frames
+
+
+def put_latest(q, item):
+    """
+    Put an item in a bounded queue, dropping the oldest items if it is full
+    :param q: queue.Queue with maxsize > 0
+    :param item: item to put
+    :return: number of dropped items
+    """
+    dropped = 0
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except queue.Full:
+            try:
+                q.get_nowait()
+                dropped += 1
+            except queue.Empty:
+                pass
+
+
+class StageTimes:
+    """
+    Thread-safe record of the duration of each pipeline stage (also sent to metrics.py, if it is enabled)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+        self.counters = {}
+
+    def add(self, stage, seconds, start=None):
+        with self.lock:
+            self.times.setdefault(stage, []).append(seconds)
+        metrics.record_span(stage, time.perf_counter() - seconds if start is None else start, seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        metrics.count(name, n)
+
+    def summary(self):
+        """
+        :return: text with the mean / p50 / p95 (ms) of each stage and the counters
+        """
+        with self.lock:
+            lines = []
+            for stage, times in self.times.items():
+                t = np.array(times) * 1000
+                lines.append("{:>10}: mean {:7.2f} ms | p50 {:7.2f} ms | p95 {:7.2f} ms | {} frames".format(
+                    stage, t.mean(), np.percentile(t, 50), np.percentile(t, 95), len(t)))
+            for name, n in self.counters.items():
+                lines.append("{:>10}: {}".format(name, n))
+        return "\n".join(lines)
+
+
+class CaptureThread(threading.Thread):
+    """
+    Reads frames as fast as the source gives them and keeps only the latest one
+    """
+
+    def __init__(self, cap, stage_times, maxsize=1, ready=None, retry_timeout=5.0):
+        """
+        :param cap: object with the cv2.VideoCapture interface
+        :param stage_times: StageTimes
+        :param maxsize: number of frames kept for the next stage
+        :param ready: threading.Event that is set after every new frame (shared by the streams of a scheduler)
+        :param retry_timeout: cameras and streams can fail to give a frame now and then, so they are only
+                              considered finished after failing for this long (seconds). Video files end
+                              at their first failed read
+        """
+        super().__init__(daemon=True)
+        self.cap = cap
+        self.live = is_live_source(cap)
+        self.retry_timeout = retry_timeout
+        self.stage_times = stage_times
+        self.ready = ready
+        self.frames = queue.Queue(maxsize=maxsize)
+        self.stopped = threading.Event()
+        self.finished = threading.Event()
+
+    def run(self):
+        frame_id = 0
+        last_frame = time.perf_counter()
+        while not self.stopped.is_set():
+            start = time.perf_counter()
+            frame_ok, frame = self.cap.read()
+            if not frame_ok:
+                if not self.live or start - last_frame > self.retry_timeout:
+                    break
+                self.stage_times.count("read_failures")
+                time.sleep(0.01)
+                continue
+            t_capture = last_frame = time.perf_counter()
+            self.stage_times.add("capture", t_capture - start, start)
+            self.stage_times.count("dropped_frames", put_latest(self.frames, (frame_id, t_capture, frame)))
+            metrics.observe("capture_queue_depth", self.frames.qsize(), buckets=DEPTH_BUCKETS)
+            if self.ready is not None:
+                self.ready.set()
+            frame_id += 1
+        self.finished.set()
+        if self.ready is not None:
+            self.ready.set()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class InferenceThread(threading.Thread):
+    """
+    Runs the detector on the latest captured frame and passes the results to the render stage
+    """
+
+    def __init__(self, capture, detect_fn, stage_times, maxsize=1):
+        """
+        :param capture: CaptureThread
+        :param detect_fn: function that takes a frame and returns its detections
+        :param stage_times: StageTimes
+        :param maxsize: number of results kept for the render stage
+        """
+        super().__init__(daemon=True)
+        self.capture = capture
+        self.detect_fn = detect_fn
+        self.stage_times = stage_times
+        self.results = queue.Queue(maxsize=maxsize)
+        self.stopped = threading.Event()
+        self.finished = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                frame_id, t_capture, frame = self.capture.frames.get(timeout=0.05)
+            except queue.Empty:
+                if self.capture.finished.is_set() and self.capture.frames.empty():
+                    break
+                continue
+
+            start = time.perf_counter()
+            detections = self.detect_fn(frame)
+            self.stage_times.add("inference", time.perf_counter() - start, start)
+            dropped = put_latest(self.results, (frame_id, t_capture, frame, detections))
+            self.stage_times.count("dropped_frames", dropped)
+        self.finished.set()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def run_pipeline(cap, detect_fn, render_fn, max_frames=None):
+    """
+    Run the capture and inference stages on background threads and the render stage on the calling thread
+    (OpenCV windows have to be handled by the main thread)
+    :param cap: object with the cv2.VideoCapture interface
+    :param detect_fn: function that takes a frame and returns its detections
+    :param render_fn: function that takes a frame and its detections, and returns False to stop the pipeline
+    :param max_frames: stop after rendering this many frames (None to run until the source ends)
+    :return: StageTimes with the duration of each stage and the end-to-end latency
+    """
+    stage_times = StageTimes()
+    capture = CaptureThread(cap, stage_times)
+    inference = InferenceThread(capture, detect_fn, stage_times)
+    capture.start()
+    inference.start()
+
+    rendered = 0
+    try:
+        while max_frames is None or rendered < max_frames:
+            try:
+                frame_id, t_capture, frame, detections = inference.results.get(timeout=0.05)
+            except queue.Empty:
+                if inference.finished.is_set() and inference.results.empty():
+                    break
+                continue
+
+            start = time.perf_counter()
+            keep_going = render_fn(frame, detections)
+            end = time.perf_counter()
+            stage_times.add("render", end - start, start)
+            stage_times.add("latency", end - t_capture, t_capture)
+            rendered += 1
+            if keep_going is False:
+                break
+    finally:
+        capture.stop()
+        inference.stop()
+        capture.join(timeout=1)
+        inference.join(timeout=1)
+
+    return stage_times
+
+
+class BatchScheduler(threading.Thread):
+    """
+    Runs the detector on the latest frames of several capture threads, batched into a single inference call
+    A batch takes at most one frame per stream, and each batch starts with the stream after the last one served,
+    so every stream gets its turn even when there are more streams than the batch size
+    """
+
+    def __init__(self, captures, predict_fn, stage_times, ready, batch_size=8, max_wait=0.005, maxsize=1):
+        """
+        :param captures: list of CaptureThread (one per stream, all sharing the ready event)
+        :param predict_fn: function that takes a list of frames and returns a list of detections
+        :param stage_times: StageTimes
+        :param ready: threading.Event set by the capture threads when they have a new frame
+        :param batch_size: maximum number of frames per inference call
+        :param max_wait: once a frame is waiting, how long (seconds) to wait for the other streams to fill the batch
+        :param maxsize: number of results kept for the render stage of each stream
+        """
+        super().__init__(daemon=True)
+        self.captures = captures
+        self.predict_fn = predict_fn
+        self.stage_times = stage_times
+        self.ready = ready
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.results = [queue.Queue(maxsize=maxsize) for _ in captures]
+        self.n_processed = [0] * len(captures)
+        self.next_stream = 0
+        self.stopped = threading.Event()
+        self.finished = threading.Event()
+
+    def _sources_finished(self):
+        return all(c.finished.is_set() and c.frames.empty() for c in self.captures)
+
+    def _collect(self):
+        """ :return: list of (stream, frame_id, t_capture, frame), empty when the sources have finished """
+        n_streams = len(self.captures)
+        batch, taken = [], set()
+        deadline = None
+        while not self.stopped.is_set():
+            self.ready.clear()
+            for k in range(n_streams):
+                stream = (self.next_stream + k) % n_streams
+                if stream in taken or len(batch) == self.batch_size:
+                    continue
+                try:
+                    batch.append((stream,) + self.captures[stream].frames.get_nowait())
+                    taken.add(stream)
+                except queue.Empty:
+                    pass
+
+            if len(batch) == min(self.batch_size, n_streams):
+                break
+            if batch:
+                deadline = deadline or time.perf_counter() + self.max_wait
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.ready.wait(remaining)
+            elif self._sources_finished():
+                break
+            else:
+                self.ready.wait(0.05)
+
+        if batch:
+            self.next_stream = (batch[-1][0] + 1) % n_streams
+        return batch
+
+    def run(self):
+        while not self.stopped.is_set():
+            batch = self._collect()
+            if not batch:
+                break
+            streams, frame_ids, t_captures, frames = zip(*batch)
+            metrics.observe("batch_size", len(frames), buckets=DEPTH_BUCKETS)
+
+            start = time.perf_counter()
+            detections = self.predict_fn(list(frames))
+            self.stage_times.add("inference", time.perf_counter() - start, start)
+
+            for stream, frame_id, t_capture, frame, det in zip(streams, frame_ids, t_captures, frames, detections):
+                self.n_processed[stream] += 1
+                dropped = put_latest(self.results[stream], (frame_id, t_capture, frame, det))
+                self.stage_times.count("dropped_frames", dropped)
+        self.finished.set()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def run_multi_stream(caps, predict_fn, render_fn, batch_size=8, max_wait=0.005, max_frames=None):
+    """
+    Capture every source on its own thread, batch their latest frames on a scheduler thread and render the
+    results on the calling thread
+    :param caps: list of objects with the cv2.VideoCapture interface
+    :param predict_fn: function that takes a list of frames and returns a list of detections
+    :param render_fn: function that takes a stream index, a frame and its detections, and returns False to stop
+    :param batch_size: maximum number of frames per inference call
+    :param max_wait: how long (seconds) a frame may wait for the frames of other streams
+    :param max_frames: stop after rendering this many frames in total (None to run until all the sources end)
+    :return: StageTimes, and the number of frames processed for each stream
+    """
+    stage_times = StageTimes()
+    ready = threading.Event()
+    captures = [CaptureThread(cap, stage_times, ready=ready) for cap in caps]
+    scheduler = BatchScheduler(captures, predict_fn, stage_times, ready, batch_size=batch_size, max_wait=max_wait)
+    for capture in captures:
+        capture.start()
+    scheduler.start()
+
+    rendered = 0
+    try:
+        while max_frames is None or rendered < max_frames:
+            results = []
+            for stream, q in enumerate(scheduler.results):
+                try:
+                    results.append((stream,) + q.get_nowait())
+                except queue.Empty:
+                    pass
+            if not results:
+                if scheduler.finished.is_set() and all(q.empty() for q in scheduler.results):
+                    break
+                time.sleep(0.002)
+                continue
+
+            keep_going = True
+            for stream, frame_id, t_capture, frame, detections in results:
+                start = time.perf_counter()
+                keep_going = render_fn(stream, frame, detections) is not False and keep_going
+                end = time.perf_counter()
+                stage_times.add("render", end - start, start)
+                stage_times.add("latency", end - t_capture, t_capture)
+                rendered += 1
+            if not keep_going:
+                break
+    finally:
+        for capture in captures:
+            capture.stop()
+        scheduler.stop()
+        for capture in captures:
+            capture.join(timeout=1)
+        scheduler.join(timeout=1)
+
+    return stage_times, scheduler.n_processed
@@ -0,0 +1,230 @@
+"""
+Sliced inference for high resolution images (used by run.py --tiles)
+Face parts in group photos become tiny when the whole image is shrunk to the network input size,
+so the image is split into overlapping tiles that are run at their native resolution, and the boxes of
+all the tiles are merged with NMS or weighted box fusion (WBF).
+A coarse pass over the whole (shrunk) image finds where the faces are, so the empty tiles are skipped.
+"""
+
+import numpy as np
+import supervision as spv
+
+from metrics import metrics
+
+MERGE_METHODS = ['nms', 'wbf']
+
+
+def tile_grid(img_h, img_w, tile_size=640, overlap=0.2):
+    """
+    Split an image into overlapping tiles (the last row and column are shifted to end at the image border)
+    :param img_h: image height
+    :param img_w: image width
+    :param tile_size: tile side (pixels)
+    :param overlap: overlap between neighbouring tiles (fraction of the tile side)
+    :return: int array of tiles (x1, y1, x2, y2), shape (N, 4)
+    """
+    stride = max(1, int(tile_size * (1 - overlap)))
+
+    def starts(size):
+        if size <= tile_size:
+            return np.zeros(1, dtype=np.int64)
+        s = np.arange(0, size - tile_size, stride)
+        return np.append(s, size - tile_size)
+
+    ys, xs = starts(img_h), starts(img_w)
+    x1, y1 = np.meshgrid(xs, ys)
+    x1, y1 = x1.ravel(), y1.ravel()
+    return np.stack([x1, y1, np.minimum(x1 + tile_size, img_w), np.minimum(y1 + tile_size, img_h)], axis=1)
+
+
+def box_iou(a, b):
+    """
+    :param a: array of boxes (x1, y1, x2, y2), shape (N, 4)
+    :param b: array of boxes (x1, y1, x2, y2), shape (M, 4)
+    :return: IoU of every pair of boxes, shape (N, M)
+    """
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(rb - lt, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def _same_class_iou(xyxy, class_id):
+    """ IoU matrix where boxes of different classes never overlap """
+    iou = box_iou(xyxy, xyxy)
+    iou[class_id[:, None] != class_id[None, :]] = 0
+    return iou
+
+
+def nms(xyxy, confidence, class_id, iou_threshold=0.5):
+    """
+    Greedy non-maximum suppression for each class (the IoU of all pairs is computed at once)
+    :param xyxy: array of boxes, shape (N, 4)
+    :param confidence: array of scores, shape (N,)
+    :param class_id: array of class IDs, shape (N,)
+    :param iou_threshold: boxes that overlap a better one more than this are removed
+    :return: indices of the kept boxes, sorted by score
+    """
+    order = np.argsort(-confidence, kind='stable')
+    iou = _same_class_iou(xyxy[order], class_id[order])
+    keep = np.ones(len(order), dtype=bool)
+    for i in range(len(order)):
+        if keep[i]:
+            keep[i + 1:] &= iou[i, i + 1:] <= iou_threshold
+    return order[keep]
+
+
+def weighted_boxes_fusion(xyxy, confidence, class_id, iou_threshold=0.5):
+    """
+    Weighted box fusion for each class: the boxes that overlap the best remaining box of their class are averaged
+    (weighted by their scores), which gives better boxes than NMS for objects split between tiles
+    :param xyxy: array of boxes, shape (N, 4)
+    :param confidence: array of scores, shape (N,)
+    :param class_id: array of class IDs, shape (N,)
+    :param iou_threshold: boxes that overlap the best box more than this are fused with it
+    :return: fused boxes (M, 4), their scores (M,) (the best score of each cluster) and class IDs (M,)
+    """
+    order = np.argsort(-confidence, kind='stable')
+    xyxy, confidence, class_id = xyxy[order], confidence[order], class_id[order]
+    iou = _same_class_iou(xyxy, class_id)
+    free = np.ones(len(order), dtype=bool)
+    fused_boxes, fused_conf, fused_cls = [], [], []
+    for i in range(len(order)):
+        if not free[i]:
+            continue
+        members = free & (iou[i] > iou_threshold)
+        members[i] = True
+        free &= ~members
+        weights = confidence[members]
+        fused_boxes.append((xyxy[members] * weights[:, None]).sum(axis=0) / weights.sum())
+        fused_conf.append(confidence[i])
+        fused_cls.append(class_id[i])
+    if not fused_boxes:
+        return np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32), np.zeros(0, dtype=int)
+    return np.array(fused_boxes, dtype=np.float32), np.array(fused_conf, dtype=np.float32), np.array(fused_cls)
+
+
+def merge_detections(detections, names, method='nms', iou_threshold=0.5):
+    """
+    Merge the detections of several tiles (already in image coordinates)
+    :param detections: list of supervision.Detections
+    :param names: dictionary with the class names {class_id: class_name, ...}
+    :param method: 'nms' or 'wbf'
+    :param iou_threshold: IoU threshold of the merge
+    :return: supervision.Detections
+    """
+    detections = [d for d in detections if len(d)]
+    if not detections:
+        return spv.Detections(xyxy=np.zeros((0, 4), dtype=np.float32), confidence=np.zeros(0, dtype=np.float32),
+                              class_id=np.zeros(0, dtype=int), data={'class_name': np.array([], dtype=str)})
+
+    xyxy = np.concatenate([d.xyxy for d in detections]).astype(np.float32)
+    confidence = np.concatenate([d.confidence for d in detections]).astype(np.float32)
+    class_id = np.concatenate([d.class_id for d in detections]).astype(int)
+    if method == 'wbf':
+        xyxy, confidence, class_id = weighted_boxes_fusion(xyxy, confidence, class_id, iou_threshold)
+    else:
+        keep = nms(xyxy, confidence, class_id, iou_threshold)
+        xyxy, confidence, class_id = xyxy[keep], confidence[keep], class_id[keep]
+    return spv.Detections(xyxy=xyxy, confidence=confidence, class_id=class_id,
+                          data={'class_name': np.array([names[c] for c in class_id])})
+
+
+class TiledPredictor:
+    """
+    Runs a backend (see backends.py) on overlapping tiles of large images and merges the results
+    It has the same predict(images) interface as the backends
+    """
+
+    def __init__(self, backend, tile_size=640, overlap=0.2, merge='nms', iou=0.5, batch_size=16,
+                 coarse=True, coarse_conf=0.05, coarse_margin=0.5):
+        """
+        :param backend: backend object (see backends.load_backend)
+        :param tile_size: tile side in pixels of the original image
+        :param overlap: overlap between neighbouring tiles (fraction of the tile side)
+        :param merge: how the boxes of different tiles are merged ('nms' or 'wbf')
+        :param iou: IoU threshold of the merge
+        :param batch_size: maximum number of tiles per inference call
+        :param coarse: run the whole image first (its detections are kept too) and skip the tiles that do not
+                       contain any (weak) detection
+        :param coarse_conf: confidence threshold of the coarse pass (low, so that small faces still count)
+        :param coarse_margin: the coarse boxes are enlarged by this fraction of their size before checking the tiles
+        """
+        self.backend = backend
+        self.names = backend.names
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.merge = merge
+        self.iou = iou
+        self.batch_size = batch_size
+        self.coarse = coarse
+        self.coarse_conf = coarse_conf
+        self.coarse_margin = coarse_margin
+        self.n_tiles = 0
+        self.n_skipped = 0
+
+    def _coarse_pass(self, images):
+        conf = self.backend.conf
+        self.backend.conf = min(conf, self.coarse_conf)
+        try:
+            return self.backend.predict(images)
+        finally:
+            self.backend.conf = conf
+
+    def predict(self, images):
+        """
+        :param images: list of BGR images
+        :return: list of supervision.Detections (in the coordinates of each image)
+        """
+        # Pass over the whole images: it finds the big face parts (that tiles would split) and where the faces are
+        whole = [None] * len(images)
+        if self.coarse:
+            with metrics.span("coarse"):
+                whole = self._coarse_pass(images)
+
+        crops, owners, offsets = [], [], []
+        results = [[] for _ in images]
+        for i, (img, det) in enumerate(zip(images, whole)):
+            h, w = img.shape[:2]
+            tiles = tile_grid(h, w, self.tile_size, self.overlap)
+            if det is not None:
+                results[i].append(det[det.confidence >= self.backend.conf])
+                if max(h, w) <= self.tile_size:
+                    continue  # the coarse pass already ran it at full resolution
+                keep = _tiles_with_boxes(tiles, det.xyxy, self.coarse_margin)
+                self.n_skipped += int((~keep).sum())
+                tiles = tiles[keep]
+            for x1, y1, x2, y2 in tiles:
+                crops.append(img[y1:y2, x1:x2])  # a view, the backend letterboxes it into its own buffer
+                owners.append(i)
+                offsets.append((x1, y1, x1, y1))
+
+        # All the tiles of the batch go through the model together
+        self.n_tiles += len(crops)
+        with metrics.span("tiles"):
+            for start in range(0, len(crops), self.batch_size):
+                batch = crops[start:start + self.batch_size]
+                for j, det in enumerate(self.backend.predict(batch), start):
+                    det.xyxy = det.xyxy + np.array(offsets[j], dtype=np.float32)
+                    results[owners[j]].append(det)
+
+        with metrics.span("merge"):
+            return [merge_detections(dets, self.names, self.merge, self.iou) for dets in results]
+
+
+def _tiles_with_boxes(tiles, xyxy, margin=0.5):
+    """
+    :param tiles: array of tiles (x1, y1, x2, y2), shape (N, 4)
+    :param xyxy: array of boxes, shape (M, 4)
+    :param margin: the boxes are enlarged by this fraction of their size
+    :return: boolean mask of the tiles that intersect at least one box
+    """
+    if len(xyxy) == 0:
+        return np.zeros(len(tiles), dtype=bool)
+    size = xyxy[:, 2:] - xyxy[:, :2]
+    boxes = np.concatenate([xyxy[:, :2] - margin * size, xyxy[:, 2:] + margin * size], axis=1)
+    overlap_x = (tiles[:, None, 0] < boxes[None, :, 2]) & (tiles[:, None, 2] > boxes[None, :, 0])
+    overlap_y = (tiles[:, None, 1] < boxes[None, :, 3]) & (tiles[:, None, 3] > boxes[None, :, 1])
+    return (overlap_x & overlap_y).any(axis=1)
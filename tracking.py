@@ -0,0 +1,214 @@
+"""
+Temporal reuse of the detections for live_demo.py (--track)
+Consecutive camera frames are almost identical, so the model only runs on key frames: every N frames, or sooner
+when a cheap frame difference says that the scene changed. In between, the boxes are moved by a constant velocity
+tracker that matches the detections of each key frame with the existing tracks (IoU), so every face part keeps
+its track ID while it stays in view.
+"""
+
+import cv2
+import numpy as np
+import supervision as spv
+
+from metrics import metrics
+from tiling import box_iou
+
+
+def frame_signature(frame, size=(64, 48)):
+    """
+    :param frame: BGR image
+    :param size: (width, height) of the thumbnail
+    :return: small blurred grayscale thumbnail (float32), cheap to compare with another one
+    """
+    small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return cv2.GaussianBlur(small, (3, 3), 0).astype(np.float32)
+
+
+def frame_difference(signature_a, signature_b):
+    """
+    :param signature_a: output of frame_signature
+    :param signature_b: output of frame_signature
+    :return: mean absolute difference of the two thumbnails (0-255)
+    """
+    return float(np.abs(signature_a - signature_b).mean())
+
+
+class IouTracker:
+    """
+    Greedy IoU tracker with a constant velocity model (in pixels per frame)
+    The tracks are matched with the detections of the same class, from the best IoU to the worst
+    """
+
+    def __init__(self, iou_threshold=0.3, max_missed=1, smoothing=0.5):
+        """
+        :param iou_threshold: minimum IoU between a (predicted) track and a detection to match them
+        :param max_missed: a track is removed after this many key frames without a matching detection
+                           (until then it stays where it was last seen, so a single missed detection does not
+                           make the box blink)
+        :param smoothing: weight of the previous box when a track is updated (0: just use the detection)
+        """
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.smoothing = smoothing
+        self.xyxy = np.zeros((0, 4), dtype=np.float32)
+        self.velocity = np.zeros((0, 4), dtype=np.float32)
+        self.confidence = np.zeros(0, dtype=np.float32)
+        self.class_id = np.zeros(0, dtype=int)
+        self.track_id = np.zeros(0, dtype=int)
+        self.missed = np.zeros(0, dtype=int)
+        self.frame_index = 0
+        self.next_id = 1
+
+    def _match(self, xyxy, class_id):
+        """ :return: pairs (track index, detection index), sorted by IoU """
+        iou = box_iou(self.xyxy, xyxy)
+        iou[self.class_id[:, None] != class_id[None, :]] = 0
+        pairs = []
+        while iou.size and iou.max() >= self.iou_threshold:
+            t, d = np.unravel_index(iou.argmax(), iou.shape)
+            pairs.append((t, d))
+            iou[t, :] = 0
+            iou[:, d] = 0
+        return pairs
+
+    def update(self, detections, frame_index):
+        """
+        Correct the tracks with the detections of a key frame
+        :param detections: supervision.Detections of the key frame
+        :param frame_index: index of the key frame
+        :return: supervision.Detections of the tracks, with tracker_id
+        """
+        dt = max(frame_index - self.frame_index, 1)
+        predicted = self.xyxy + self.velocity * dt
+        self.xyxy = predicted
+        self.frame_index = frame_index
+
+        xyxy = detections.xyxy.astype(np.float32)
+        class_id = detections.class_id.astype(int)
+        pairs = self._match(xyxy, class_id)
+        matched_tracks = np.array([t for t, _ in pairs], dtype=int)
+        matched_dets = np.array([d for _, d in pairs], dtype=int)
+
+        # Matched tracks: blend the prediction with the detection, and update the velocity
+        if len(pairs):
+            old = predicted[matched_tracks] - self.velocity[matched_tracks] * dt
+            new = self.smoothing * predicted[matched_tracks] + (1 - self.smoothing) * xyxy[matched_dets]
+            self.velocity[matched_tracks] = (new - old) / dt
+            self.xyxy[matched_tracks] = new
+            self.confidence[matched_tracks] = detections.confidence[matched_dets]
+            self.missed[matched_tracks] = 0
+
+        # Unmatched tracks are kept for a while (the part may be missed in a single key frame)
+        unmatched = np.ones(len(self.xyxy), dtype=bool)
+        unmatched[matched_tracks] = False
+        self.missed[unmatched] += 1
+        self.velocity[unmatched] = 0  # they stop where they were last seen
+        alive = self.missed <= self.max_missed
+        self.xyxy, self.velocity = self.xyxy[alive], self.velocity[alive]
+        self.confidence, self.class_id = self.confidence[alive], self.class_id[alive]
+        self.track_id, self.missed = self.track_id[alive], self.missed[alive]
+
+        # Unmatched detections start new tracks
+        new = np.ones(len(xyxy), dtype=bool)
+        new[matched_dets] = False
+        n_new = int(new.sum())
+        self.xyxy = np.concatenate([self.xyxy, xyxy[new]])
+        self.velocity = np.concatenate([self.velocity, np.zeros((n_new, 4), dtype=np.float32)])
+        self.confidence = np.concatenate([self.confidence, detections.confidence[new].astype(np.float32)])
+        self.class_id = np.concatenate([self.class_id, class_id[new]])
+        self.track_id = np.concatenate([self.track_id, np.arange(self.next_id, self.next_id + n_new)])
+        self.missed = np.concatenate([self.missed, np.zeros(n_new, dtype=int)])
+        self.next_id += n_new
+        return self._detections(0)
+
+    def predict(self, frame_index):
+        """
+        Move the tracks to a frame without detections
+        :param frame_index: index of the frame
+        :return: supervision.Detections of the tracks, with tracker_id
+        """
+        return self._detections(frame_index - self.frame_index)
+
+    def _detections(self, dt):
+        xyxy = self.xyxy + self.velocity * dt
+        return spv.Detections(xyxy=xyxy.astype(np.float32), confidence=self.confidence.copy(),
+                              class_id=self.class_id.copy(), tracker_id=self.track_id.copy())
+
+
+class AdaptiveDetector:
+    """
+    Runs the model only on key frames and tracks the detections in between
+    It is called like the detect function of live_demo.py: frame -> supervision.Detections
+    """
+
+    def __init__(self, model, every_n=5, diff_threshold=8.0, tracker=None):
+        """
+        :param model: backend or predictor with predict(images) and names
+        :param every_n: run the model at least once every N frames
+        :param diff_threshold: run the model sooner if the mean absolute difference (0-255) between the frame
+                               and the last key frame is above this
+        :param tracker: IouTracker (a default one if None)
+        """
+        self.model = model
+        self.names = model.names
+        self.every_n = every_n
+        self.diff_threshold = diff_threshold
+        self.tracker = tracker if tracker is not None else IouTracker()
+        self.frame_index = -1
+        self.key_index = None
+        self.key_signature = None
+        self.n_key_frames = 0
+
+    def __call__(self, frame):
+        self.frame_index += 1
+        signature = frame_signature(frame)
+        is_key = (self.key_index is None or self.frame_index - self.key_index >= self.every_n or
+                  frame_difference(signature, self.key_signature) > self.diff_threshold)
+
+        if is_key:
+            self.key_index = self.frame_index
+            self.key_signature = signature
+            self.n_key_frames += 1
+            metrics.count("key_frames")
+            detections = self.model.predict([frame])[0]
+            with metrics.span("track"):
+                tracks = self.tracker.update(detections, self.frame_index)
+        else:
+            metrics.count("tracked_frames")
+            with metrics.span("track"):
+                tracks = self.tracker.predict(self.frame_index)
+
+        # Keep the boxes inside the frame
+        h, w = frame.shape[:2]
+        tracks.xyxy = tracks.xyxy.clip(0, [w, h, w, h]).astype(np.float32)
+        tracks.data = {'class_name': np.array([self.names[c] for c in tracks.class_id], dtype=str)}
+        return tracks
+
+
+def add_tracking_args(parser):
+    """
+    Add the temporal reuse options to a script's argument parser (see AdaptiveDetector)
+    :param parser: argparse.ArgumentParser
+    :return: None
+    """
+    parser.add_argument('--track', action='store_true',
+                        help="Only run the model on key frames and track the face parts in between")
+    parser.add_argument('--detect_every', type=int, default=5, help="Run the model at least once every N frames")
+    parser.add_argument('--diff_threshold', type=float, default=8.0,
+                        help="Run the model sooner when the frame changes more than this (mean abs. difference, 0-255)")
+    parser.add_argument('--track_iou', type=float, default=0.3, help="Minimum IoU to match a track and a detection")
+    parser.add_argument('--track_max_missed', type=int, default=1,
+                        help="Remove a track after this many key frames without its face part")
+
+
+def tracking_from_args(model, args):
+    """
+    :param model: backend or predictor (see backends.load_backend)
+    :param args: parsed arguments of a script that called add_tracking_args
+    :return: AdaptiveDetector if --track was given, None otherwise
+    """
+    if not args.track:
+        return None
+    tracker = IouTracker(iou_threshold=args.track_iou, max_missed=args.track_max_missed)
+    return AdaptiveDetector(model, every_n=args.detect_every, diff_threshold=args.diff_threshold, tracker=tracker)
@@ -20,6 +20,11 @@ if __name__ == "__main__":
     parser.add_argument("-b", '--batch_size', type=int, default=8, help="Batch size")
     parser.add_argument("-e", '--epochs', type=int, default=10, help="Number of epochs")
     parser.add_argument("--device", type=str, default=['0'], nargs='+', help="Device list (also accepts 'cpu')")
+    parser.add_argument("--shards", action='store_true',
+                        help="Train from the packed shards (run prepare_full_dataset.py with --shards first)")
+    parser.add_argument("--image_cache", type=str,
+                        help="Folder of a disk cache of decoded and resized images, shared by all the training runs")
+    parser.add_argument("--cache_gb", type=float, default=20.0, help="Size budget of the image cache (GB)")
     args = parser.parse_args()
 
     if args.path_data is not None:
@@ -29,10 +34,28 @@ if __name__ == "__main__":
 
     path_face_parts = path_datasets / "Face-Parts-Dataset"
     path_yaml = path_face_parts / "split" / "data.yaml"
+    trainer = None
+    if args.shards:
+        from trainers import ShardDetectionTrainer
+        path_yaml = path_face_parts / "shards" / "data.yaml"
+        trainer = ShardDetectionTrainer
+    if args.image_cache is not None:
+        if args.shards:
+            print("ERROR: the shards already hold resized images, --image_cache cannot be used with --shards")
+            exit()
+        if len(",".join(args.device).split(",")) > 1:
+            print("ERROR: the cache settings do not reach the processes of multi-GPU training, "
+                  "use --image_cache with a single --device")
+            exit()
+        from trainers import cached_trainer
+        trainer = cached_trainer(args.image_cache, max_gb=args.cache_gb)
 
     # Training
     model = YOLO("weights/yolov8{}.pt".format(args.arch))
     results = model.train(data=str(path_yaml), task="detect", name="{}_{}".format(args.name, args.arch),
                           epochs=args.epochs, imgsz=args.image_size, batch=args.batch_size,
-                          device=",".join(args.device),
+                          device=",".join(args.device), trainer=trainer,
                           scale=0.25, degrees=25.0, mosaic=0.8)
+    if args.image_cache is not None:
+        from image_cache import ImageCache
+        print("Image cache:", ImageCache(args.image_cache, imgsz=args.image_size, max_gb=args.cache_gb).stats())
@@ -0,0 +1,197 @@
+"""
+Custom Ultralytics datasets and trainers used by train.py
+"""
+
+import math
+
+import cv2
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.utils import colorstr
+from ultralytics.utils.torch_utils import de_parallel
+
+from shards import ShardReader, is_shard_dir
+from image_cache import ImageCache
+
+
+def _buffer_image(dataset, i, im, hw0, rect_mode):
+    """
+    The end of BaseDataset.load_image: resize the image to imgsz (if it is not already) and keep it in the
+    dataset buffer when training with augmentations
+    :param dataset: YOLO dataset
+    :param i: image index
+    :param im: decoded image
+    :param hw0: original (height, width) of the image
+    :param rect_mode: resize the long side to imgsz instead of stretching the image to a square
+    :return: image, original (height, width), resized (height, width)
+    """
+    h, w = im.shape[:2]
+    if rect_mode:  # resize long side to imgsz while maintaining aspect ratio
+        r = dataset.imgsz / max(h, w)
+        if r != 1:
+            w, h = (min(math.ceil(w * r), dataset.imgsz), min(math.ceil(h * r), dataset.imgsz))
+            im = cv2.resize(im, (w, h), interpolation=cv2.INTER_LINEAR)
+    elif not (h == w == dataset.imgsz):  # resize by stretching image to square imgsz
+        im = cv2.resize(im, (dataset.imgsz, dataset.imgsz), interpolation=cv2.INTER_LINEAR)
+
+    # Add to buffer if training with augmentations
+    if dataset.augment:
+        dataset.ims[i], dataset.im_hw0[i], dataset.im_hw[i] = im, hw0, im.shape[:2]
+        dataset.buffer.append(i)
+        if 1 < len(dataset.buffer) >= dataset.max_buffer_length:
+            j = dataset.buffer.pop(0)
+            if dataset.cache != "ram":
+                dataset.ims[j], dataset.im_hw0[j], dataset.im_hw[j] = None, None, None
+
+    return im, hw0, im.shape[:2]
+
+
+class ShardDataset(YOLODataset):
+    """
+    YOLO dataset that reads the images and labels from a shard folder (see shards.py) instead of single files
+    """
+
+    def __init__(self, *args, img_path, **kwargs):
+        self.shards = ShardReader(img_path)
+        # With rect=True, BaseDataset.set_rectangle sorts im_files and labels by aspect ratio, so the images are
+        # looked up by name and not by their position in the dataset
+        self.shard_index = {im_file: j for j, im_file in enumerate(self.shards.im_files)}
+        super().__init__(*args, img_path=img_path, **kwargs)
+
+    def get_img_files(self, img_path):
+        """ The images are listed in the shard index """
+        im_files = self.shards.im_files
+        if self.fraction < 1:
+            im_files = im_files[: round(len(im_files) * self.fraction)]  # retain a fraction of the dataset
+        return im_files
+
+    def get_labels(self):
+        """ Labels in the format of YOLODataset.cache_labels, straight from the shard index """
+        labels = []
+        for im_file in self.im_files:
+            j = self.shard_index[im_file]
+            lb = self.shards.labels(j)
+            labels.append({"im_file": im_file,
+                           "shape": tuple(self.shards.shapes[j]),
+                           "cls": lb[:, 0:1].copy(),
+                           "bboxes": lb[:, 1:].copy(),
+                           "segments": [],
+                           "keypoints": None,
+                           "normalized": True,
+                           "bbox_format": "xywh"})
+        return labels
+
+    def set_rectangle(self):
+        """ Same as BaseDataset.set_rectangle, checking that every label still belongs to its image afterwards """
+        super().set_rectangle()
+        for im_file, label in zip(self.im_files, self.labels):
+            j = self.shard_index[im_file]
+            if label["im_file"] != im_file or label["shape"] != tuple(self.shards.shapes[j]):
+                raise ValueError("The labels of {} do not match its image after sorting the dataset".format(im_file))
+
+    def load_image(self, i, rect_mode=True):
+        """ Same as BaseDataset.load_image, but decoding the image from the shard """
+        if self.ims[i] is not None:
+            return self.ims[i], self.im_hw0[i], self.im_hw[i]
+
+        j = self.shard_index[self.im_files[i]]
+        im = self.shards.image(j)
+        if im is None:
+            raise FileNotFoundError("Image Not Found {}".format(self.im_files[i]))
+
+        h0, w0 = self.shards.shapes[j]  # the image was resized when packed, but the labels need the original size
+        return _buffer_image(self, i, im, (h0, w0), rect_mode)
+
+
+class CachedDataset(YOLODataset):
+    """
+    YOLO dataset that reads the images already resized from a disk cache shared by all the runs (see image_cache.py)
+    """
+
+    def __init__(self, *args, image_cache, **kwargs):
+        self.image_cache = image_cache
+        super().__init__(*args, **kwargs)
+
+    def load_image(self, i, rect_mode=True):
+        """ Same as BaseDataset.load_image, but the decoded and resized image comes from the cache """
+        if self.ims[i] is not None:
+            return self.ims[i], self.im_hw0[i], self.im_hw[i]
+
+        im, hw0 = self.image_cache.load(self.im_files[i])
+        if im is None:
+            raise FileNotFoundError("Image Not Found {}".format(self.im_files[i]))
+        return _buffer_image(self, i, im, hw0, rect_mode)
+
+
+class ShardDetectionTrainer(DetectionTrainer):
+    """
+    Detection trainer that uses ShardDataset for the splits that point to a shard folder
+    """
+
+    def build_dataset(self, img_path, mode="train", batch=None):
+        if not is_shard_dir(img_path):
+            return super().build_dataset(img_path, mode=mode, batch=batch)
+
+        gs = max(int(de_parallel(self.model).stride.max() if self.model else 0), 32)
+        cfg = self.args
+        return ShardDataset(img_path=img_path,
+                            imgsz=cfg.imgsz,
+                            batch_size=batch,
+                            augment=mode == "train",
+                            hyp=cfg,
+                            rect=cfg.rect or mode == "val",
+                            cache="ram" if cfg.cache in (True, "ram") else None,  # *.npy disk caching needs image files
+                            single_cls=cfg.single_cls or False,
+                            stride=gs,
+                            pad=0.0 if mode == "train" else 0.5,
+                            prefix=colorstr("{}: ".format(mode)),
+                            task=cfg.task,
+                            classes=cfg.classes,
+                            data=self.data,
+                            fraction=cfg.fraction if mode == "train" else 1.0)
+
+
+class CachedDetectionTrainer(DetectionTrainer):
+    """
+    Detection trainer that reads the training and validation images through the disk cache of image_cache.py
+    Ultralytics creates the trainer from its class, so the cache settings are class attributes (see cached_trainer).
+    They are not passed to the processes of multi-GPU training, so train.py only uses this trainer on one device.
+    """
+
+    path_cache = None
+    max_gb = 20.0
+
+    def build_dataset(self, img_path, mode="train", batch=None):
+        if self.path_cache is None:
+            raise ValueError("The image cache folder is not set, use cached_trainer to get this trainer")
+
+        gs = max(int(de_parallel(self.model).stride.max() if self.model else 0), 32)
+        cfg = self.args
+        return CachedDataset(img_path=img_path,
+                             image_cache=ImageCache(self.path_cache, imgsz=cfg.imgsz, max_gb=self.max_gb),
+                             imgsz=cfg.imgsz,
+                             batch_size=batch,
+                             augment=mode == "train",
+                             hyp=cfg,
+                             rect=cfg.rect or mode == "val",
+                             cache="ram" if cfg.cache in (True, "ram") else None,
+                             single_cls=cfg.single_cls or False,
+                             stride=gs,
+                             pad=0.0 if mode == "train" else 0.5,
+                             prefix=colorstr("{}: ".format(mode)),
+                             task=cfg.task,
+                             classes=cfg.classes,
+                             data=self.data,
+                             fraction=cfg.fraction if mode == "train" else 1.0)
+
+
+def cached_trainer(path_cache, max_gb=20.0):
+    """
+    Set the cache settings of CachedDetectionTrainer
+    :param path_cache: cache folder (see image_cache.ImageCache)
+    :param max_gb: size budget of the cache (GB)
+    :return: CachedDetectionTrainer, reading the training and validation images through the cache
+    """
+    CachedDetectionTrainer.path_cache = path_cache
+    CachedDetectionTrainer.max_gb = max_gb
+    return CachedDetectionTrainer
@@ -1,6 +1,17 @@
+import os
+import shutil
+import struct
+from functools import lru_cache
+
 import cv2
 import numpy as np
 
+from annotation import SpriteAnnotator
+from metrics import metrics
+
+LINK_MODES = ['copy', 'hardlink', 'symlink', 'reflink']
+REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
 
 def smart_resize(img, new_size=512):
     """
@@ -13,6 +24,195 @@ def smart_resize(img, new_size=512):
     return cv2.resize(img, None, fx=ratio, fy=ratio), ratio
 
 
+def read_image(path, new_size=640):
+    """
+    Read an image from disk and resize it with smart_resize
+    :param path: path to the image
+    :param new_size: output max size
+    :return: resized image, or None if the image could not be read
+    """
+    with metrics.span("decode"):
+        img = cv2.imread(str(path), cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    with metrics.span("resize"):
+        img, _ = smart_resize(img, new_size=new_size)
+    return img
+
+
+def decode_image(path, min_size=None):
+    """
+    Read an image without resizing it, except for large JPEG images: the decoder can downscale them by 2, 4 or 8
+    while decoding (much faster than decoding them at full size), as long as the long side stays >= min_size
+    :param path: path to the image
+    :param min_size: smallest long side needed by the model (None to always decode at full size)
+    :return: image (or None if it could not be read), (x, y) scale from the decoded image to the original one
+    """
+    path = str(path)
+    flag = cv2.IMREAD_COLOR
+    size = None
+    if min_size is not None:
+        try:
+            with open(path, 'rb') as f:
+                is_jpeg = f.read(2) == b"\xff\xd8"
+            size = image_size(path) if is_jpeg else None
+        except (OSError, struct.error):
+            size = None  # a plain cv2.imread decides whether it can be read
+        if size is not None:
+            for factor, reduced_flag in REDUCED_FLAGS:
+                if max(size) >= factor * min_size:
+                    flag = reduced_flag
+                    break
+
+    with metrics.span("decode"):
+        img = cv2.imread(path, flag)
+    if img is None:
+        return None, (1.0, 1.0)
+    if size is None:
+        return img, (1.0, 1.0)
+    return img, (size[1] / img.shape[1], size[0] / img.shape[0])
+
+
+def _reflink(src, dst):
+    """
+    Copy-on-write clone of a file (only Linux filesystems with FICLONE support, like Btrfs or XFS)
+    :param src: source file
+    :param dst: destination file
+    :return: None
+    """
+    import fcntl
+    FICLONE = 0x40049409
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        try:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        except OSError:
+            f_dst.close()
+            os.remove(dst)
+            raise
+
+
+def link_file(src, dst, mode='copy'):
+    """
+    Put a file in a new location without copying its data when possible
+    If the link cannot be created (e.g. the folders are in different filesystems), the file is copied
+    :param src: source file
+    :param dst: destination file (it is replaced if it exists)
+    :param mode: 'copy', 'hardlink', 'symlink' or 'reflink'
+    :return: mode that was actually used
+    """
+    with metrics.span("link"):
+        return _link_file(src, dst, mode)
+
+
+def _link_file(src, dst, mode):
+    # Removing the old file first matters: copying onto an old hardlink would overwrite the source file
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        if mode == 'hardlink':
+            os.link(src, dst)
+            return mode
+        elif mode == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+            return mode
+        elif mode == 'reflink':
+            _reflink(src, dst)
+            return mode
+    except (OSError, ImportError):
+        pass
+    shutil.copy(src, dst)
+    return 'copy'
+
+
+def _jpeg_size(f):
+    """
+    Read the size of a JPEG image from its SOF marker (and the EXIF orientation, like cv2.imread does)
+    :param f: file object, right after the SOI marker
+    :return: (height, width), or None if the SOF marker was not found
+    """
+    swap = False
+    while True:
+        marker = f.read(2)
+        while len(marker) == 2 and marker[1] == 0xFF:  # fill bytes
+            marker = marker[1:] + f.read(1)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:  # markers without a segment
+            continue
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack(">H", length_bytes)[0]
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            sof = f.read(5)
+            if len(sof) < 5:
+                return None  # truncated file
+            _, h, w = struct.unpack(">BHH", sof)
+            return (w, h) if swap else (h, w)
+        segment = f.read(length - 2)
+        if code == 0xE1 and segment[:6] == b"Exif\x00\x00":
+            swap = _exif_orientation(segment[6:]) in (5, 6, 7, 8)
+
+
+def _exif_orientation(tiff):
+    """
+    :param tiff: TIFF block of an EXIF segment
+    :return: orientation tag (1 if it is missing or the block cannot be parsed)
+    """
+    try:
+        endian = "<" if tiff[:2] == b"II" else ">"
+        ifd = struct.unpack(endian + "I", tiff[4:8])[0]
+        for i in range(struct.unpack(endian + "H", tiff[ifd:ifd + 2])[0]):
+            entry = tiff[ifd + 2 + 12 * i: ifd + 14 + 12 * i]
+            if struct.unpack(endian + "H", entry[:2])[0] == 0x0112:
+                return struct.unpack(endian + "H", entry[8:10])[0]
+    except struct.error:
+        pass
+    return 1
+
+
+@lru_cache(maxsize=4096)
+def _image_size(path, file_size, mtime):
+    """ Cached by path, size and modification time so that edited images are read again """
+    with open(path, 'rb') as f:
+        head = f.read(26)
+        try:
+            if head[:2] == b"\xff\xd8":
+                f.seek(2)
+                size = _jpeg_size(f)
+                if size is not None:
+                    return size
+            elif head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR" and len(head) >= 24:
+                w, h = struct.unpack(">II", head[16:24])
+                return h, w
+            elif head[:2] == b"BM" and len(head) >= 26:
+                if struct.unpack("<I", head[14:18])[0] == 12:  # old OS/2 header
+                    w, h = struct.unpack("<HH", head[18:22])
+                else:
+                    w, h = struct.unpack("<ii", head[18:26])
+                return abs(h), w
+        except struct.error:
+            pass  # corrupt header
+
+    # Unknown format or corrupt header: decoding the whole image is the only option
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    return None if img is None else img.shape[:2]
+
+
+def image_size(path):
+    """
+    Get the size of an image without decoding it (only the header is read for JPEG, PNG and BMP images)
+    :param path: path to the image
+    :return: (height, width), or None if the image could not be read
+    """
+    try:
+        st = os.stat(path)
+        return _image_size(str(path), st.st_size, st.st_mtime_ns)
+    except OSError:
+        return None  # missing, a folder, no read permission...
+
+
 def points_to_yolo(labels_df, points, part_id, img_h, img_w):
     """
     Create a contour from the list of X,Y points and get the bounding box
@@ -35,19 +235,95 @@ def points_to_yolo(labels_df, points, part_id, img_h, img_w):
     return x, y, w, h  # these are not the normalised coordinates, these are for plotting the box
 
 
+def part_index_groups(part_points, use_parts):
+    """
+    Prepare the landmark groups of a dataset for landmarks_to_yolo
+    Each group is padded by repeating its first index, which does not change its min/max coordinates
+    :param part_points: dictionary with the landmark indices of each face part {part_name: [idxs, ...], ...}
+    :param use_parts: list of face parts to use (the index is the class ID)
+    :return: class ID of each group (G,), padded landmark indices of each group (G, max group size)
+    """
+    groups = [(part_id, idxs) for part_id, part_name in enumerate(use_parts) for idxs in part_points[part_name]]
+    max_size = max(len(idxs) for _, idxs in groups)
+    class_ids = np.array([part_id for part_id, _ in groups], dtype=np.int64)
+    idx = np.array([list(idxs) + [idxs[0]] * (max_size - len(idxs)) for _, idxs in groups], dtype=np.int64)
+    return class_ids, idx
+
+
+def landmarks_to_boxes(points, idx):
+    """
+    Get the bounding box (in pixels) of each landmark group, like cv2.boundingRect does
+    :param points: array of (X,Y) points, shape (N_points, 2) or (N_images, N_points, 2)
+    :param idx: padded landmark indices of each group (see part_index_groups)
+    :return: int array of boxes (x, y, w, h), shape (G, 4) or (N_images, G, 4)
+    """
+    points = np.asarray(points).astype(np.int32)  # truncated, as cv2.boundingRect needs integer points
+    grouped = points[..., idx, :]  # (..., G, group size, 2)
+    xy_min = grouped.min(axis=-2)
+    xy_max = grouped.max(axis=-2)
+    return np.concatenate([xy_min, xy_max - xy_min + 1], axis=-1)
+
+
+def landmarks_to_yolo(points, class_ids, idx, img_h, img_w):
+    """
+    Convert the facial landmarks of one or many images to normalized YOLO boxes
+    :param points: array of (X,Y) points, shape (N_points, 2) or (N_images, N_points, 2)
+    :param class_ids: class ID of each group (see part_index_groups)
+    :param idx: padded landmark indices of each group (see part_index_groups)
+    :param img_h: image height (a scalar, or an array with the height of each image)
+    :param img_w: image width (a scalar, or an array with the width of each image)
+    :return: YOLO labels (class, x_c, y_c, w, h), shape (G, 5) or (N_images, G, 5),
+             and the boxes in pixels (see landmarks_to_boxes)
+    """
+    boxes = landmarks_to_boxes(points, idx)
+    size = np.stack(np.broadcast_arrays(np.asarray(img_w, dtype=np.float64),
+                                        np.asarray(img_h, dtype=np.float64)), axis=-1)
+    if size.ndim > 1:
+        size = size[:, None, :]  # one size per image, shared by all of its groups
+    xy_n = boxes[..., :2] / size
+    wh_n = boxes[..., 2:] / size
+    labels = np.empty(boxes.shape[:-1] + (5,), dtype=np.float64)
+    labels[..., 0] = class_ids
+    labels[..., 1:3] = xy_n + 0.5 * wh_n
+    labels[..., 3:5] = wh_n
+    return labels, boxes
+
+
+def parse_landmarks(lines):
+    """
+    Parse landmark lines such as "x y" or "x , y" (Helen) into an array
+    :param lines: list of strings, one point per line
+    :return: float array of (X,Y) points, shape (N_points, 2)
+    """
+    return np.array(" ".join(lines).replace(",", " ").split(), dtype=np.float64).reshape(-1, 2)
+
+
+def write_yolo_labels(path, labels):
+    """
+    Save YOLO labels to a txt file
+    :param path: path to the label file
+    :param labels: array of labels (class, x_c, y_c, w, h), shape (N, 5)
+    :return: None
+    """
+    np.savetxt(path, np.asarray(labels).reshape(-1, 5), fmt="%d %.6f %.6f %.6f %.6f")
+
+
 def annotate_frame(image, detections, box_annotator, label_annotator, class_names_dict):
     """
-    Annotate the bounding box with class name and confidence
+    Annotate the bounding box with class name and confidence (and track ID, if the detections are tracked)
     :param image: input image
     :param detections: YOLO detections object
-    :param box_annotator: supervision bounding box annotator
-    :param label_annotator: supervision bounding box annotator
+    :param box_annotator: supervision bounding box annotator (or annotation.SpriteAnnotator)
+    :param label_annotator: supervision label annotator (or annotation.SpriteAnnotator)
     :param class_names_dict: dictionary with model's class names {class_id: class_name, ...}
     :return: annotated image
     """
+    if isinstance(box_annotator, SpriteAnnotator):
+        return box_annotator.annotate(image, detections, class_names_dict)
     labels = [
-        "{} {:0.2f}".format(class_names_dict[class_id], confidence)
-        for _, _, confidence, class_id, _, _
+        "{} {:0.2f}".format(class_names_dict[class_id], confidence) if tracker_id is None else
+        "#{} {} {:0.2f}".format(tracker_id, class_names_dict[class_id], confidence)
+        for _, _, confidence, class_id, tracker_id, _
         in detections
     ]
     image = box_annotator.annotate(scene=image, detections=detections)
@@ -0,0 +1,153 @@
+"""
+Incremental processing of a folder that keeps receiving new images (used by run.py --watch)
+The images that are already in the report are listed in a small index next to it, one "name<TAB>size<TAB>mtime"
+line per image. The index is only appended to, after the detections of the new images have been written,
+so an interrupted run never loses detections (at worst, the images of the last scan are processed again).
+An image whose size or modification time changed is processed again (the last line of a name wins).
+"""
+
+import os
+import time
+from pathlib import Path
+
+from backends import IMAGE_EXTENSIONS
+
+# Files added right after a scan may not change the folder mtime (it has the same timestamp tick, which is coarse
+# on some filesystems, e.g. 2 s on FAT), so the folder is listed again until its mtime is older than this
+MTIME_WINDOW_NS = 2_000_000_000
+
+
+class ProcessedIndex:
+    """
+    Append-only index of the images that were already processed
+    """
+
+    def __init__(self, path, reset=False):
+        """
+        :param path: path to the index (text file)
+        :param reset: forget the images of the previous runs
+        """
+        self.path = Path(path)
+        self.entries = {}  # name -> (size, mtime_ns)
+        if reset:
+            self.path.unlink(missing_ok=True)
+        elif self.path.is_file():
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) == 3:  # the last line may be incomplete if a previous run was killed
+                        self.entries[fields[0]] = (int(fields[1]), int(fields[2]))
+        self._dir_mtime = None
+        self._listed_at = None
+        self._waiting = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def scan(self, path_data, settle=1.0, extensions=IMAGE_EXTENSIONS, recheck=False):
+        """
+        Find the images that are not in the index yet (or that changed, with recheck)
+        Only the new names are stat'ed, and the folder is not listed at all if its mtime did not change since the
+        last scan (adding or renaming a file always changes it), so a scan of a huge folder is cheap.
+        :param path_data: folder with the images
+        :param settle: ignore the files modified less than this many seconds ago (they may still be uploading)
+        :param extensions: image file extensions
+        :param recheck: also stat the images that are already in the index, and return the ones whose size or
+                        mtime changed (slower: a stat call per file)
+        :return: list of (name, size, mtime_ns) of the new images, sorted by name
+        """
+        dir_mtime = os.stat(path_data).st_mtime_ns
+        if (not recheck and not self._waiting and dir_mtime == self._dir_mtime and
+                self._listed_at - dir_mtime > MTIME_WINDOW_NS):
+            return []
+
+        now = time.time_ns()
+        self._dir_mtime, self._listed_at = dir_mtime, now
+        new, self._waiting = [], False
+        with os.scandir(path_data) as it:
+            for entry in it:
+                if not entry.name.lower().endswith(extensions) or (entry.name in self.entries and not recheck):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue  # deleted while scanning
+                if self.entries.get(entry.name) == (st.st_size, st.st_mtime_ns):
+                    continue
+                if now - st.st_mtime_ns < settle * 1e9:
+                    self._waiting = True  # look at it again in the next scan
+                    continue
+                new.append((entry.name, st.st_size, st.st_mtime_ns))
+        return sorted(new)
+
+    def add(self, files):
+        """
+        Add processed images to the index (and to the file on disk)
+        :param files: list of (name, size, mtime_ns)
+        :return: None
+        """
+        if not files:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write("".join("{}\t{}\t{}\n".format(*entry) for entry in files))
+            f.flush()
+            os.fsync(f.fileno())
+        for name, size, mtime in files:
+            self.entries[name] = (size, mtime)
+
+
+def file_entries(path_data, names):
+    """
+    :param path_data: folder with the images
+    :param names: list of file names
+    :return: list of (name, size, mtime_ns) of the files that still exist
+    """
+    entries = []
+    for name in names:
+        try:
+            st = os.stat(os.path.join(path_data, name))
+        except FileNotFoundError:
+            continue
+        entries.append((name, st.st_size, st.st_mtime_ns))
+    return entries
+
+
+def watch(path_data, index, process_fn, interval=2.0, settle=1.0, recheck_interval=60.0, max_scans=None):
+    """
+    Process the new images of a folder until the user stops it (Ctrl+C)
+    :param path_data: folder with the images
+    :param index: ProcessedIndex
+    :param process_fn: function that takes a list of file names, processes them and writes their detections
+                       (the index is updated after it returns)
+    :param interval: seconds between two scans
+    :param settle: ignore the files modified less than this many seconds ago
+    :param recheck_interval: seconds between two scans that also look for changed images (None to never do it)
+    :param max_scans: stop after this many scans (None to run forever)
+    :return: number of processed images
+    """
+    n_processed, n_scans = 0, 0
+    last_recheck = time.perf_counter()
+    try:
+        while max_scans is None or n_scans < max_scans:
+            start = time.perf_counter()
+            recheck = recheck_interval is not None and start - last_recheck >= recheck_interval
+            if recheck:
+                last_recheck = start
+            new = index.scan(path_data, settle, recheck=recheck)
+            n_scans += 1
+            if new:
+                n_changed = sum(name in index for name, _, _ in new)
+                print("{} new and {} changed images ({} already processed)".format(
+                    len(new) - n_changed, n_changed, len(index)))
+                process_fn([name for name, _, _ in new])
+                index.add(new)
+                n_processed += len(new)
+            if max_scans is None or n_scans < max_scans:
+                time.sleep(max(0.0, interval - (time.perf_counter() - start)))
+    except KeyboardInterrupt:
+        pass
+    return n_processed